@@ -1,80 +1,196 @@
-from http.client import NOT_IMPLEMENTED
-from models import db, connect_db, User, Message, Likes
-from forms import CSRFProtectForm, UserAddForm, LoginForm, MessageForm, UserEditForm
-from sqlalchemy import or_
-from sqlalchemy.exc import IntegrityError
-from flask_debugtoolbar import DebugToolbarExtension
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
-import os
-from dotenv import load_dotenv
+"""Warbler: a Flask app factory plus the Warbler views (as a blueprint).
 
-load_dotenv()
+`create_app()` builds an app for one environment (see config.py). The
+module-level name `app` is created on first access, so importing this
+module doesn't build an app; `gunicorn app:app`, `from app import app` and
+`flask run` all still work.
+"""
 
+import logging
+import os
+from itertools import islice
+
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    render_template,
+    send_file,
+    request,
+    flash,
+    redirect,
+    session,
+    g,
+    url_for,
+)
+from flask.ctx import _AppCtxGlobals
+from flask_sqlalchemy import Pagination
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm import joinedload
+
+import archival
+import archives
+import cache
+import events
+import health
+import images
+import jobs
+import logs
+import metrics
+import notifications
+import profiling
+import ratelimit
+import recommendations
+import sessions
+import shards
+import snapshots
+import templating
+import timeline
+import trending
+from config import CONFIGS
+from forms import CSRFProtectForm, UserAddForm, LoginForm, MessageForm, UserEditForm
+from ratelimit import Rate
+from templating import stream_template
+from models import (
+    db,
+    connect_db,
+    retry_on_conflict,
+    DEFAULT_HEADER_IMAGE,
+    DEFAULT_IMAGE,
+    User,
+    Message,
+    Likes,
+    Follows,
+)
+
+logger = logging.getLogger(__name__)
 
 CURR_USER_KEY = "curr_user"
+FOLLOWS_PER_PAGE = 24
+LIKERS_PER_PAGE = 24
+
+# Streamed listings fetch rows (and the viewer's follow/like flags for them)
+# this many at a time.
+STREAM_BATCH = 100
+
+PROFILE_CHANGED = (
+    "Your profile was changed somewhere else since you opened this page. "
+    "Please check it and make your edits again."
+)
+
+bp = Blueprint("warbler", __name__)
+
+
+class AppGlobals(_AppCtxGlobals):
+    """Flask's `g`, building the CSRF form only when something uses it.
+
+    Most GET requests render no form that needs `g.csrf_checking`, so there
+    is no point creating one (and a CSRF token in the session) up front.
+    `g.unread_notifications`, for the nav badge, is looked up the same way.
+    """
+
+    def __getattr__(self, name):
+        if name == "csrf_checking":
+            self.csrf_checking = CSRFProtectForm()
+            return self.csrf_checking
+
+        if name == "unread_notifications":
+            user = self.get("user")
+            self.unread_notifications = (
+                notifications.unread_count(user.id) if user else 0
+            )
+            return self.unread_notifications
+
+        return super().__getattr__(name)
+
+
+def create_app(config_name=None):
+    """Create a Warbler app configured for `config_name`.
+
+    Defaults to the WARBLER_ENV environment variable, then "development".
+    """
+
+    config_name = config_name or os.environ.get("WARBLER_ENV", "development")
+    config_class = CONFIGS[config_name]
+
+    if config_class.LOAD_DOTENV:
+        from dotenv import load_dotenv
 
-app = Flask(__name__)
+        load_dotenv()
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-database_url = os.environ["DATABASE_URL"]
-database_url = database_url.replace("postgres://", "postgresql://")
+    app = Flask(__name__)
+    app.app_ctx_globals_class = AppGlobals
+    app.config.from_object(config_class())
 
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = False
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = True
-app.config["SECRET_KEY"] = os.environ["SECRET_KEY"]
-toolbar = DebugToolbarExtension(app)
+    logs.init_app(app)
+    profiling.init_app(app)
+    ratelimit.init_app(app, user_id=lambda: session.get(CURR_USER_KEY))
+    templating.init_app(app)
+    images.init_app(app)
+    sessions.init_app(app)
+    cache.init_app(app)
+    timeline.init_app(app)
+    archives.init_app(app)
+    archival.init_app(app)
 
-database_url = os.environ['DATABASE_URL']
+    if app.config["DEBUG_TOOLBAR"]:
+        from flask_debugtoolbar import DebugToolbarExtension
 
-# fix incorrect database URIs currently returned by Heroku's pg setup
-database_url = database_url.replace('postgres://', 'postgresql://')
+        DebugToolbarExtension(app)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    connect_db(app)
+    shards.init_app(app, db)
+    metrics.init_app(app, db)
+    health.init_app(app, db)
+    app.register_blueprint(bp)
 
-connect_db(app)
+    return app
+
+
+def __getattr__(name):
+    """Build the module-level `app` the first time something asks for it."""
+
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # ~~ User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = db.session.get(User, session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
-@app.before_request
-def add_csrf_keys_to_g():
-    """If we're logged in, add the WTF CSRF token to the Flask global"""
-
-    # g.logout_form = CSRFProtectForm()
-    # g.delete_form = CSRFProtectForm()
-    g.csrf_checking = CSRFProtectForm()
-
-
 def do_login(user):
     """Log in user."""
 
+    sessions.regenerate(session)
     session[CURR_USER_KEY] = user.id
 
 
 def do_logout():
     """Logout user."""
 
+    sessions.regenerate(session)
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
 
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
+@ratelimit.limit(per_ip=Rate(5, 60), concurrency=4, methods=["POST"])
 def signup():
     """Handle user signup.
 
@@ -110,7 +226,8 @@ def signup():
         return render_template("users/signup.html", form=form)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
+@ratelimit.limit(per_ip=Rate(10, 60), concurrency=4, methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -129,7 +246,7 @@ def login():
     return render_template("users/login.html", form=form)
 
 
-@app.post("/logout")
+@bp.post("/logout")
 def logout():
     """Handle logout of user."""
 
@@ -148,11 +265,55 @@ def logout():
         return redirect("/")
 
 
+##############################################################################
+# ~~ Streaming helpers
+
+
+def batched(rows, size=STREAM_BATCH):
+    """Yield lists of up to `size` items from the iterable `rows`."""
+
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def with_following_flags(users):
+    """Yield (user, is g.user following them) pairs, a batch query at a time."""
+
+    for batch in batched(users):
+        ids = g.user.following_ids_among([u.id for u in batch]) if g.user else set()
+        for user in batch:
+            yield user, user.id in ids
+
+
+def liked_ids_for(messages):
+    """Ids of those of `messages` that g.user likes, in one query."""
+
+    if not g.user:
+        return set()
+    return g.user.liked_ids_among([msg.id for msg in messages])
+
+
+def with_liked_flags(messages):
+    """Yield (message, does g.user like it) pairs, a batch query at a time."""
+
+    for batch in batched(messages):
+        ids = g.user.liked_ids_among([m.id for m in batch]) if g.user else set()
+        for msg in batch:
+            yield msg, msg.id in ids
+
+
 ##############################################################################
 # ~~ General user routes:
 
 
-@app.get("/users")
+@bp.get("/users")
+@ratelimit.limit(
+    per_ip=Rate(60, 60),
+    per_user=Rate(30, 60),
+    concurrency=8,
+    when=lambda: bool(request.args.get("q")),
+)
 def list_users():
     """Page with listing of users.
 
@@ -160,24 +321,46 @@ def list_users():
     """
     search = request.args.get("q")
 
-    if not search:
-        users = User.query.all()
+    if search:
+        # yield_per reads through a server-side cursor, so neither the rows
+        # nor the rendered page are ever held in memory all at once.
+        users = (
+            User.query.filter(User.username.like(f"%{search}%"))
+            .order_by(User.id)
+            .yield_per(STREAM_BATCH)
+        )
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        # Everyone sees the same unfiltered list: read it from the cache a
+        # chunk at a time.
+        users = snapshots.directory(STREAM_BATCH)
 
-    return render_template("users/index.html", users=users)
+    return stream_template("users/index.html", users=with_following_flags(users))
 
 
-@app.get("/users/<int:user_id>")
+@bp.get("/users/<int:user_id>")
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    return render_template("users/show.html", user=user)
-
-
-@app.get("/users/<int:user_id>/following")
+    # The header (and its counts) is cached; the messages are not.
+    user = snapshots.profile(user_id)
+    if user is None:
+        abort(404)
+    messages = (
+        Message.query.filter_by(user_id=user_id)
+        .options(joinedload(Message.user))
+        .order_by(Message.timestamp.desc())
+        .all()
+    )
+
+    return render_template(
+        "users/show.html",
+        user=user,
+        messages=messages,
+        liked_ids=liked_ids_for(messages),
+    )
+
+
+@bp.get("/users/<int:user_id>/following")
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -186,10 +369,19 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("users/following.html", user=user)
+    page = request.args.get("page", 1, type=int)
+    following = user.following_query().paginate(page, FOLLOWS_PER_PAGE)
+    following_ids = g.user.following_ids_among([u.id for u in following.items])
+
+    return stream_template(
+        "users/following.html",
+        user=user,
+        following=following,
+        following_ids=following_ids,
+    )
 
 
-@app.get("/users/<int:user_id>/followers")
+@bp.get("/users/<int:user_id>/followers")
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -198,10 +390,19 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template("users/followers.html", user=user)
+    page = request.args.get("page", 1, type=int)
+    followers = user.followers_query().paginate(page, FOLLOWS_PER_PAGE)
+    following_ids = g.user.following_ids_among([u.id for u in followers.items])
 
+    return stream_template(
+        "users/followers.html",
+        user=user,
+        followers=followers,
+        following_ids=following_ids,
+    )
 
-@app.post("/users/follow/<int:follow_id>")
+
+@bp.post("/users/follow/<int:follow_id>")
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -209,14 +410,26 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    User.query.get_or_404(follow_id)
+    follower_id = g.user.id
+
+    def follow():
+        created_at = Follows.add(follower_id, follow_id)
+        if created_at is not None:
+            # A Core insert, so flush can't see it.
+            events.emit(
+                db.session,
+                "follow.created",
+                follower_id=follower_id,
+                followed_id=follow_id,
+            )
+
+    retry_on_conflict(follow)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post("/users/stop-following/<int:follow_id>")
+@bp.post("/users/stop-following/<int:follow_id>")
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -224,14 +437,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = Follows.query.get((follow_id, g.user.id))
+    if follow is not None:
+        db.session.delete(follow)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route("/users/profile", methods=["GET", "POST"])
+@bp.route("/users/profile", methods=["GET", "POST"])
+@ratelimit.limit(per_user=Rate(10, 60), concurrency=4, methods=["POST"])
 def profile():
     """Update profile for current user."""
 
@@ -245,6 +460,11 @@ def profile():
         is_password_valid = User.authenticate(g.user.username, form.password.data)
 
         if is_password_valid:
+            version = form.version_id.data
+            if version and version != str(g.user.version_id):
+                flash(PROFILE_CHANGED, "warning")
+                return redirect("/users/profile")
+
             g.user.username = form.username.data
             g.user.email = form.email.data
             g.user.image_url = (
@@ -257,7 +477,13 @@ def profile():
             )
             g.user.bio = form.bio.data
 
-            db.session.commit()
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                flash(PROFILE_CHANGED, "warning")
+                return redirect("/users/profile")
+
             flash("User Profile Updated!", "success")
             return redirect(f"/users/{g.user.id}")
 
@@ -268,7 +494,7 @@ def profile():
         return render_template("/users/edit.html", form=form)
 
 
-@app.post("/users/delete")
+@bp.post("/users/delete")
 def delete_user():
     """Delete user."""
 
@@ -280,28 +506,90 @@ def delete_user():
 
         do_logout()
 
-        Message.query.filter(Message.user_id == g.user.id).delete()
+        # A single DELETE: the database cascades it to the user's messages,
+        # likes and follows (see the passive_deletes relationships). The
+        # cascade can't keep like counts in step, so release those first.
+        user_id = g.user.id
+        Message.add_likes(
+            db.select(Likes.message_being_liked_id).where(Likes.user_id == user_id),
+            -1,
+        )
         db.session.delete(g.user)
         db.session.commit()
 
         flash("User was deleted", "warning")
         return redirect("/signup")
 
+    else:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+
+@bp.post("/users/archive")
+def request_archive():
+    """Start exporting the current user's archive in the background."""
+
+    if not archives.enabled():
+        abort(404)
+
+    if not g.user or not g.csrf_checking.validate_on_submit():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    jobs.enqueue("archive_requested", user_id=g.user.id)
+    db.session.commit()
+
+    flash("Your archive is being prepared; download it from your profile.", "info")
+    return redirect(f"/users/{g.user.id}")
+
+
+@bp.get("/users/archive")
+def download_archive():
+    """Download the current user's most recent archive."""
+
+    if not archives.enabled():
+        abort(404)
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-@app.get("/users/<int:user_id>/likes")
+    path = archives.archive_path(g.user.id)
+    if not os.path.exists(path):
+        flash("No archive yet. Request one from your profile.", "warning")
+        return redirect(f"/users/{g.user.id}")
+
+    return send_file(
+        path,
+        mimetype="application/gzip",
+        as_attachment=True,
+        download_name=f"warbler-{g.user.username}.ndjson.gz",
+    )
+
+
+@bp.get("/users/<int:user_id>/likes")
 def list_liked_messages_for_user(user_id):
     """List all messages liked by a user."""
 
-    user = User.query.get(user_id)
+    user = User.query.get_or_404(user_id)
+    messages = (
+        user.liked_messages_query()
+        .options(joinedload(Message.user))
+        .yield_per(STREAM_BATCH)
+    )
 
-    return render_template("/users/likes.html", user=user)
+    return stream_template(
+        "users/likes.html",
+        user=user,
+        messages=with_liked_flags(messages),
+    )
 
 
 ##############################################################################
 # ~~ Messages routes:
 
 
-@app.route("/messages/new", methods=["GET", "POST"])
+@bp.route("/messages/new", methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -324,16 +612,43 @@ def messages_add():
     return render_template("messages/new.html", form=form)
 
 
-@app.get("/messages/<int:message_id>")
+@bp.get("/messages/<int:message_id>")
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    # breakpoint()
+    msg = snapshots.message(message_id)
+    if msg is None:
+        abort(404)
     return render_template("messages/show.html", message=msg)
 
 
-@app.post("/messages/<int:message_id>/delete")
+@bp.get("/messages/<int:message_id>/likes")
+def message_likers(message_id):
+    """Show who likes a message, a page at a time."""
+
+    msg = Message.query.get_or_404(message_id)
+    page = request.args.get("page", 1, type=int)
+    if page < 1:
+        abort(404)  # as paginate() does
+    likers = (
+        msg.likers_query().limit(LIKERS_PER_PAGE).offset((page - 1) * LIKERS_PER_PAGE)
+    )
+
+    # The page count comes from the stored like count, not a COUNT query.
+    likers = Pagination(None, page, LIKERS_PER_PAGE, msg.like_count, likers.all())
+    following_ids = (
+        g.user.following_ids_among([u.id for u in likers.items]) if g.user else set()
+    )
+
+    return render_template(
+        "messages/likes.html",
+        message=msg,
+        likers=likers,
+        following_ids=following_ids,
+    )
+
+
+@bp.post("/messages/<int:message_id>/delete")
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -352,7 +667,7 @@ def messages_destroy(message_id):
 # ~~ Homepage and error pages
 
 
-@app.get("/")
+@bp.get("/")
 def homepage():
     """Show homepage:
 
@@ -361,28 +676,64 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following]
-        messages = (
-            Message.query.filter(
-                or_(Message.user_id.in_(following_ids), Message.user_id == g.user.id)
-            )
-            .order_by(Message.timestamp.desc())
-            .limit(100)
-            .all()
-        )
+        following_ids = recommendations.following_ids(g.user.id)
+        messages = timeline.home([*following_ids, g.user.id], 100)
 
-        return render_template("home.html", messages=messages)
+        suggestions = recommendations.recommended_users(g.user.id)
+
+        return render_template(
+            "home.html",
+            messages=messages,
+            liked_ids=liked_ids_for(messages),
+            suggestions=suggestions,
+        )
 
     else:
         return render_template("home-anon.html")
 
 
+@bp.get("/trending")
+def show_trending():
+    """Show the most-liked recent warbles and the most-used hashtags."""
+
+    messages = trending.trending_messages()
+
+    return render_template(
+        "trending.html",
+        messages=messages,
+        liked_ids=liked_ids_for(messages),
+        hashtags=trending.trending_hashtags(),
+    )
+
+
+@bp.get("/notifications")
+def show_notifications():
+    """Show the user's notifications, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    unread = notifications.unread_count(g.user.id)
+    g.unread_notifications = 0
+    # Render before marking them read, so the new ones still stand out.
+    page = render_template(
+        "notifications.html", notifications=notifications.inbox(g.user.id)
+    )
+
+    if unread:
+        notifications.mark_read(g.user.id)
+        db.session.commit()
+
+    return page
+
+
 ##############################################################################
 # ~~ Message Like routes:
 
 # TODO: add check against current user liking own warbles, update template to
 # not show likes to self
-@app.post("/msg/like/<int:msg_id>")
+@bp.post("/msg/like/<int:msg_id>")
 def like_message(msg_id):
     """Show liked messages and update the database"""
 
@@ -392,15 +743,27 @@ def like_message(msg_id):
 
     if g.csrf_checking.validate_on_submit():
 
-        msg = Message.query.get(msg_id)
-        # breakpoint()
-        if msg not in g.user.messages:
-            print(msg)
-            print(g.user.liked_messages)
-            g.user.liked_messages.append(msg)
-            print(g.user.liked_messages)
+        msg = Message.query.get_or_404(msg_id)
 
-            db.session.commit()
+        if msg.user_id != g.user.id:
+            user_id = g.user.id
+
+            def like():
+                created_at = Likes.add(user_id, msg_id)
+                if created_at is not None:
+                    Message.add_likes([msg_id])
+                    # A Core insert, so flush can't see it.
+                    events.emit(
+                        db.session,
+                        "like.created",
+                        user_id=user_id,
+                        message_id=msg_id,
+                        created_at=created_at.isoformat(),
+                    )
+                return created_at
+
+            if retry_on_conflict(like) is not None:
+                logger.debug("Liked message", extra={"message_id": msg_id})
 
             return redirect("/")  # FIXME: figure out better way to refresh page
 
@@ -411,7 +774,7 @@ def like_message(msg_id):
         return redirect("/")
 
 
-@app.post("/msg/stop-liking/<int:msg_id>")
+@bp.post("/msg/stop-liking/<int:msg_id>")
 def stop_liking_message(msg_id):
     """Stop liking a liked message and update the DB"""
 
@@ -421,12 +784,22 @@ def stop_liking_message(msg_id):
 
     if g.csrf_checking.validate_on_submit():
 
-        msg_liked = Message.query.get(msg_id)
-
-        g.user.liked_messages.remove(msg_liked)
+        liked = Likes.query.filter_by(user_id=g.user.id, message_being_liked_id=msg_id)
+        created_at = liked.with_entities(Likes.created_at).scalar()
+        removed = liked.delete()
+        if removed:
+            Message.add_likes([msg_id], -1)
+            # A bulk delete, so flush can't see it.
+            events.emit(
+                db.session,
+                "like.deleted",
+                user_id=g.user.id,
+                message_id=msg_id,
+                created_at=created_at and created_at.isoformat(),
+            )
         db.session.commit()
 
-        return redirect(request.referrer)
+        return redirect(request.referrer or url_for("warbler.homepage"))
     else:
         return redirect("/")
 
@@ -439,10 +812,14 @@ def stop_liking_message(msg_id):
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 
-@app.after_request
+@bp.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Responses that set their own max-age (proxied images) keep it.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
     return response
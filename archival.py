@@ -0,0 +1,175 @@
+"""Moving old messages out of the hot ``messages`` table.
+
+Timelines and profiles only ever show recent warbles, but ``messages`` keeps
+growing. ``archive_messages()`` moves messages older than
+``MESSAGE_ARCHIVE_DAYS`` into ``messages_archive``, a batch at a time, so
+``messages`` (and its indexes) stay the size of the recent past. Run it
+periodically with ``flask archive-messages``.
+
+On PostgreSQL ``messages_archive`` is range-partitioned by month;
+``ensure_partitions()`` creates each month's partition before rows land in
+it, and old months can later be detached or moved to cheaper storage
+without touching the rest. SQLite has no partitioning, so there it is one
+ordinary table and everything else works the same.
+
+An archived message's likes move with it, into ``likes_archive``; its
+``like_count`` comes along too. Archived messages can still be viewed at
+/messages/<id>, and are included (with their likes) in exports and message
+counts, but can't be liked or deleted. Their likes no longer show on likes
+pages, nor in the like counts beside them (``User.count_likes()``).
+
+Their notifications are deleted, not archived: the inbox only shows recent
+activity, and likes of a warble that old have long scrolled out of it. As
+with any deleted notification, an unread one leaves the unread count high
+until the inbox is next read (see notifications.py).
+
+Limitations: only ``messages_archive`` is partitioned. ``messages`` can't
+be, since PostgreSQL requires a partitioned table's primary key to include
+the partition column and ``likes`` (and ``message_trends``) reference
+``messages.id`` alone; nor is ``likes_archive``. Those stay ordinary tables
+that only get smaller or grow.
+"""
+
+from datetime import datetime, timedelta
+
+import click
+
+import events
+from models import db, LikeArchive, Likes, Message, MessageArchive, Notification
+
+DEFAULT_ARCHIVE_DAYS = 365
+ARCHIVE_BATCH = 1000
+
+
+def month_start(at):
+    return at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def ensure_partitions(start, end):
+    """Create the monthly archive partitions covering `start`..`end`.
+
+    Does nothing on databases without partitioning.
+    """
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    month = month_start(start)
+    while month <= end:
+        following = next_month(month)
+        db.session.execute(
+            db.text(
+                f"CREATE TABLE IF NOT EXISTS "
+                f"messages_archive_{month:%Y_%m} PARTITION OF messages_archive "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+            )
+        )
+        month = following
+
+
+def archive_batch(before, batch_size=ARCHIVE_BATCH):
+    """Move up to `batch_size` of the oldest messages before `before`.
+
+    Returns how many were moved, with their likes. Doesn't commit.
+    """
+
+    rows = (
+        db.session.query(
+            Message.id,
+            Message.text,
+            Message.timestamp,
+            Message.user_id,
+            Message.like_count,
+        )
+        .filter(Message.timestamp < before)
+        .order_by(Message.timestamp, Message.id)
+        .limit(batch_size)
+        .all()
+    )
+    if not rows:
+        return 0
+
+    ids = [row.id for row in rows]
+
+    ensure_partitions(rows[0].timestamp, rows[-1].timestamp)
+    db.session.bulk_insert_mappings(
+        MessageArchive,
+        [
+            dict(
+                id=row.id,
+                text=row.text,
+                timestamp=row.timestamp,
+                user_id=row.user_id,
+                like_count=row.like_count,
+            )
+            for row in rows
+        ],
+    )
+    # Copy the likes before deleting them with the messages.
+    timestamps = {row.id: row.timestamp for row in rows}
+    likes = db.session.query(
+        Likes.user_id, Likes.message_being_liked_id, Likes.created_at
+    ).filter(Likes.message_being_liked_id.in_(ids))
+    db.session.bulk_insert_mappings(
+        LikeArchive,
+        [
+            dict(
+                user_id=user_id,
+                message_id=message_id,
+                message_timestamp=timestamps[message_id],
+                created_at=created_at,
+            )
+            for user_id, message_id, created_at in likes
+        ],
+    )
+    # Not left to the foreign keys: with sharding, rows on other shards
+    # don't cascade.
+    Likes.query.filter(Likes.message_being_liked_id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    Notification.query.filter(Notification.message_id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    for row in rows:
+        events.emit(db.session, "message.archived", id=row.id, user_id=row.user_id)
+
+    return len(rows)
+
+
+def archive_messages(before, batch_size=ARCHIVE_BATCH):
+    """Archive every message older than `before`, committing per batch.
+
+    Each batch is its own short transaction, so archiving a large backlog
+    never holds locks on much of ``messages`` at once.
+    """
+
+    total = 0
+    while True:
+        moved = archive_batch(before, batch_size)
+        db.session.commit()
+        if not moved:
+            return total
+        total += moved
+
+
+def init_app(app):
+    """Add the ``archive-messages`` command to `app`."""
+
+    @app.cli.command("archive-messages")
+    @click.option(
+        "--days",
+        type=int,
+        default=None,
+        help="Archive messages older than this many days.",
+    )
+    def archive_messages_command(days):
+        """Move old messages into the archive table."""
+
+        days = days or app.config.get("MESSAGE_ARCHIVE_DAYS") or DEFAULT_ARCHIVE_DAYS
+        before = datetime.utcnow() - timedelta(days=days)
+        click.echo(f"Archived {archive_messages(before)} messages older than {before}")
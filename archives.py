@@ -0,0 +1,458 @@
+"""Export and import of user archives.
+
+An archive is gzipped NDJSON: one JSON object per line, each with a
+``type``. The first line describes the account ("user"); then come the
+user's "message" (archived ones first), "like" and "follow" rows::
+
+    {"type": "user", "version": 2, "username": "...", ...}
+    {"type": "message", "id": 12, "text": "...", "timestamp": "..."}
+    {"type": "like", "author": "...", "timestamp": "...", "created_at": "..."}
+    {"type": "follow", "username": "...", "created_at": "..."}
+
+Likes and follows name what they point at by natural key -- a user by
+username, a message by its author's username and its timestamp -- rather
+than by ids, which mean nothing outside the exporting database.
+
+Exports run as ``archive_requested`` jobs. Rows are read through
+``yield_per()`` and written straight into the gzip stream, so memory use
+doesn't depend on the size of the account. The finished archive is moved
+into ``ARCHIVE_DIR``, where the download view serves it from disk. The web
+and worker processes must share that directory, so there's no default:
+without it, exports are off.
+
+``import_archive()`` (and the ``flask import-archive`` command) loads an
+archive into an existing account in batches of ``bulk_insert_mappings``,
+committing each batch, so neither the transaction nor the events it queues
+grow with the archive. Messages become new messages owned by that account. Likes and follows are
+imported where the users and messages they name exist here (and they
+aren't already there). The bulk inserts bypass the session's flush, so the
+importer emits the ``message.created``, ``like.created`` and
+``follow.created`` events itself; caches, notifications and the other
+consumers see imported rows like any others.
+"""
+
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import current_app
+
+import events
+import jobs
+from models import (
+    db,
+    Follows,
+    LikeArchive,
+    Likes,
+    Message,
+    MessageArchive,
+    User,
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 2
+EXPORT_BATCH = 1000
+IMPORT_BATCH = 1000
+
+
+def enabled():
+    """Can archives be exported: is ``ARCHIVE_DIR`` set?"""
+
+    return bool(current_app.config.get("ARCHIVE_DIR"))
+
+
+def archive_path(user_id):
+    """Where `user_id`'s latest export lives."""
+
+    return os.path.join(current_app.config["ARCHIVE_DIR"], f"user-{user_id}.ndjson.gz")
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def _usernames(user_ids):
+    rows = db.session.query(User.id, User.username).filter(User.id.in_(user_ids))
+    return dict(rows)
+
+
+def archive_rows(user):
+    """Yield `user`'s archive as dicts, one per line."""
+
+    yield {
+        "type": "user",
+        "version": ARCHIVE_VERSION,
+        "exported_at": datetime.utcnow().isoformat(),
+        "username": user.username,
+        "email": user.email,
+        "bio": user.bio,
+        "location": user.location,
+        "image_url": user.image_url,
+        "header_image_url": user.header_image_url,
+    }
+
+    for model in (MessageArchive, Message):
+        messages = (
+            db.session.query(model.id, model.text, model.timestamp)
+            .filter(model.user_id == user.id)
+            .order_by(model.id)
+            .yield_per(EXPORT_BATCH)
+        )
+        for message_id, text, timestamp in messages:
+            yield {
+                "type": "message",
+                "id": message_id,
+                "text": text,
+                "timestamp": timestamp.isoformat(),
+            }
+
+    # Looked up a batch at a time rather than joined, since with sharding
+    # the liked messages and followed users can live on other shards.
+    like_sources = (
+        (Likes, Likes.message_being_liked_id, Message),
+        (LikeArchive, LikeArchive.message_id, MessageArchive),
+    )
+    for like_model, liked_id, model in like_sources:
+        likes = (
+            db.session.query(liked_id, like_model.created_at)
+            .filter(like_model.user_id == user.id)
+            .order_by(liked_id)
+            .yield_per(EXPORT_BATCH)
+        )
+        for chunk in _chunks(likes, EXPORT_BATCH):
+            messages = {
+                row.id: row
+                for row in db.session.query(
+                    model.id, model.user_id, model.timestamp
+                ).filter(model.id.in_([message_id for message_id, _ in chunk]))
+            }
+            authors = _usernames({msg.user_id for msg in messages.values()})
+            for message_id, created_at in chunk:
+                msg = messages.get(message_id)
+                if msg is not None and msg.user_id in authors:
+                    yield {
+                        "type": "like",
+                        "author": authors[msg.user_id],
+                        "timestamp": msg.timestamp.isoformat(),
+                        "created_at": created_at.isoformat(),
+                    }
+
+    follows = (
+        db.session.query(Follows.user_being_followed_id, Follows.created_at)
+        .filter(Follows.user_following_id == user.id)
+        .order_by(Follows.created_at)
+        .yield_per(EXPORT_BATCH)
+    )
+    for chunk in _chunks(follows, EXPORT_BATCH):
+        usernames = _usernames([followed_id for followed_id, _ in chunk])
+        for followed_id, created_at in chunk:
+            if followed_id in usernames:
+                yield {
+                    "type": "follow",
+                    "username": usernames[followed_id],
+                    "created_at": created_at.isoformat(),
+                }
+
+
+def write_archive(user, fileobj):
+    """Write `user`'s archive to the binary file `fileobj`.
+
+    Returns the number of lines written.
+    """
+
+    lines = 0
+
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as gz:
+        out = io.TextIOWrapper(gz, encoding="utf-8")
+        for row in archive_rows(user):
+            out.write(json.dumps(row, separators=(",", ":")))
+            out.write("\n")
+            lines += 1
+        out.flush()
+        out.detach()
+
+    return lines
+
+
+def export_user(user):
+    """Write `user`'s archive to `archive_path()`, replacing any old one."""
+
+    path = archive_path(user.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write next to the final path and rename, so a download never sees a
+    # half-written archive.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_archive(user, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return path
+
+
+def read_archive(fileobj):
+    """Yield the rows of the gzipped NDJSON archive in `fileobj`."""
+
+    with gzip.open(fileobj, mode="rt", encoding="utf-8") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _existing(column, filter_by, ids):
+    """Which of `ids` are values of `column` (in rows matching `filter_by`)."""
+
+    if not ids:
+        return set()
+
+    rows = db.session.query(column).filter(*filter_by, column.in_(ids))
+    return {value for (value,) in rows}
+
+
+def _user_ids(usernames):
+    """Map those of `usernames` that exist here to their ids."""
+
+    if not usernames:
+        return {}
+
+    rows = db.session.query(User.username, User.id).filter(User.username.in_(usernames))
+    return dict(rows)
+
+
+class _Importer:
+    """Buffers archive rows and writes them a batch at a time."""
+
+    def __init__(self, user, batch_size):
+        self.user = user
+        self.batch_size = batch_size
+        self.messages = []
+        self.likes = []
+        self.follows = []
+        self.counts = {"message": 0, "like": 0, "follow": 0}
+
+    def add(self, row):
+        kind = row.get("type")
+
+        if kind == "message":
+            self.messages.append(
+                dict(
+                    text=row["text"],
+                    timestamp=datetime.fromisoformat(row["timestamp"]),
+                    user_id=self.user.id,
+                )
+            )
+            if len(self.messages) >= self.batch_size:
+                self.flush_messages()
+
+        elif kind == "like":
+            self.likes.append(
+                (
+                    row["author"],
+                    datetime.fromisoformat(row["timestamp"]),
+                    datetime.fromisoformat(row["created_at"]),
+                )
+            )
+            if len(self.likes) >= self.batch_size:
+                self.flush_likes()
+
+        elif kind == "follow":
+            self.follows.append(
+                (row["username"], datetime.fromisoformat(row["created_at"]))
+            )
+            if len(self.follows) >= self.batch_size:
+                self.flush_follows()
+
+    def flush_messages(self):
+        # return_defaults fills in each mapping's id, for its event.
+        db.session.bulk_insert_mappings(Message, self.messages, return_defaults=True)
+        for msg in self.messages:
+            events.emit(
+                db.session,
+                "message.created",
+                id=msg["id"],
+                user_id=msg["user_id"],
+                timestamp=msg["timestamp"].isoformat(),
+            )
+        db.session.commit()
+        self.counts["message"] += len(self.messages)
+        self.messages = []
+
+    def flush_likes(self):
+        author_ids = _user_ids({author for author, _, _ in self.likes})
+        author_ids.pop(self.user.username, None)
+        if not author_ids:
+            self.likes = []
+            return
+
+        # Messages are found by author and timestamp.
+        candidates = db.session.query(
+            Message.id, Message.user_id, Message.timestamp
+        ).filter(
+            Message.user_id.in_(list(author_ids.values())),
+            Message.timestamp.in_({timestamp for _, timestamp, _ in self.likes}),
+        )
+        found = {(row.user_id, row.timestamp): row.id for row in candidates}
+
+        created = {}
+        for author, timestamp, created_at in self.likes:
+            message_id = found.get((author_ids.get(author), timestamp))
+            if message_id is not None:
+                created[message_id] = created_at
+        liked = _existing(
+            Likes.message_being_liked_id, [Likes.user_id == self.user.id], set(created)
+        )
+        new_ids = sorted(set(created) - liked)
+
+        db.session.bulk_insert_mappings(
+            Likes,
+            [
+                dict(
+                    user_id=self.user.id,
+                    message_being_liked_id=message_id,
+                    created_at=created[message_id],
+                )
+                for message_id in new_ids
+            ],
+        )
+        Message.add_likes(new_ids)
+        for message_id in new_ids:
+            events.emit(
+                db.session,
+                "like.created",
+                user_id=self.user.id,
+                message_id=message_id,
+                created_at=created[message_id].isoformat(),
+            )
+        db.session.commit()
+        self.counts["like"] += len(new_ids)
+        self.likes = []
+
+    def flush_follows(self):
+        created = dict(self.follows)
+        user_ids = _user_ids(set(created))
+        user_ids.pop(self.user.username, None)
+        following = _existing(
+            Follows.user_being_followed_id,
+            [Follows.user_following_id == self.user.id],
+            set(user_ids.values()),
+        )
+        new = sorted(
+            (user_id, username)
+            for username, user_id in user_ids.items()
+            if user_id not in following
+        )
+
+        db.session.bulk_insert_mappings(
+            Follows,
+            [
+                dict(
+                    user_following_id=self.user.id,
+                    user_being_followed_id=followed_id,
+                    created_at=created[username],
+                )
+                for followed_id, username in new
+            ],
+        )
+        for followed_id, _ in new:
+            events.emit(
+                db.session,
+                "follow.created",
+                follower_id=self.user.id,
+                followed_id=followed_id,
+            )
+        db.session.commit()
+        self.counts["follow"] += len(new)
+        self.follows = []
+
+    def flush(self):
+        self.flush_messages()
+        self.flush_likes()
+        self.flush_follows()
+
+
+def import_archive(user, fileobj, batch_size=IMPORT_BATCH):
+    """Load the archive in `fileobj` into `user`'s account.
+
+    Commits each batch. Returns how many messages, likes and follows were
+    added, by type. If it fails partway, the batches before stay imported; importing again skips
+    the likes and follows already there, but adds those messages twice.
+    """
+
+    importer = _Importer(user, batch_size)
+
+    rows = read_archive(fileobj)
+    header = next(rows, None)
+    if not header or header.get("type") != "user":
+        raise ValueError("Not a Warbler archive: missing the user line")
+    if header.get("version") != ARCHIVE_VERSION:
+        raise ValueError(f"Unsupported archive version {header.get('version')!r}")
+
+    for row in rows:
+        importer.add(row)
+    importer.flush()
+
+    return importer.counts
+
+
+@jobs.handler("archive_requested")
+def on_archive_requested(user_id):
+    if not enabled():
+        logger.warning("ARCHIVE_DIR isn't set; not exporting user %s", user_id)
+        return
+
+    user = User.query.get(user_id)
+
+    if user is not None:
+        export_user(user)
+
+
+@events.consumer("user.deleted", durable=True)
+def on_users_deleted(batch):
+    """Don't keep a deleted user's archive around."""
+
+    if not enabled():
+        return
+
+    for kind, data in batch:
+        try:
+            os.unlink(archive_path(data["id"]))
+        except FileNotFoundError:
+            pass
+
+
+def init_app(app):
+    """Add the ``import-archive`` command to `app`."""
+
+    if not app.config.get("ARCHIVE_DIR"):
+        logger.info("ARCHIVE_DIR isn't set; archive exports are off")
+
+    @app.cli.command("import-archive")
+    @click.argument("username")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    def import_archive_command(username, path):
+        """Import the archive at PATH into USERNAME's account."""
+
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f"No user named {username!r}")
+
+        with open(path, "rb") as f:
+            counts = import_archive(user, f)
+
+        click.echo(
+            f"Imported {counts['message']} messages, {counts['like']} likes "
+            f"and {counts['follow']} follows into @{username}"
+        )
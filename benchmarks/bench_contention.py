@@ -0,0 +1,120 @@
+"""Stress concurrent likes and follows of the same rows, and time them.
+
+    python benchmarks/bench_contention.py [--threads N] [--seconds S]
+
+    DATABASE_URL=postgresql:///warbler_bench \\
+        python benchmarks/bench_contention.py
+
+Fills a fresh database (a temporary SQLite file unless DATABASE_URL is set;
+its tables are dropped first) with one hot message, its author and a user
+per thread. Then every thread, through the real routes, likes and unlikes
+the hot message and follows and unfollows its author as fast as it can, and
+sometimes repeats a like or follow straight away, as a double-click would.
+Reports requests per second, how many requests failed, how many
+transactions were retried, and whether the message's like count still
+matches its likes.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/bench.db")
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    import models
+    from app import create_app, CURR_USER_KEY
+    from models import db, Likes, Message, User
+
+    app = create_app("testing")
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        author = User(username="author", email="author@bench.test", password="x")
+        fans = [
+            User(username=f"fan{i}", email=f"fan{i}@bench.test", password="x")
+            for i in range(args.threads)
+        ]
+        db.session.add_all([author, *fans])
+        db.session.flush()
+        msg = Message(text="hot", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        author_id, msg_id = author.id, msg.id
+        fan_ids = [fan.id for fan in fans]
+
+    retries = Counter()
+    is_retryable = models.is_retryable
+
+    def counting(error):
+        retryable = is_retryable(error)
+        retries[retryable] += 1
+        return retryable
+
+    models.is_retryable = counting
+
+    statuses = Counter()
+    deadline = time.monotonic() + args.seconds
+    start = threading.Barrier(args.threads)
+
+    def hammer(fan_id):
+        rng = random.Random(fan_id)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fan_id
+
+        start.wait()
+        while time.monotonic() < deadline:
+            paths = [
+                f"/msg/like/{msg_id}",
+                f"/msg/stop-liking/{msg_id}",
+                f"/users/follow/{author_id}",
+                f"/users/stop-following/{author_id}",
+            ]
+            for path in paths:
+                for _ in range(2 if rng.random() < 0.2 else 1):
+                    resp = client.post(path, headers={"Referer": "/"})
+                    statuses[resp.status_code] += 1
+
+    threads = [threading.Thread(target=hammer, args=(i,)) for i in fan_ids]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    with app.app_context():
+        like_count = Message.query.get(msg_id).like_count
+        likes = Likes.query.filter_by(message_being_liked_id=msg_id).count()
+
+    total = sum(statuses.values())
+    print(f"{args.threads} threads, {elapsed:.1f}s, {db.engine.dialect.name}")
+    print(f"requests:  {total:,} ({total / elapsed:,.0f}/s)")
+    print(f"failed:    {total - statuses[302]:,}")
+    print(f"retried:   {retries[True]:,} (other errors: {retries[False]:,})")
+    print(f"like_count {like_count} vs {likes} likes: ", end="")
+    print("consistent" if like_count == likes else "DRIFTED")
+
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Benchmark the in-memory follow graph (graph.py).
+
+    python benchmarks/bench_graph.py [--users N] [--edges N]
+
+Reports build time, bytes per edge for the CSR arrays (compared with the
+same adjacency held as Python sets), and per-call latency of the hot
+lookups.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_recommendations import generate_graph  # noqa: E402
+from graph import FollowGraph  # noqa: E402
+
+
+def edges_of(offsets, targets):
+    for source in range(len(offsets) - 1):
+        for i in range(offsets[source], offsets[source + 1]):
+            yield source, targets[i]
+
+
+def per_call_us(fn, args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for a in args:
+            fn(*a)
+        best = min(best, time.perf_counter() - started)
+    return best / len(args) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--edges", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    offsets, targets = generate_graph(args.users, args.edges)
+    num_edges = len(targets)
+
+    graph = FollowGraph()
+    started = time.perf_counter()
+    graph.load(edges_of(offsets, targets))
+    print(
+        f"load: {num_edges:,} edges, {args.users:,} users "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+    nbytes = graph.nbytes()
+    print(f"CSR arrays: {nbytes / 2**20:.1f}MB, {nbytes / num_edges:.1f} bytes/edge")
+
+    tracemalloc.start()
+    as_sets = [set(targets[offsets[u] : offsets[u + 1]]) for u in range(args.users)]
+    set_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del as_sets
+    print(
+        f"same graph as list of sets (one direction): "
+        f"{set_bytes / 2**20:.1f}MB, {set_bytes / num_edges:.1f} bytes/edge"
+    )
+
+    rng = random.Random(2)
+    pairs = [
+        (rng.randrange(args.users), rng.randrange(args.users)) for _ in range(100_000)
+    ]
+    users = [(u,) for u, _ in pairs]
+
+    print(f"is_following:     {per_call_us(graph.is_following, pairs):.2f}us")
+    print(f"count_followers:  {per_call_us(graph.count_followers, users):.2f}us")
+    print(f"following:        {per_call_us(graph.following, users):.2f}us")
+    print(
+        f"common_following: "
+        f"{per_call_us(graph.common_following, pairs[:10_000]):.2f}us"
+    )
+
+    for follower, followed in pairs[:1000]:
+        graph.add(follower, followed)
+    print(
+        f"is_following with 1k local deltas: "
+        f"{per_call_us(graph.is_following, pairs):.2f}us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Benchmark what recording metrics costs on the hot path.
+
+    python benchmarks/bench_metrics.py [--calls N] [--threads N]
+
+Times, in nanoseconds per call, a labelled `Counter.inc` and a
+`Histogram.observe` from one thread and from `--threads` threads at once
+(they share each metric's lock), and a snapshot of every metric as a
+worker flush or scrape takes it. Then times a whole request, and one
+database query, against a small in-memory SQLite database in an app with
+metrics and one without, best of interleaved rounds.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+import metrics  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, User  # noqa: E402
+
+
+def per_call_ns(fn, calls, threads=1):
+    start = threading.Barrier(threads + 1)
+
+    def run():
+        start.wait()
+        for _ in range(calls):
+            fn()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - started) / (calls * threads) * 1e9
+
+
+def per_request_us(client, path, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        client.get(path)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200_000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    registry = metrics.Registry()
+    counter = metrics.Counter("c_total", "", ["endpoint"], registry=registry)
+    histogram = metrics.Histogram("h_seconds", "", ["endpoint"], registry=registry)
+    inc = lambda: counter.inc("warbler.homepage")  # noqa: E731
+    observe = lambda: histogram.observe(0.042, "warbler.homepage")  # noqa: E731
+
+    print(f"{'operation':<28} {'1 thread ns':>12} {f'{args.threads} threads ns':>13}")
+    for name, fn in (("Counter.inc", inc), ("Histogram.observe", observe)):
+        alone = per_call_ns(fn, args.calls)
+        shared = per_call_ns(fn, args.calls // args.threads, args.threads)
+        print(f"{name:<28} {alone:>12.0f} {shared:>13.0f}")
+
+    # Every app metric, with values for a few dozen endpoints.
+    for number in range(40):
+        metrics.http_requests.inc(f"endpoint{number}", "GET", "200")
+        metrics.http_request_seconds.observe(0.01, f"endpoint{number}")
+    snapshots = max(args.calls // 1000, 10)
+    snapshot_us = per_call_ns(metrics.default_registry.snapshot, snapshots) / 1000
+    print(f"{'snapshot, all metrics':<28} {snapshot_us:>10.0f}us")
+
+    # The setting is read when an app is created.
+    apps = {}
+    for enabled in (False, True):
+        os.environ["METRICS_ENABLED"] = "1" if enabled else "0"
+        apps[enabled] = create_app("testing")
+
+    timings = {enabled: {"request": [], "query": []} for enabled in apps}
+    clients = {}
+    for enabled, app in apps.items():
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username="u", email="u@bench.test", password="x"))
+            db.session.commit()
+        clients[enabled] = app.test_client()
+
+    for _ in range(args.rounds):
+        for enabled, app in apps.items():
+            calls = args.requests // args.rounds
+            timings[enabled]["request"].append(
+                per_request_us(clients[enabled], "/login", calls)
+            )
+            with app.app_context():
+                engine = db.get_engine(app)
+                with engine.connect() as conn:
+                    query = lambda: conn.exec_driver_sql("SELECT 1")  # noqa: E731
+                    timings[enabled]["query"].append(
+                        per_call_ns(query, calls * 10) / 1000
+                    )
+
+    print(f"\n{'':<28} {'off us':>10} {'on us':>10}")
+    for name in ("request", "query"):
+        off, on = min(timings[False][name]), min(timings[True][name])
+        print(
+            f"{'GET /login' if name == 'request' else 'SELECT 1':<28} "
+            f"{off:>10.1f} {on:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark the Python-side cost of the hottest queries, before and after.
+
+    python benchmarks/bench_queries.py [--calls N]
+
+Runs each of the per-request queries -- the logged-in user by id, a user by
+username (logging in), and the home timeline -- the way the code used to
+build them (a fresh ORM ``Query`` each time) and the way it does now
+(``Session.get`` and cached lambda statements), against a small in-memory
+SQLite database. The database work is the same both ways and tiny, so the
+difference is what SQLAlchemy spends in Python building, caching and
+compiling the statement and loading the rows.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+from app import create_app  # noqa: E402
+from models import _user_by_username, db, Message, User  # noqa: E402
+
+
+def fill():
+    users = [
+        User(username=f"user{i}", email=f"{i}@bench.test", password="x")
+        for i in range(50)
+    ]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all(
+        Message(text="warble", user_id=user.id) for user in users for _ in range(5)
+    )
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def per_call(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+        db.session.expunge_all()  # each request starts with an empty session
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def compare(before, after, calls, rounds):
+    """Best-of-`rounds` microseconds per call of each, rounds interleaved."""
+
+    before(), after()  # warm the statement caches
+    timings = ([], [])
+    for _ in range(rounds):
+        for fn, times in zip((before, after), timings):
+            times.append(per_call(fn, calls // rounds))
+    return min(timings[0]), min(timings[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    app = create_app("testing")
+    with app.app_context():
+        db.create_all()
+        ids = fill()
+        following = ids[:20]
+
+        cases = {
+            "user by id": (
+                lambda: User.query.get(ids[7]),
+                lambda: db.session.get(User, ids[7]),
+            ),
+            "user by username": (
+                lambda: User.query.filter_by(username="user7").first(),
+                lambda: db.session.execute(_user_by_username("user7"))
+                .scalars()
+                .first(),
+            ),
+            "home timeline": (
+                lambda: Message.query.filter(Message.user_id.in_(following))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(100)
+                .all(),
+                lambda: Message.timeline(following, 100),
+            ),
+        }
+
+        print(f"{'query':<18} {'before us':>10} {'after us':>10}")
+        for name, (before, after) in cases.items():
+            before_us, after_us = compare(before, after, args.calls, args.rounds)
+            print(f"{name:<18} {before_us:>10.1f} {after_us:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
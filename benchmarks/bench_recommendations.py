@@ -0,0 +1,94 @@
+"""Benchmark friends-of-friends scoring on a generated follow graph.
+
+    python benchmarks/bench_recommendations.py [--users N] [--edges N]
+
+Builds a graph with a heavy-tailed in-degree (a few accounts are followed by
+a large share of users, like real celebrities), then times
+`recommendations.friends_of_friends` for a sample of users, including the
+highest-degree ones, where sampling bounds matter most.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommendations import friends_of_friends  # noqa: E402
+
+
+def generate_graph(num_users, num_edges, seed=0):
+    """Return (offsets, targets): a CSR adjacency list of who follows whom."""
+
+    rng = random.Random(seed)
+
+    # Zipf-ish popularity: user i is picked with weight 1 / (i + 1).
+    weights = [1.0 / (i + 1) for i in range(num_users)]
+    follows = [set() for _ in range(num_users)]
+    total = 0
+
+    # Popular accounts get picked repeatedly; keep drawing until the graph
+    # has num_edges distinct follows.
+    while total < num_edges:
+        popular = rng.choices(range(num_users), weights=weights, k=num_edges - total)
+        for followed in popular:
+            follower = follows[rng.randrange(num_users)]
+            if followed not in follower:
+                follower.add(followed)
+                total += 1
+
+    offsets = array("i", [0])
+    targets = array("i")
+    for user_id, followed in enumerate(follows):
+        followed.discard(user_id)
+        targets.extend(sorted(followed))
+        offsets.append(len(targets))
+
+    return offsets, targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--edges", type=int, default=1_000_000)
+    parser.add_argument("--samples", type=int, default=500)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    offsets, targets = generate_graph(args.users, args.edges)
+    print(
+        f"graph: {args.users:,} users, {len(targets):,} edges "
+        f"(built in {time.perf_counter() - started:.1f}s)"
+    )
+
+    def get_following(user_id):
+        return targets[offsets[user_id] : offsets[user_id + 1]]
+
+    by_out_degree = sorted(range(args.users), key=lambda u: offsets[u + 1] - offsets[u])
+    rng = random.Random(1)
+    cohorts = {
+        "random users": rng.sample(range(args.users), args.samples),
+        "top out-degree": by_out_degree[-args.samples :],
+    }
+
+    for name, user_ids in cohorts.items():
+        timings = []
+        for user_id in user_ids:
+            started = time.perf_counter()
+            friends_of_friends(user_id, get_following)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        timings.sort()
+        print(
+            f"{name:>15}: p50 {statistics.median(timings):.2f}ms  "
+            f"p99 {timings[int(len(timings) * 0.99) - 1]:.2f}ms  "
+            f"max {timings[-1]:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Measure what server-side sessions and lazy CSRF forms save per request.
+
+    DATABASE_URL=sqlite:////tmp/warbler_bench.db SECRET_KEY=x \\
+        python benchmarks/bench_sessions.py
+
+Compares Flask's cookie sessions with the server-side interface (bytes of
+cookie sent by the browser and set by the server), and times a GET that
+renders no form with and without building `g.csrf_checking` eagerly.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import g  # noqa: E402
+from flask.sessions import SecureCookieSessionInterface  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from forms import CSRFProtectForm  # noqa: E402
+from models import db, User  # noqa: E402
+from sessions import MemoryStore, ServerSideSessionInterface  # noqa: E402
+
+REQUESTS = 500
+
+
+def per_request_ms(client, path):
+    started = time.process_time()
+    for _ in range(REQUESTS):
+        client.get(path)
+    return (time.process_time() - started) / REQUESTS * 1000
+
+
+def cookie_bytes(interface, user_id):
+    app.session_interface = interface
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+        sess["_flashes"] = [("success", "Hello, benchmark_user!")]
+        sess["csrf_token"] = "x" * 40
+
+    cookie = next(iter(client.cookie_jar))
+    return len(cookie.name) + len(cookie.value) + 1
+
+
+def main():
+    app.config["WTF_CSRF_ENABLED"] = True
+    db.create_all()
+
+    user = User.query.filter_by(username="benchmark_user").first()
+    if user is None:
+        user = User.signup("benchmark_user", "bench@test.com", "password", None)
+        db.session.commit()
+
+    cookie = cookie_bytes(SecureCookieSessionInterface(), user.id)
+    server = cookie_bytes(ServerSideSessionInterface(MemoryStore()), user.id)
+    print(f"Cookie header, cookie sessions:      {cookie} bytes")
+    print(f"Cookie header, server-side sessions: {server} bytes")
+
+    app.session_interface = ServerSideSessionInterface(MemoryStore())
+    client = app.test_client()
+
+    lazy = per_request_ms(client, "/users")
+
+    def eager_csrf():
+        g.csrf_checking = CSRFProtectForm()
+
+    app.before_request(eager_csrf)
+    eager = per_request_ms(client, "/users")
+
+    print(f"GET /users CPU, eager CSRF form: {eager:.3f}ms")
+    print(f"GET /users CPU, lazy CSRF form:  {lazy:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
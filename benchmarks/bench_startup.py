@@ -0,0 +1,72 @@
+"""Benchmark Warbler start-up: imports, app creation and the first request.
+
+    DATABASE_URL=sqlite:////tmp/warbler_bench.db SECRET_KEY=x \\
+        python benchmarks/bench_startup.py [--runs N]
+
+Each run is a fresh interpreter, so the numbers are what a newly forked
+(non-preloaded) worker pays. Compare the "production" and "development"
+rows to see what the dev-only extensions cost.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app as warbler
+imported = time.perf_counter()
+application = warbler.create_app(sys.argv[1])
+created = time.perf_counter()
+application.test_client().get("/")
+first_request = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "create_app": created - imported,
+    "first_request": first_request - created,
+    "modules": len(sys.modules),
+}))
+"""
+
+
+def run_probe(config_name):
+    # Production refuses to rate limit without Redis (see ratelimit.py).
+    env = {"RATELIMIT_ENABLED": "0", **os.environ}
+    out = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", PROBE, config_name],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(
+        f"{'config':<12} {'import ms':>10} {'create ms':>10} "
+        f"{'1st req ms':>11} {'modules':>8}"
+    )
+    for config_name in ("production", "development"):
+        runs = [run_probe(config_name) for _ in range(args.runs)]
+        median = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+        print(
+            f"{config_name:<12} {median['import'] * 1000:>10.1f} "
+            f"{median['create_app'] * 1000:>10.1f} "
+            f"{median['first_request'] * 1000:>11.1f} {median['modules']:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
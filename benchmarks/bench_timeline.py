@@ -0,0 +1,136 @@
+"""Benchmark the merged home timeline against the SQL one.
+
+    python benchmarks/bench_timeline.py [--authors N] [--per-author N]
+
+    DATABASE_URL=postgresql:///warbler_bench \\
+        python benchmarks/bench_timeline.py
+
+Fills a fresh database (a temporary SQLite file unless DATABASE_URL is set;
+its tables are dropped first) with `--authors` users and `--per-author`
+messages each, then for follow sets of 10 to 50,000 authors times
+`Message.timeline` (one SQL query) against `timeline.home` with the cache
+cold and warm, checking they return the same messages. The cache is the
+in-process store, so warm numbers leave out Redis round trips.
+
+SQLite can't bind more than 32,766 parameters, so the SQL path has no number
+there for the biggest follow sets.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FOLLOW_COUNTS = (10, 100, 1_000, 10_000, 50_000)
+LIMIT = 100
+
+
+def fill(db, Message, User, authors, per_author, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2021, 1, 1)
+
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            dict(id=i, username=f"u{i}", email=f"u{i}@bench.test", password="x")
+            for i in range(1, authors + 1)
+        ],
+    )
+    db.session.execute(
+        Message.__table__.insert(),
+        [
+            dict(
+                user_id=i,
+                text="warble",
+                timestamp=start + timedelta(seconds=rng.randrange(90 * 86400)),
+                like_count=0,
+            )
+            for i in range(1, authors + 1)
+            for _ in range(per_author)
+        ],
+    )
+    db.session.commit()
+
+
+def timed(fn, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--authors", type=int, default=max(FOLLOW_COUNTS))
+    parser.add_argument("--per-author", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/bench.db")
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    from sqlalchemy.exc import OperationalError
+
+    import timeline
+    from app import create_app
+    from cache import cache
+    from models import db, Message, User
+    from sessions import MemoryStore
+
+    app = create_app("testing")
+    app.config["TIMELINE_FANIN"] = True
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        started = time.perf_counter()
+        fill(db, Message, User, args.authors, args.per_author)
+        print(
+            f"{args.authors:,} authors, {args.authors * args.per_author:,} "
+            f"messages (filled in {time.perf_counter() - started:.1f}s)"
+        )
+        print(f"{'follows':>8} {'sql ms':>10} {'cold ms':>10} {'warm ms':>10}")
+
+        rng = random.Random(1)
+        for follows in FOLLOW_COUNTS:
+            if follows > args.authors:
+                break
+            user_ids = rng.sample(range(1, args.authors + 1), follows)
+
+            try:
+                sql_ms, expected = timed(
+                    lambda: Message.timeline(user_ids, LIMIT), args.runs
+                )
+                expected = [msg.id for msg in expected]
+            except OperationalError:
+                db.session.rollback()
+                sql_ms, expected = None, None
+
+            def cold():
+                # Standing in for Redis, without the round trips.
+                cache.configure(MemoryStore(), shared=True)
+                return timeline.home(user_ids, LIMIT)
+
+            cold_ms, _ = timed(cold, args.runs)
+            warm_ms, merged = timed(lambda: timeline.home(user_ids, LIMIT), args.runs)
+
+            if expected is not None and [msg.id for msg in merged] != expected:
+                sys.exit(f"{follows} follows: merged timeline differs from SQL")
+
+            sql = "n/a" if sql_ms is None else f"{sql_ms:.1f}"
+            print(f"{follows:>8,} {sql:>10} {cold_ms:>10.1f} {warm_ms:>10.1f}")
+
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
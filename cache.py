@@ -0,0 +1,474 @@
+"""A two-tier read-through cache for hot, viewer-independent reads.
+
+``cache.get_or_load(key, loader, ttl, tags)`` looks in two places before
+calling ``loader()``:
+
+1. a small LRU dict in this process (``L1_SIZE`` entries, each trusted for
+   at most ``L1_TTL`` seconds), then
+2. a shared store with Redis' commands -- Redis itself when
+   ``CACHE_REDIS_URL`` (or ``SESSION_REDIS_URL``) is set. Without one the
+   cache is off: an in-process store (``CACHE_BACKEND=memory``, for a
+   single process) would miss other workers' invalidations.
+
+Values must be JSON-serialisable; they are stored in the shared tier as
+JSON along with how long they took to load and the versions of their tags.
+
+Stampedes are headed off three ways:
+
+* Concurrent misses for one key in a process wait for a single load, and
+  across processes a short lock in the shared store lets one process load
+  while the others wait briefly for its result.
+* Entries are refreshed early with probability rising as expiry nears,
+  scaled by how long the value takes to load ("XFetch", Vattani et al.),
+  so a popular key is usually reloaded by one request before it expires
+  rather than by all of them just after.
+* While one request refreshes early, the others keep serving the old value.
+
+Invalidation is by tag. Every entry records the version of each of its tags
+when it was loaded; ``invalidate(tag)`` gives the tag a new version in the
+shared store, which makes every entry carrying it stale in every process
+(and drops those entries from this process's L1 at once; other processes'
+L1 copies live at most ``L1_TTL`` longer). Callers invalidate from event
+consumers (see events.py), so it happens once the write has committed.
+Versions are random tokens that expire after ``TAG_TTL``, so a tag that
+expired or was evicted never comes back with a version an entry recorded:
+its entries just go stale.
+
+``stats`` counts hits, misses, early refreshes and coalesced waits per key
+family (the part of the key before the first ":").
+"""
+
+import json
+import logging
+import math
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask import abort, jsonify
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+L1_SIZE = 1024
+L1_TTL = 5
+BETA = 1.0
+LOCK_TTL = 10
+LOCK_WAIT = 0.5
+LOCK_POLL = 0.02
+TAG_TTL = 24 * 60 * 60
+
+# Deletes a load lock only if it's still ours: once LOCK_TTL has passed it
+# may belong to another process.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# The most keys an in-process store holds before evicting the oldest.
+MEMORY_MAX_KEYS = 50_000
+
+
+class FamilyStats:
+    """Counters for one key family."""
+
+    __slots__ = ("l1_hits", "l2_hits", "misses", "early_refreshes", "coalesced")
+
+    def __init__(self):
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.early_refreshes = 0
+        self.coalesced = 0
+
+    @property
+    def hit_rate(self):
+        hits = self.l1_hits + self.l2_hits
+        total = hits + self.misses + self.early_refreshes
+        return hits / total if total else 0.0
+
+    def as_dict(self):
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats["hit_rate"] = round(self.hit_rate, 3)
+        return stats
+
+
+class Cache:
+    """Per-process LRU in front of a shared Redis-like store."""
+
+    key_prefix = "cache:"
+    tag_prefix = "cache-tag:"
+    lock_prefix = "cache-lock:"
+
+    def __init__(self, store=None, l1_size=L1_SIZE, l1_ttl=L1_TTL, beta=BETA):
+        self.store = store
+        self.enabled = store is not None
+        # Whether every process sees the same store (Redis), so that an
+        # invalidation in one reaches them all.
+        self.shared = False
+        self.l1_size = l1_size
+        self.l1_ttl = l1_ttl
+        self.beta = beta
+        self.stats = defaultdict(FamilyStats)
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._release = self._release_script(store)
+
+    def configure(self, store, shared=False):
+        self.store = store
+        self.enabled = True
+        self.shared = shared
+        self._release = self._release_script(store)
+        self.stats.clear()
+        self.clear_local()
+
+    def clear_local(self):
+        with self._lock:
+            self._l1.clear()
+
+    # ~~ L1
+
+    def _l1_get(self, key):
+        with self._lock:
+            return self._l1_entry(key, time.monotonic())
+
+    def _l1_entry(self, key, now):
+        entry = self._l1.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._l1[key]
+            return None
+        self._l1.move_to_end(key)
+        return entry
+
+    def _l1_put(self, key, value, tags, ttl):
+        self._l1_put_many([(key, value, tags)], ttl)
+
+    def _l1_put_many(self, items, ttl):
+        expires = time.monotonic() + min(ttl, self.l1_ttl)
+        with self._lock:
+            # Only the last l1_size would survive the eviction anyway.
+            for key, value, tags in items[-self.l1_size :]:
+                self._l1[key] = (value, expires, frozenset(tags))
+                self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+
+    # ~~ L2
+
+    def _tag_versions(self, tags):
+        """The version of each of `tags`, starting any that have none."""
+
+        if not tags:
+            return {}
+        keys = [self.tag_prefix + tag for tag in tags]
+        versions = dict(zip(tags, self.store.mget(keys)))
+        for tag, version in versions.items():
+            if version is None:
+                key = self.tag_prefix + tag
+                version = secrets.token_hex(8)
+                if not self.store.set(key, version, ex=TAG_TTL, nx=True):
+                    version = self.store.get(key)
+            versions[tag] = version.decode() if isinstance(version, bytes) else version
+        return versions
+
+    def _l2_get(self, key, tags):
+        raw = self.store.get(self.key_prefix + key)
+        if raw is None:
+            return None
+
+        record = json.loads(raw)
+        if record["tags"] != self._tag_versions(tags):
+            return None
+        return record
+
+    def _should_refresh_early(self, record):
+        # XFetch: refresh when now - delta * beta * ln(rand) >= expiry.
+        # ln(rand) is negative, so this fires increasingly often as expiry
+        # nears, and earlier for values that are slow to load.
+        jitter = -record["delta"] * self.beta * math.log(1.0 - random.random())
+        return time.time() + jitter >= record["expires"]
+
+    # ~~ Loading
+
+    @staticmethod
+    def _release_script(store):
+        if store is None or not hasattr(store, "register_script"):
+            return None
+        return store.register_script(RELEASE_SCRIPT)
+
+    def _unlock(self, lock_key, token):
+        """Drop the load lock at `lock_key` if it still holds `token`."""
+
+        try:
+            if self._release is not None:
+                self._release(keys=[lock_key], args=[token])
+            else:
+                self.store.delete_if(lock_key, token)
+        except Exception:
+            # It expires after LOCK_TTL anyway.
+            logger.warning("Couldn't release cache lock %s", lock_key, exc_info=True)
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._loading.get(key)
+            if lock is None:
+                lock = self._loading[key] = threading.Lock()
+            return lock
+
+    def _wait_for_other_process(self, key, tags):
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL)
+            record = self._l2_get(key, tags)
+            if record is not None:
+                return record
+        return None
+
+    def _load(self, key, loader, ttl, tags, stats):
+        versions = self._tag_versions(tags)
+        started = time.monotonic()
+        value = loader()
+        delta = time.monotonic() - started
+
+        record = {
+            "value": value,
+            "expires": time.time() + ttl,
+            "delta": delta,
+            "tags": versions,
+        }
+        self.store.setex(self.key_prefix + key, ttl, json.dumps(record))
+        self._l1_put(key, value, tags, ttl)
+        return value
+
+    def get_or_load(self, key, loader, ttl, tags=()):
+        """The cached value for `key`, calling `loader()` to fill it if needed.
+
+        `tags` name what the value depends on, for `invalidate()`.
+        """
+
+        if not self.enabled:
+            return loader()
+
+        tags = sorted(tags)
+        stats = self.stats[key.split(":", 1)[0]]
+
+        entry = self._l1_get(key)
+        if entry is not None:
+            stats.l1_hits += 1
+            return entry[0]
+
+        try:
+            record = self._l2_get(key, tags)
+        except Exception:
+            logger.warning("Cache store unavailable; loading %s", key, exc_info=True)
+            return loader()
+
+        if record is not None and not self._should_refresh_early(record):
+            stats.l2_hits += 1
+            self._l1_put(key, record["value"], tags, record["expires"] - time.time())
+            return record["value"]
+
+        lock = self._key_lock(key)
+        if record is not None and lock.locked():
+            # Someone in this process is already refreshing it early.
+            stats.l2_hits += 1
+            return record["value"]
+
+        with lock:
+            entry = self._l1_get(key)
+            if entry is not None:
+                stats.coalesced += 1
+                return entry[0]
+
+            lock_key = self.lock_prefix + key
+            token = secrets.token_hex(8)
+            try:
+                locked = self.store.set(lock_key, token, ex=LOCK_TTL, nx=True)
+                if not locked:
+                    if record is not None:
+                        stats.l2_hits += 1
+                        return record["value"]
+
+                    # Another process is loading it; give it a moment.
+                    record = self._wait_for_other_process(key, tags)
+                    if record is not None:
+                        stats.coalesced += 1
+                        self._l1_put(key, record["value"], tags, LOCK_TTL)
+                        return record["value"]
+            except Exception:
+                logger.warning(
+                    "Cache store unavailable; loading %s", key, exc_info=True
+                )
+                return loader()
+
+            if record is None:
+                stats.misses += 1
+            else:
+                stats.early_refreshes += 1
+
+            try:
+                return self._load(key, loader, ttl, tags, stats)
+            finally:
+                # Past the wait, the other process's lock isn't ours to drop.
+                if locked:
+                    self._unlock(lock_key, token)
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def get_many_or_load(self, keys, loader, ttl, tags=None):
+        """Cached values for many `keys`, as a dict of key -> value.
+
+        `loader(missing)` returns a dict with a value for each of the keys
+        that weren't cached, which are then stored. `tags(key)` names the
+        tags of each key. The shared store is read with one ``MGET``, so
+        there is no early refresh or cross-process load coalescing here;
+        it's for many small values that are cheap to load in bulk.
+        """
+
+        if not self.enabled:
+            return loader(list(keys))
+
+        found = {}
+        wanted = []
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                entry = self._l1_entry(key, now)
+                if entry is None:
+                    wanted.append(key)
+                else:
+                    found[key] = entry[0]
+        self._count_many(found, "l1_hits")
+        if not wanted:
+            return found
+
+        key_tags = {key: sorted(tags(key)) if tags else [] for key in wanted}
+        try:
+            raws = self.store.mget([self.key_prefix + key for key in wanted])
+            versions = self._tag_versions(sorted(set().union(*key_tags.values())))
+        except Exception:
+            logger.warning("Cache store unavailable; loading %d keys", len(wanted))
+            return dict(found, **loader(wanted))
+
+        hits = {}
+        missing = []
+        for key, raw in zip(wanted, raws):
+            record = raw and json.loads(raw)
+            current = {tag: versions[tag] for tag in key_tags[key]}
+            if record and record["tags"] == current:
+                hits[key] = record["value"]
+            else:
+                missing.append(key)
+        self._l1_put_many([(k, v, key_tags[k]) for k, v in hits.items()], ttl)
+        self._count_many(hits, "l2_hits")
+        found.update(hits)
+        if not missing:
+            return found
+
+        started = time.monotonic()
+        loaded = loader(missing)
+        delta = (time.monotonic() - started) / len(missing)
+
+        expires = time.time() + ttl
+        pipeline = self.store.pipeline() if hasattr(self.store, "pipeline") else None
+        for key in missing:
+            record = {
+                "value": loaded[key],
+                "expires": expires,
+                "delta": delta,
+                "tags": {tag: versions[tag] for tag in key_tags[key]},
+            }
+            (pipeline or self.store).setex(
+                self.key_prefix + key, ttl, json.dumps(record)
+            )
+        if pipeline is not None:
+            pipeline.execute()
+        self._l1_put_many([(k, loaded[k], key_tags[k]) for k in missing], ttl)
+        self._count_many(missing, "misses")
+
+        found.update(loaded)
+        return found
+
+    def _count_many(self, keys, counter):
+        families = defaultdict(int)
+        for key in keys:
+            families[key.split(":", 1)[0]] += 1
+        for family, count in families.items():
+            stats = self.stats[family]
+            setattr(stats, counter, getattr(stats, counter) + count)
+
+    # ~~ Invalidation
+
+    def invalidate(self, *tags):
+        """Make every entry carrying any of `tags` stale, everywhere."""
+
+        if not self.enabled or not tags:
+            return
+
+        tags = set(tags)
+        # One round trip to Redis however many tags there are.
+        pipeline = self.store.pipeline() if hasattr(self.store, "pipeline") else None
+        for tag in tags:
+            (pipeline or self.store).set(
+                self.tag_prefix + tag, secrets.token_hex(8), ex=TAG_TTL
+            )
+        if pipeline is not None:
+            pipeline.execute()
+
+        with self._lock:
+            for key in [k for k, entry in self._l1.items() if entry[2] & tags]:
+                del self._l1[key]
+
+    def report(self):
+        """Per-family stats, as a dict."""
+
+        return {family: stats.as_dict() for family, stats in self.stats.items()}
+
+
+cache = Cache()
+
+
+def init_app(app):
+    """Point `cache` at the store ``CACHE_BACKEND`` names.
+
+    "redis" (needs the optional ``redis`` package), "memory", or "off".
+    Defaults to "redis" when ``CACHE_REDIS_URL`` is set and "off"
+    otherwise; "memory" is refused where ``SHARED_STORES_REQUIRED``. With
+    ``PROFILE_TOKEN`` set, ``GET /internal/cache`` reports this worker's
+    stats.
+    """
+
+    redis_url = app.config.get("CACHE_REDIS_URL")
+    backend = app.config.get("CACHE_BACKEND") or ("redis" if redis_url else "off")
+
+    if backend == "memory" and app.config.get("SHARED_STORES_REQUIRED"):
+        logger.warning("An in-process cache misses other workers' writes; it's off")
+        backend = "off"
+
+    if backend == "off":
+        cache.enabled = False
+    elif backend == "redis":
+        import redis
+
+        cache.configure(redis.Redis.from_url(redis_url), shared=True)
+    else:
+        from sessions import MemoryStore
+
+        cache.configure(MemoryStore(max_keys=MEMORY_MAX_KEYS))
+
+    if app.config.get("PROFILE_TOKEN"):
+
+        @app.get("/internal/cache")
+        def cache_stats():
+            """This worker's cache hits and misses per key family, as JSON."""
+
+            if not profiling.bearer_authorized(app):
+                abort(403)
+            return jsonify(enabled=cache.enabled, families=cache.report())
@@ -0,0 +1,190 @@
+"""Configuration for each Warbler environment.
+
+`create_app()` in app.py picks one of these by name ("development",
+"testing" or "production"), defaulting to the WARBLER_ENV environment
+variable. Settings that come from the environment are properties, so they
+are read when an app is created rather than when this module is imported.
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # Compiled SQL is cached per engine; the default 500 statements is
+    # tight once every page's queries and their eager loads are counted.
+    SQLALCHEMY_ENGINE_OPTIONS = {"query_cache_size": 1200}
+
+    IMAGE_PROXY_ENABLED = True
+    # Refuse per-process (in-memory) stores for state every worker must
+    # agree on, such as sessions.
+    SHARED_STORES_REQUIRED = False
+
+    # Dev-only extensions are imported and installed only when enabled.
+    DEBUG_TOOLBAR = False
+    LOAD_DOTENV = False
+
+    @property
+    def SQLALCHEMY_DATABASE_URI(self):
+        # fix incorrect database URIs currently returned by Heroku's pg setup
+        return os.environ["DATABASE_URL"].replace("postgres://", "postgresql://")
+
+    @property
+    def SHARD_DATABASE_URLS(self):
+        return os.environ.get("SHARD_DATABASE_URLS")
+
+    @property
+    def SECRET_KEY(self):
+        return os.environ["SECRET_KEY"]
+
+    @property
+    def SESSION_BACKEND(self):
+        return os.environ.get("SESSION_BACKEND")
+
+    @property
+    def SESSION_REDIS_URL(self):
+        return os.environ.get("SESSION_REDIS_URL")
+
+    @property
+    def RATELIMIT_ENABLED(self):
+        return os.environ.get("RATELIMIT_ENABLED", "1") != "0"
+
+    @property
+    def RATELIMIT_BACKEND(self):
+        return os.environ.get("RATELIMIT_BACKEND")
+
+    @property
+    def RATELIMIT_REDIS_URL(self):
+        return os.environ.get("RATELIMIT_REDIS_URL") or self.SESSION_REDIS_URL
+
+    @property
+    def RATELIMIT_TRUSTED_PROXIES(self):
+        return int(os.environ.get("RATELIMIT_TRUSTED_PROXIES", 0))
+
+    @property
+    def CACHE_BACKEND(self):
+        return os.environ.get("CACHE_BACKEND")
+
+    @property
+    def CACHE_REDIS_URL(self):
+        return os.environ.get("CACHE_REDIS_URL") or self.SESSION_REDIS_URL
+
+    @property
+    def TIMELINE_FANIN(self):
+        return bool(os.environ.get("TIMELINE_FANIN"))
+
+    @property
+    def IMAGE_CACHE_DIR(self):
+        return os.environ.get("IMAGE_CACHE_DIR")
+
+    @property
+    def IMAGE_CACHE_MAX_BYTES(self):
+        max_bytes = os.environ.get("IMAGE_CACHE_MAX_BYTES")
+        return int(max_bytes) if max_bytes else None
+
+    @property
+    def TEMPLATE_CACHE_DIR(self):
+        return os.environ.get("TEMPLATE_CACHE_DIR")
+
+    @property
+    def ARCHIVE_DIR(self):
+        return os.environ.get("ARCHIVE_DIR")
+
+    @property
+    def MESSAGE_ARCHIVE_DAYS(self):
+        days = os.environ.get("MESSAGE_ARCHIVE_DAYS")
+        return int(days) if days else None
+
+    @property
+    def PROFILE_TEMPLATES(self):
+        return bool(os.environ.get("PROFILE_TEMPLATES"))
+
+    @property
+    def PROFILE_TOKEN(self):
+        return os.environ.get("PROFILE_TOKEN")
+
+    @property
+    def PROFILE_SAMPLING(self):
+        return bool(os.environ.get("PROFILE_SAMPLING"))
+
+    @property
+    def PROFILE_DIR(self):
+        return os.environ.get("PROFILE_DIR")
+
+    @property
+    def METRICS_ENABLED(self):
+        return os.environ.get("METRICS_ENABLED", "1") != "0"
+
+    @property
+    def METRICS_DIR(self):
+        return os.environ.get("METRICS_DIR")
+
+    @property
+    def METRICS_TOKEN(self):
+        return os.environ.get("METRICS_TOKEN")
+
+    @property
+    def LOG_LEVEL(self):
+        return os.environ.get("LOG_LEVEL", "INFO")
+
+    @property
+    def LOG_FORMAT(self):
+        return os.environ.get("LOG_FORMAT", "json")
+
+
+class DevelopmentConfig(Config):
+    """Local development: .env file, debug toolbar, readable logs."""
+
+    LOAD_DOTENV = True
+    LOG_FORMAT = "text"
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    @property
+    def ARCHIVE_DIR(self):
+        # One machine, so the web and worker processes share /tmp.
+        return os.environ.get("ARCHIVE_DIR") or os.path.join(
+            tempfile.gettempdir(), "warbler-archives"
+        )
+
+    @property
+    def CACHE_BACKEND(self):
+        # Off unless asked for, even with a Redis URL, so edits made
+        # straight in the database show.
+        return os.environ.get("CACHE_BACKEND", "off")
+
+
+class TestingConfig(Config):
+    """The test suite."""
+
+    TESTING = True
+    SESSION_BACKEND = "memory"
+    CACHE_BACKEND = "off"
+    RATELIMIT_ENABLED = False
+
+
+class ProductionConfig(Config):
+    """Deployed app: nothing dev-only is imported.
+
+    Sessions, rate limits and the cache must be shared between workers, so
+    production needs Redis: set ``SESSION_REDIS_URL``, and optionally
+    ``RATELIMIT_REDIS_URL`` / ``CACHE_REDIS_URL`` to give those their own
+    instances (both fall back to ``SESSION_REDIS_URL``). Without Redis,
+    sessions fall back to signed cookies, the cache stays off, and rate
+    limits refuse to start unless ``RATELIMIT_ENABLED=0``.
+    """
+
+    SHARED_STORES_REQUIRED = True
+    # /metrics is public otherwise.
+    METRICS_TOKEN_REQUIRED = True
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
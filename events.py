@@ -0,0 +1,247 @@
+"""Domain events captured from model writes.
+
+Every flush turns the ``Message``, ``Likes``, ``Follows`` and ``User`` rows
+it inserts, updates or deletes into events such as ``message.created`` or
+``follow.deleted``, each with a small JSON-able ``data`` dict (see the
+``source`` registrations at the bottom). Follows made through
+``User.following``/``User.followers`` have no row object of their own, so
+those collections are watched too.
+
+Consumers subscribe to event kinds with ``@consumer(...)`` and get the
+transaction's events as one list, in order, only once it commits:
+
+* In-process consumers (the default) run right after the commit, in the
+  process that made it. They're for cheap, idempotent reactions such as
+  cache invalidation, and are lost if the process dies at that moment.
+* Durable consumers (``durable=True``) get their batch through the job
+  queue, which is this pipeline's outbox: an ``events`` job per consumer is
+  added in the same transaction as the writes, so it exists if and only if
+  they were committed, and the worker delivers it with the job queue's
+  retries. Delivery is at least once, and the worker may hand a consumer
+  several transactions' events in one batch.
+
+Writes that skip the session's flush -- bulk ``Query.update()``/
+``delete()``, ``bulk_insert_mappings`` and database cascades -- make no
+events. Code doing bulk writes that consumers care about calls ``emit()``;
+rows removed by a cascade (a deleted user's messages, likes and follows)
+are covered only by the ``user.deleted`` event.
+
+The overhead per flush is a pass over the session's changed objects, and
+one job row per durable consumer that has events in the transaction.
+"""
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import jobs
+from models import Follows, Job, Likes, Message, User
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple("Event", ["kind", "data"])
+
+SOURCES = {}
+COLLECTIONS = []
+CONSUMERS = {}
+
+
+class Consumer:
+    """A function subscribed to some event kinds."""
+
+    def __init__(self, fn, kinds, durable):
+        self.fn = fn
+        self.kinds = frozenset(kinds)
+        self.durable = durable
+        self.name = f"{fn.__module__}.{fn.__qualname__}"
+
+    def matching(self, events):
+        return [e for e in events if e.kind in self.kinds]
+
+
+def consumer(*kinds, durable=False):
+    """Subscribe the decorated function to `kinds` of event.
+
+    It's called with a list of `Event`s from one committed transaction.
+    Durable consumers run in the worker, inside the job's transaction, and
+    should not commit.
+    """
+
+    def decorator(fn):
+        c = Consumer(fn, kinds, durable)
+        CONSUMERS[c.name] = c
+        return fn
+
+    return decorator
+
+
+def source(model, name, fields):
+    """Make writes to `model` rows emit ``<name>.created`` etc. events.
+
+    `fields(obj)` returns the events' data.
+    """
+
+    SOURCES[model] = (name, fields)
+
+
+def collection(attr, name, fields):
+    """Emit ``<name>.created``/``.deleted`` for changes to relationship `attr`.
+
+    `fields(owner, item)` returns the events' data.
+    """
+
+    COLLECTIONS.append((attr.class_, attr.key, name, fields))
+
+
+def emit(session, kind, **data):
+    """Add an event to `session`'s transaction, for writes flush can't see."""
+
+    _pending(session).append(Event(kind, data))
+
+
+def _pending(session):
+    return session.info.setdefault("events", [])
+
+
+def _changes(session):
+    """Yield the events for the objects `session` is flushing."""
+
+    for obj in session.new:
+        if (found := SOURCES.get(type(obj))) is not None:
+            yield Event(f"{found[0]}.created", found[1](obj))
+
+    for obj in session.dirty:
+        found = SOURCES.get(type(obj))
+        # Only column changes are updates; collections are handled below.
+        if found and session.is_modified(obj, include_collections=False):
+            yield Event(f"{found[0]}.updated", found[1](obj))
+
+    for obj in session.deleted:
+        if (found := SOURCES.get(type(obj))) is not None:
+            yield Event(f"{found[0]}.deleted", found[1](obj))
+
+    for model, key, name, fields in COLLECTIONS:
+        for obj in (*session.new, *session.dirty):
+            if type(obj) is not model:
+                continue
+            history = inspect(obj).attrs[key].history
+            for item in history.added or ():
+                yield Event(f"{name}.created", fields(obj, item))
+            for item in history.deleted or ():
+                yield Event(f"{name}.deleted", fields(obj, item))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect(session, flush_context):
+    if SOURCES:
+        _pending(session).extend(_changes(session))
+
+
+@event.listens_for(Session, "before_commit")
+def _write_outbox(session):
+    # Flush first, so the events of the commit's own flush are included;
+    # the job rows added here go in the commit's final flush.
+    session.flush()
+
+    pending = session.info.get("events")
+    if not pending:
+        return
+
+    for c in CONSUMERS.values():
+        if c.durable and (matching := c.matching(pending)):
+            session.add(
+                Job(
+                    kind="events",
+                    payload={"consumer": c.name, "events": [list(e) for e in matching]},
+                )
+            )
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver(session):
+    pending = session.info.pop("events", None)
+    if not pending:
+        return
+
+    for c in CONSUMERS.values():
+        if not c.durable and (matching := c.matching(pending)):
+            try:
+                c.fn(matching)
+            except Exception:
+                logger.exception("Event consumer %s failed", c.name)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard(session, previous_transaction):
+    session.info.pop("events", None)
+
+
+@jobs.handler("events", batched=True)
+def deliver_durable(payloads):
+    """Run durable consumers on committed transactions' events.
+
+    The worker hands over a claimed batch's jobs at once; each consumer gets
+    all of its events from them as one list, in the order they were queued.
+    """
+
+    batches = {}
+    for payload in payloads:
+        batches.setdefault(payload["consumer"], []).extend(payload["events"])
+
+    for consumer, events in batches.items():
+        c = CONSUMERS.get(consumer)
+        if c is None:
+            logger.warning("No event consumer %s; dropping its events", consumer)
+            continue
+
+        c.fn([Event(kind, data) for kind, data in events])
+
+
+##############################################################################
+# ~~ Sources
+
+
+source(User, "user", lambda user: {"id": user.id})
+
+source(
+    Message,
+    "message",
+    lambda msg: {
+        "id": msg.id,
+        "user_id": msg.user_id,
+        "timestamp": msg.timestamp.isoformat(),
+    },
+)
+
+source(
+    Likes,
+    "like",
+    lambda like: {
+        "user_id": like.user_id,
+        "message_id": like.message_being_liked_id,
+        "created_at": like.created_at and like.created_at.isoformat(),
+    },
+)
+
+source(
+    Follows,
+    "follow",
+    lambda follow: {
+        "follower_id": follow.user_following_id,
+        "followed_id": follow.user_being_followed_id,
+    },
+)
+
+collection(
+    User.following,
+    "follow",
+    lambda user, other: {"follower_id": user.id, "followed_id": other.id},
+)
+
+collection(
+    User.followers,
+    "follow",
+    lambda user, other: {"follower_id": other.id, "followed_id": user.id},
+)
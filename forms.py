@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
+from wtforms import HiddenField, StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
 
@@ -27,6 +27,9 @@ class UserEditForm(FlaskForm):
     header_image_url = StringField("(Optional) Header Image URL")
     bio = TextAreaField("(Optional) Bio")
     password = PasswordField("Password", validators=[Length(min=6)])
+    # The user's version_id when the form was shown, to catch edits made
+    # from two places at once.
+    version_id = HiddenField()
 
 
 class LoginForm(FlaskForm):
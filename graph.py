@@ -0,0 +1,290 @@
+"""Process-local, compact copy of the follow graph.
+
+The ``follows`` table is loaded into two CSR ("compressed sparse row")
+adjacency structures -- one keyed by follower, one keyed by the followed
+user -- each made of two flat ``array('i')`` buffers:
+
+    offsets[u] .. offsets[u + 1]   slice of `targets` holding u's neighbours
+    targets                        neighbour ids, sorted within each row
+
+Rows are sorted, so ``is_following`` is a binary search (O(log d)), degrees
+are an offset subtraction, and intersections are a linear merge.
+
+Memory: every edge is stored once per direction as a 4-byte int, so 8 bytes
+per follow, plus 8 bytes per user id (one offset slot in each direction).
+Ids are used directly as row numbers, so deleted users still cost their
+slot. A million follows between 50k users takes 8.4 bytes per edge (8MB);
+the same graph as a list of Python sets takes ~100 bytes per edge for just
+one direction. ``benchmarks/bench_graph.py`` measures both.
+
+Only the worker holds a copy: the recommendation scorer (recommendations.py)
+reads it, and applies each batch of follow events to it (``add`` /
+``remove``) before scoring. Those go into small per-user delta sets that are
+consulted before the CSR arrays. Request handlers read the ``follows`` table
+instead, since a copy per web process would lag behind the other processes'
+writes.
+
+The scorer calls ``ensure_fresh()`` first, which resyncs from the database
+every ``RESYNC_SECONDS`` or once the deltas grow past ``MAX_DELTA`` edges.
+A resync builds fresh arrays and swaps them in, so readers never see a
+half-built graph, and replays onto them the changes recorded while the
+table was being read, which the read may have missed.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from models import db, Follows
+
+RESYNC_SECONDS = 300
+MAX_DELTA = 10_000
+
+
+def build_csr(edges):
+    """Build (offsets, targets) from (source, target) pairs sorted by both."""
+
+    offsets = array("i", [0])
+    targets = array("i")
+
+    for source, target in edges:
+        while len(offsets) <= source:
+            offsets.append(len(targets))
+        targets.append(target)
+
+    offsets.append(len(targets))
+    return offsets, targets
+
+
+def transpose_csr(offsets, targets):
+    """Reverse every edge of a CSR graph (a counting sort, O(V + E))."""
+
+    size = max(targets) + 1 if targets else 0
+    t_offsets = array("i", [0]) * (size + 1)
+
+    for target in targets:
+        t_offsets[target + 1] += 1
+    for i in range(size):
+        t_offsets[i + 1] += t_offsets[i]
+
+    t_targets = array("i", [0]) * len(targets)
+    cursor = array("i", t_offsets)
+
+    # Walking sources in order leaves every reversed row already sorted.
+    for source in range(len(offsets) - 1):
+        for i in range(offsets[source], offsets[source + 1]):
+            target = targets[i]
+            t_targets[cursor[target]] = source
+            cursor[target] += 1
+
+    return t_offsets, t_targets
+
+
+def intersect_sorted(left, right):
+    """Ids present in both sorted sequences, in order."""
+
+    common = []
+    i = j = 0
+
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            i += 1
+        elif left[i] > right[j]:
+            j += 1
+        else:
+            common.append(left[i])
+            i += 1
+            j += 1
+
+    return common
+
+
+class _Adjacency:
+    """One direction of the graph: CSR arrays plus local deltas."""
+
+    def __init__(self, offsets=None, targets=None):
+        self.offsets = offsets if offsets is not None else array("i", [0])
+        self.targets = targets if targets is not None else array("i")
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+
+    def _bounds(self, user_id):
+        if 0 <= user_id < len(self.offsets) - 1:
+            return self.offsets[user_id], self.offsets[user_id + 1]
+        return 0, 0
+
+    def _in_base(self, user_id, other_id):
+        lo, hi = self._bounds(user_id)
+        i = bisect_left(self.targets, other_id, lo, hi)
+        return i < hi and self.targets[i] == other_id
+
+    def contains(self, user_id, other_id):
+        if other_id in self.added.get(user_id, ()):
+            return True
+        if other_id in self.removed.get(user_id, ()):
+            return False
+        return self._in_base(user_id, other_id)
+
+    def degree(self, user_id):
+        lo, hi = self._bounds(user_id)
+        return (
+            hi
+            - lo
+            + len(self.added.get(user_id, ()))
+            - len(self.removed.get(user_id, ()))
+        )
+
+    def row(self, user_id):
+        lo, hi = self._bounds(user_id)
+        base = self.targets[lo:hi]
+        added = self.added.get(user_id)
+        removed = self.removed.get(user_id)
+
+        if not added and not removed:
+            return base
+        return sorted(set(base).union(added or ()).difference(removed or ()))
+
+    def add(self, user_id, other_id):
+        self.removed[user_id].discard(other_id)
+        if not self._in_base(user_id, other_id):
+            self.added[user_id].add(other_id)
+
+    def remove(self, user_id, other_id):
+        self.added[user_id].discard(other_id)
+        if self._in_base(user_id, other_id):
+            self.removed[user_id].add(other_id)
+
+    def delta_size(self):
+        return sum(map(len, self.added.values())) + sum(map(len, self.removed.values()))
+
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + self.targets.itemsize * len(
+            self.targets
+        )
+
+
+class FollowGraph:
+    """The follow graph, held in compact arrays. See the module docstring."""
+
+    def __init__(self):
+        self._following = None
+        self._followers = None
+        self._lock = threading.Lock()
+        # Changes recorded while `load` reads its edges, to replay.
+        self._pending = None
+        self.loaded_at = None
+
+    @property
+    def loaded(self):
+        return self._following is not None
+
+    def load(self, edges):
+        """Replace the graph with `edges`: (follower, followed) pairs sorted
+        by follower, then followed. Changes recorded while `edges` is read
+        are applied on top, since it may have been read before them."""
+
+        with self._lock:
+            self._pending = []
+        try:
+            offsets, targets = build_csr(edges)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        following = _Adjacency(offsets, targets)
+        followers = _Adjacency(*transpose_csr(offsets, targets))
+
+        with self._lock:
+            for change, follower_id, followed_id in self._pending or ():
+                getattr(following, change)(follower_id, followed_id)
+                getattr(followers, change)(followed_id, follower_id)
+            self._pending = None
+            self._following, self._followers = following, followers
+            self.loaded_at = time.monotonic()
+
+    def load_from_db(self):
+        """Resync the graph from the ``follows`` table."""
+
+        edges = (
+            db.session.query(Follows.user_following_id, Follows.user_being_followed_id)
+            .order_by(Follows.user_following_id, Follows.user_being_followed_id)
+            .yield_per(10_000)
+        )
+        self.load(edges)
+
+    def needs_resync(self):
+        if not self.loaded:
+            return True
+        if time.monotonic() - self.loaded_at >= RESYNC_SECONDS:
+            return True
+        return self._following.delta_size() >= MAX_DELTA
+
+    def ensure_fresh(self):
+        """Load or resync from the database if the graph is missing or stale."""
+
+        if self.needs_resync():
+            self.load_from_db()
+        return self
+
+    def add(self, follower_id, followed_id):
+        """Record a new follow. Ignored unless the graph is loaded or loading."""
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(("add", follower_id, followed_id))
+            if self.loaded:
+                self._following.add(follower_id, followed_id)
+                self._followers.add(followed_id, follower_id)
+
+    def remove(self, follower_id, followed_id):
+        """Record an unfollow. Ignored unless the graph is loaded or loading."""
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(("remove", follower_id, followed_id))
+            if self.loaded:
+                self._following.remove(follower_id, followed_id)
+                self._followers.remove(followed_id, follower_id)
+
+    def is_following(self, follower_id, followed_id):
+        return self._following.contains(follower_id, followed_id)
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        with self._lock:
+            return self._following.row(user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        with self._lock:
+            return self._followers.row(user_id)
+
+    def count_following(self, user_id):
+        return self._following.degree(user_id)
+
+    def count_followers(self, user_id):
+        return self._followers.degree(user_id)
+
+    def common_following(self, user_id, other_id):
+        """Users followed by both `user_id` and `other_id`."""
+
+        return intersect_sorted(self.following(user_id), self.following(other_id))
+
+    def followed_by_followers_of(self, user_id, other_id):
+        """Followers of `other_id` whom `user_id` follows ("followed by ...")."""
+
+        return intersect_sorted(self.following(user_id), self.followers(other_id))
+
+    def nbytes(self):
+        """Bytes held by the CSR arrays (excluding the small deltas)."""
+
+        if not self.loaded:
+            return 0
+        return self._following.nbytes() + self._followers.nbytes()
+
+
+follow_graph = FollowGraph()
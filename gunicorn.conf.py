@@ -0,0 +1,83 @@
+"""gunicorn settings for Warbler (read automatically by `gunicorn app:app`)."""
+
+import gc
+import os
+import shutil
+import tempfile
+
+import metrics
+import templating
+from models import db
+
+# Import the app once in the master and fork workers from it, so each worker
+# starts with the app -- and every compiled template -- already in memory.
+preload_app = True
+
+# On SIGTERM (a deploy or scale-down) stop accepting connections and give the
+# requests already in flight this long to finish before workers are killed.
+graceful_timeout = 30
+
+# Replace each worker after about this many requests, so slow memory growth
+# can't build up. The jitter staggers the restarts, so workers don't all go
+# at once and leave requests queued behind them; with the app preloaded, a
+# replacement is forked ready to serve.
+max_requests = 1000
+max_requests_jitter = 200
+
+
+def on_starting(server):
+    """Start the workers' shared metrics afresh (see metrics.py), in a
+    directory of this master's own unless ``METRICS_DIR`` names one."""
+
+    registry = metrics.default_registry
+    if registry.directory is None:
+        registry.directory = tempfile.mkdtemp(prefix="warbler-metrics-")
+        # For apps loaded in the workers, if preload_app is turned off.
+        os.environ["METRICS_DIR"] = registry.directory
+        server.own_metrics_dir = registry.directory
+    registry.clear_directory()
+
+
+def on_exit(server):
+    """Remove the metrics directory made by `on_starting`, if any."""
+
+    if getattr(server, "own_metrics_dir", None):
+        shutil.rmtree(server.own_metrics_dir, ignore_errors=True)
+
+
+def when_ready(server):
+    """Finish warming the app in the master, before any worker is forked."""
+
+    app = server.app.wsgi()
+    count = templating.precompile(app)
+    server.log.info("Precompiled %s templates", count)
+
+    # Move everything loaded so far into the permanent generation, so the
+    # garbage collector in each worker never writes to (and so copies) the
+    # memory pages shared with the master.
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Don't let workers share any database connection the master opened."""
+
+    with server.app.wsgi().app_context():
+        db.engine.dispose()
+
+
+def worker_exit(server, worker):
+    """Log where this worker spent its render time, if profiling was on,
+    and write out its metrics."""
+
+    if templating.profiler.templates:
+        server.log.info("Template render profile:\n%s", templating.profiler.report())
+
+    # Hand over the counts since the last flush before going.
+    metrics.default_registry.flush()
+
+
+def child_exit(server, worker):
+    """Fold a reaped worker's metrics into those of past workers."""
+
+    metrics.default_registry.mark_process_dead(worker.pid)
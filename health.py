@@ -0,0 +1,127 @@
+"""Liveness and readiness endpoints for load balancers and orchestrators.
+
+``GET /healthz`` and ``GET /readyz`` are answered by WSGI middleware in
+front of the Flask app, so a probe never reaches Flask: no ``before_request``
+hooks (loading the user, rate limiting), no session, no CSRF form and no
+template. Probing ``/`` instead costs a rendered page.
+
+* ``/healthz`` says the worker can answer requests at all, and nothing else:
+  a database outage shouldn't get every worker restarted.
+* ``/readyz`` also says whether this worker can get a database connection
+  and use it: a connection is checked out of the pool and sent ``SELECT 1``
+  (on every shard, if sharded). Waiting for a connection from an exhausted
+  pool counts against the ping, so a worker whose pool is used up reports
+  itself unready rather than queueing its probes behind real requests.
+
+The ping runs on its own thread and is given `PING_TIMEOUT` seconds; its
+result is reused for `READY_TTL` seconds, and concurrent probes share one
+ping, so however often the load balancer asks, each worker pings at most
+about once a `READY_TTL`.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from sqlalchemy import text
+
+import shards
+
+logger = logging.getLogger(__name__)
+
+READY_TTL = 2.0
+PING_TIMEOUT = 1.0
+
+HEADERS = [("Content-Type", "text/plain"), ("Cache-Control", "no-store")]
+
+
+class Readiness:
+    """The cached result of the last `ping()`."""
+
+    def __init__(self, ping, ttl=READY_TTL, timeout=PING_TIMEOUT):
+        self.ping = ping
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._checked = None
+        self._result = (False, "not checked")
+        self._pending = None
+        # Threads are only started once a ping is submitted, so this is
+        # safe to create before gunicorn forks.
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ready")
+
+    def check(self):
+        """(ready, reason), pinging if the last result is too old."""
+
+        with self._lock:
+            if self._checked is not None:
+                if time.monotonic() - self._checked < self.ttl:
+                    return self._result
+            # A ping that timed out may still be waiting; don't pile up more.
+            if self._pending is None or self._pending.done():
+                self._pending = self._pool.submit(self.ping)
+            pending = self._pending
+
+        try:
+            pending.result(timeout=self.timeout)
+            result = (True, "ready")
+        except TimeoutError:
+            result = (False, f"database ping took over {self.timeout}s")
+        except Exception as error:
+            logger.warning("Readiness ping failed", exc_info=True)
+            result = (False, f"database unavailable: {type(error).__name__}")
+
+        with self._lock:
+            self._result = result
+            self._checked = time.monotonic()
+        return result
+
+
+class HealthCheck:
+    """WSGI middleware answering ``/healthz`` and ``/readyz`` itself."""
+
+    def __init__(self, wsgi_app, readiness):
+        self.wsgi_app = wsgi_app
+        self.readiness = readiness
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO")
+        if path not in ("/healthz", "/readyz"):
+            return self.wsgi_app(environ, start_response)
+
+        if environ.get("REQUEST_METHOD") not in ("GET", "HEAD"):
+            start_response("405 METHOD NOT ALLOWED", [*HEADERS, ("Allow", "GET")])
+            return [b""]
+
+        if path == "/healthz":
+            ready, reason = True, "ok"
+        else:
+            ready, reason = self.readiness.check()
+
+        status = "200 OK" if ready else "503 SERVICE UNAVAILABLE"
+        start_response(status, HEADERS)
+        return [b"" if environ["REQUEST_METHOD"] == "HEAD" else reason.encode()]
+
+
+def ping_database(app, db):
+    """Run ``SELECT 1`` on a pooled connection to each of `app`'s databases."""
+
+    with app.app_context():
+        shard_router = shards.router()
+        engines = shard_router.engines.values() if shard_router else [db.engine]
+        for engine in engines:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+
+
+def init_app(app, db):
+    """Answer ``/healthz`` and ``/readyz`` in front of `app`.
+
+    Call after `db` (and any shards) are set up; later ``wsgi_app``
+    wrappers would see probes first.
+    """
+
+    readiness = Readiness(lambda: ping_database(app, db))
+    app.wsgi_app = HealthCheck(app.wsgi_app, readiness)
+    app.extensions["readiness"] = readiness
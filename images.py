@@ -0,0 +1,424 @@
+"""Proxying, resizing and caching of user images.
+
+Avatars and header images are arbitrary external URLs, and timelines used to
+embed them full size straight from third-party hosts. The ``image`` template
+filter rewrites such a URL to ``/img/<variant>/<token>``, where the token is
+the original URL signed with the app's secret key (so the proxy only ever
+fetches URLs the app itself rendered):
+
+    <img src="{{ user.image_url | image('avatar') }}">
+
+The first request for an image fetches it once, and every variant served
+from it -- scaled to fit the ``VARIANTS`` box, as WebP for browsers that
+accept it -- is stored in ``IMAGE_CACHE_DIR``. Files there are named by the
+hash of their content, so the same picture behind several URLs is stored
+once; small "ref" files map a URL and variant to its content. When the cache
+grows past ``IMAGE_CACHE_MAX_BYTES`` the least recently served files are
+evicted -- refs and failure markers (below) along with images, each counted
+at ``FILE_OVERHEAD`` more than its bytes, so they can't pile up either. Responses are cacheable by browsers for a year: a changed image URL
+is a different proxy URL.
+
+Resizing needs the optional Pillow package; without it the original image
+is cached and served as is. Local ``/static`` URLs are left alone, and the
+proxy refuses to fetch from private or loopback addresses unless
+``IMAGE_PROXY_ALLOW_PRIVATE`` is set (the tests' stand-in server needs it).
+Each host is resolved once, checked, and connected to at the address that
+passed the check, so a DNS answer that changes in between (rebinding) can't
+point the fetch somewhere else. A URL that fails to fetch is remembered for
+``FAILURE_TTL`` seconds, during which its page views redirect to the
+original without trying again.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+from flask import abort, redirect, request, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+
+logger = logging.getLogger(__name__)
+
+# Largest width and height of each variant, in pixels (about 2x the size
+# the CSS shows them at).
+VARIANTS = {
+    "thumb": (96, 96),
+    "avatar": (256, 256),
+    "header": (1200, 600),
+}
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "warbler-images")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# What a file costs on disk beyond its bytes, roughly: a partly used block,
+# an inode and a directory entry.
+FILE_OVERHEAD = 4096
+FETCH_TIMEOUT = 5
+FAILURE_TTL = 300
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+BROWSER_MAX_AGE = 365 * 24 * 3600
+
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_type(data):
+    """The image content type of `data`, from its magic bytes, or None."""
+
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class ImageCache:
+    """Content-addressed files on disk, evicted least recently used first."""
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def _ref_path(self, ref):
+        digest = hashlib.sha256(ref.encode()).hexdigest()
+        return os.path.join(self.root, "refs", digest[:2], digest)
+
+    def _write(self, path, data):
+        new = not os.path.exists(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if new:
+            self._grow(len(data) + FILE_OVERHEAD)
+
+    def get(self, ref):
+        """(content type, file path) stored under `ref`, or None."""
+
+        ref_path = self._ref_path(ref)
+        try:
+            with open(ref_path) as f:
+                content_type, digest = f.read().split()
+            path = self._blob_path(digest)
+            # The mtime is the "last used" time eviction goes by.
+            os.utime(path)
+            os.utime(ref_path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return content_type, path
+
+    def put(self, ref, content_type, data):
+        """Store `data` under `ref`. Returns the file path."""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+
+        if not os.path.exists(path):
+            self._write(path, data)
+
+        self._write(self._ref_path(ref), f"{content_type} {digest}".encode())
+        return path
+
+    def failed_recently(self, ref, ttl):
+        """Was `ref` marked failed less than `ttl` seconds ago?"""
+
+        try:
+            marked = os.path.getmtime(self._ref_path(f"failed:{ref}"))
+        except FileNotFoundError:
+            return False
+        return time.time() - marked < ttl
+
+    def mark_failed(self, ref):
+        self._write(self._ref_path(f"failed:{ref}"), b"")
+
+    def size(self):
+        """Bytes the cache takes on disk, roughly."""
+
+        return sum(_cost(stat) for _, stat in self._files())
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def _grow(self, nbytes):
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += nbytes
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target=None):
+        """Delete least recently used files until under `target` bytes.
+
+        The default target is 90% of the limit, so eviction doesn't run
+        again on the very next write. Refs to deleted files just miss, and
+        an image whose refs were deleted is never touched again, so it ages
+        out too.
+        """
+
+        if target is None:
+            target = self.max_bytes * 0.9
+
+        files = sorted(self._files(), key=lambda file: file[1].st_mtime)
+        size = sum(_cost(stat) for _, stat in files)
+
+        for path, stat in files:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= _cost(stat)
+
+        self._size = size
+
+
+def _cost(stat):
+    return stat.st_size + FILE_OVERHEAD
+
+
+def _check_host(url, allow_private):
+    """The address to fetch `url` from: one its host resolves to, if they
+    are all public. None with `allow_private`, to connect as usual."""
+
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url!r}")
+
+    if allow_private:
+        return None
+
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    addresses = [
+        info[4][0]
+        for info in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    ]
+    for address in addresses:
+        if not ipaddress.ip_address(address).is_global:
+            raise ValueError(f"Refusing to fetch from {address}")
+    return addresses[0]
+
+
+def _pinned(connection_class, address):
+    """`connection_class`, connecting to `address` whatever the host
+    resolves to. The host still goes in the Host header and TLS checks."""
+
+    def connection(host, **kwargs):
+        conn = connection_class(host, **kwargs)
+        conn._create_connection = lambda to, *args: socket.create_connection(
+            (address, to[1]), *args
+        )
+        return conn
+
+    return connection
+
+
+class _PinnedHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    """Open http(s) URLs at the address `_check_host` vouched for."""
+
+    def __init__(self, allow_private):
+        urllib.request.HTTPHandler.__init__(self)
+        urllib.request.HTTPSHandler.__init__(self)
+        self.allow_private = allow_private
+
+    def _open(self, connection_class, req, **kwargs):
+        address = _check_host(req.full_url, self.allow_private)
+        if address is not None:
+            connection_class = _pinned(connection_class, address)
+        return self.do_open(connection_class, req, **kwargs)
+
+    def http_open(self, req):
+        return self._open(http.client.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open(http.client.HTTPSConnection, req, context=self._context)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Apply the host check to every redirect, not just the first URL."""
+
+    def __init__(self, allow_private):
+        self.allow_private = allow_private
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_host(newurl, self.allow_private)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, allow_private=False):
+    """Download the image at `url`. Returns (content type, bytes)."""
+
+    _check_host(url, allow_private)
+
+    # No proxies from the environment: one would do its own DNS lookup.
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}),
+        _PinnedHandler(allow_private),
+        _CheckedRedirects(allow_private),
+    )
+    req = urllib.request.Request(url, headers={"User-Agent": "warbler-images"})
+    with opener.open(req, timeout=FETCH_TIMEOUT) as resp:
+        data = resp.read(MAX_IMAGE_BYTES + 1)
+
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Image at {url!r} is too large")
+
+    content_type = sniff_type(data)
+    if content_type is None:
+        raise ValueError(f"Not an image: {url!r}")
+
+    return content_type, data
+
+
+def resize(data, variant, webp):
+    """Scale `data` to fit `variant`; as WebP if `webp`.
+
+    Returns (content type, bytes), or None if Pillow isn't installed.
+    """
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail(VARIANTS[variant])
+        out = io.BytesIO()
+
+        if webp:
+            img.save(out, "WEBP", quality=80)
+            return "image/webp", out.getvalue()
+
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(out, "PNG", optimize=True)
+            return "image/png", out.getvalue()
+
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        return "image/jpeg", out.getvalue()
+
+
+class ImageProxy:
+    """Signs image URLs and serves cached variants of them."""
+
+    salt = "warbler-image"
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = ImageCache(
+            app.config.get("IMAGE_CACHE_DIR") or DEFAULT_CACHE_DIR,
+            app.config.get("IMAGE_CACHE_MAX_BYTES") or DEFAULT_MAX_BYTES,
+        )
+        self.allow_private = bool(app.config.get("IMAGE_PROXY_ALLOW_PRIVATE"))
+
+    def _serializer(self):
+        return URLSafeSerializer(self.app.secret_key, salt=self.salt)
+
+    def proxied(self, url, variant="avatar"):
+        """The proxy URL for `url`'s `variant`; local URLs are unchanged."""
+
+        if not url or not url.startswith(("http://", "https://")):
+            return url
+
+        token = self._serializer().dumps(url)
+        return url_for("serve_image", variant=variant, token=token)
+
+    def variant(self, url, variant, webp):
+        """(content type, path) of `url`'s `variant`, fetching if needed;
+        None if fetching it failed recently."""
+
+        ref = f"{variant}:{'webp' if webp else 'orig'}:{url}"
+        found = self.cache.get(ref)
+        if found:
+            return found
+
+        source = self.cache.get(f"src:{url}")
+        if source:
+            content_type, path = source
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            if self.cache.failed_recently(f"src:{url}", FAILURE_TTL):
+                return None
+            try:
+                content_type, data = fetch(url, self.allow_private)
+            except Exception:
+                self.cache.mark_failed(f"src:{url}")
+                raise
+            self.cache.put(f"src:{url}", content_type, data)
+
+        resized = resize(data, variant, webp)
+        if resized is not None:
+            content_type, data = resized
+
+        return content_type, self.cache.put(ref, content_type, data)
+
+    def serve(self, variant, token):
+        if variant not in VARIANTS:
+            abort(404)
+
+        try:
+            url = self._serializer().loads(token)
+        except BadSignature:
+            abort(404)
+
+        webp = "image/webp" in request.headers.get("Accept", "")
+
+        try:
+            found = self.variant(url, variant, webp)
+        except Exception:
+            logger.warning("Couldn't proxy image %s", url, exc_info=True)
+            found = None
+
+        if found is None:
+            # Fall back to the original: the page still shows the image.
+            return redirect(url)
+
+        content_type, path = found
+
+        response = send_file(path, mimetype=content_type, max_age=BROWSER_MAX_AGE)
+        response.cache_control.public = True
+        response.vary.add("Accept")
+        return response
+
+
+def init_app(app):
+    """Add the ``image`` template filter and the ``/img`` route to `app`.
+
+    With ``IMAGE_PROXY_ENABLED`` off the filter returns URLs unchanged.
+    """
+
+    if not app.config.get("IMAGE_PROXY_ENABLED", True):
+        app.add_template_filter(lambda url, variant="avatar": url, "image")
+        return
+
+    proxy = ImageProxy(app)
+    app.extensions["images"] = proxy
+    app.add_template_filter(proxy.proxied, "image")
+    app.add_url_rule(
+        "/img/<variant>/<token>", "serve_image", proxy.serve, methods=["GET"]
+    )
@@ -0,0 +1,264 @@
+"""Background job queue for Warbler.
+
+Jobs are rows in the ``jobs`` table. Request handlers call ``enqueue()``
+inside their own transaction, so a job exists if and only if the write that
+caused it was committed. ``worker.py`` claims due jobs in batches and runs
+the handler registered for each job's kind.
+
+Claiming uses ``SELECT ... FOR UPDATE SKIP LOCKED`` on PostgreSQL, so any
+number of workers can share the table. SQLite (used by the tests) has no row
+locks; SQLAlchemy drops the ``FOR UPDATE`` there, which is fine for the
+single worker a SQLite database can support.
+
+A claimed job is leased rather than marked as running: claiming pushes its
+``run_at`` into the future. A worker that dies mid-batch therefore can't
+strand work -- the job just becomes due again when the lease runs out.
+
+Handlers registered with ``batched=True`` get all the jobs of their kind in
+a claimed batch at once, in one transaction, so they can coalesce writes;
+if that fails, those jobs are run one at a time like any others.
+"""
+
+import logging
+import signal
+import time
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 5
+POLL_INTERVAL = 1.0
+STATS_INTERVAL = 60.0
+
+JOB_QUEUED = "queued"
+JOB_FAILED = "failed"
+
+HANDLERS = {}
+BATCHED = set()
+
+
+def handler(kind, batched=False):
+    """Register the decorated function as the handler for `kind` jobs.
+
+    The handler is called with the job's payload as keyword arguments and
+    runs inside the job's transaction; it should not commit. A `batched`
+    handler is called with a list of payloads instead, in claim order.
+    """
+
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        if batched:
+            BATCHED.add(kind)
+        else:
+            BATCHED.discard(kind)
+        return fn
+
+    return decorator
+
+
+def enqueue(kind, **payload):
+    """Add a `kind` job to the current session.
+
+    The job is committed along with whatever the caller commits next.
+    Raises ValueError if no handler is registered for `kind`: the worker
+    would only drop the job.
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler registered for {kind!r} jobs")
+
+    job = Job(kind=kind, payload=payload)
+    db.session.add(job)
+    return job
+
+
+class JobStats:
+    """Throughput counters for one worker process."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.batches = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def processed(self):
+        return self.succeeded + self.retried + self.failed
+
+    def throughput(self):
+        """Jobs processed per second of wall-clock time."""
+
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "batches": self.batches,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "jobs_per_second": round(self.throughput(), 2),
+        }
+
+
+stats = JobStats()
+
+
+def claim_batch(size=BATCH_SIZE):
+    """Lease up to `size` due jobs to this worker and return them."""
+
+    now = datetime.utcnow()
+
+    jobs = (
+        Job.query.filter(Job.status == JOB_QUEUED, Job.run_at <= now)
+        .order_by(Job.run_at, Job.id)
+        .limit(size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+    for job in jobs:
+        job.attempts += 1
+        job.run_at = now + timedelta(seconds=LEASE_SECONDS)
+
+    db.session.commit()
+    return jobs
+
+
+def run_job(job):
+    """Run one claimed job and record the outcome.
+
+    On success the job row is deleted in the same transaction as the
+    handler's writes. On failure the handler's writes are rolled back and
+    the job is rescheduled with exponential backoff, or marked failed once
+    it has used up its attempts.
+    """
+
+    fn = HANDLERS.get(job.kind)
+
+    try:
+        if fn is None:
+            logger.warning("No handler registered for %s; dropping it", job)
+        elif job.kind in BATCHED:
+            fn([job.payload])
+        else:
+            fn(**job.payload)
+        db.session.delete(job)
+        db.session.commit()
+        stats.succeeded += 1
+        return True
+
+    except Exception as exc:
+        db.session.rollback()
+        logger.exception("%s failed (attempt %s)", job, job.attempts)
+
+        job.last_error = f"{type(exc).__name__}: {exc}"
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = JOB_FAILED
+            stats.failed += 1
+        else:
+            backoff = 2**job.attempts
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+            stats.retried += 1
+        db.session.commit()
+        return False
+
+
+def run_together(kind, jobs):
+    """Run `jobs`, all of batched `kind`, in one transaction.
+
+    Returns False, having rolled back, if the handler failed.
+    """
+
+    try:
+        HANDLERS[kind]([job.payload for job in jobs])
+        for job in jobs:
+            db.session.delete(job)
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        logger.warning(
+            "Batch of %d %s jobs failed; running them one at a time",
+            len(jobs),
+            kind,
+            exc_info=True,
+        )
+        return False
+
+    stats.succeeded += len(jobs)
+    return True
+
+
+def run_batch(size=BATCH_SIZE):
+    """Claim and run one batch of jobs. Returns how many were claimed."""
+
+    jobs = claim_batch(size)
+    if not jobs:
+        return 0
+
+    started = time.monotonic()
+    batched = {}
+    for job in jobs:
+        if job.kind in BATCHED:
+            batched.setdefault(job.kind, []).append(job)
+
+    done = set()
+    for kind, group in batched.items():
+        if len(group) > 1 and run_together(kind, group):
+            done.update(group)
+
+    for job in jobs:
+        if job not in done:
+            run_job(job)
+    stats.batches += 1
+    stats.busy_seconds += time.monotonic() - started
+
+    return len(jobs)
+
+
+def run_pending(size=BATCH_SIZE):
+    """Run batches until no job is due. Handy in tests and shell sessions."""
+
+    total = 0
+    while True:
+        claimed = run_batch(size)
+        if not claimed:
+            return total
+        total += claimed
+
+
+def run_worker(batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+    """Process jobs until SIGTERM/SIGINT; call inside an app context."""
+
+    stopping = []
+
+    def stop(signum, frame):
+        logger.info("Received signal %s; finishing current batch", signum)
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_report = time.monotonic()
+
+    while not stopping:
+        claimed = run_batch(batch_size)
+
+        if time.monotonic() - last_report >= STATS_INTERVAL:
+            logger.info("Job stats: %s", stats.as_dict())
+            last_report = time.monotonic()
+
+        # A full batch means there is probably more waiting; don't sleep.
+        if claimed < batch_size:
+            time.sleep(poll_interval)
+
+    db.session.remove()
+    logger.info("Worker stopped. Job stats: %s", stats.as_dict())
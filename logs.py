@@ -0,0 +1,76 @@
+"""Logging setup for the web and worker processes.
+
+Everything logs through the standard ``logging`` module to stderr (never
+stdout), at the level set by ``LOG_LEVEL``. With ``LOG_FORMAT = "json"``
+(the default outside development) each record is one JSON object per line,
+so a log pipeline can filter and aggregate without parsing prose:
+
+    {"ts": "...", "level": "INFO", "logger": "jobs", "msg": "...",
+     "method": "POST", "path": "/msg/like/3", "endpoint": "...", "user_id": 7}
+
+Request fields are added to records logged while handling a request, and
+anything passed as ``extra={...}`` becomes a field of its own.
+"""
+
+import json
+import logging
+import sys
+from datetime import datetime
+
+from flask import g, has_request_context, request
+
+# Attributes every LogRecord has; anything else came from `extra`.
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+
+        if has_request_context():
+            entry["method"] = request.method
+            entry["path"] = request.path
+            entry["endpoint"] = request.endpoint
+            user = g.get("user")
+            if user is not None:
+                entry["user_id"] = user.id
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class _WarblerHandler(logging.StreamHandler):
+    """Marks the handler init_app installed, so it is installed only once."""
+
+
+def init_app(app):
+    """Send log records to stderr at ``LOG_LEVEL``, in ``LOG_FORMAT``."""
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _WarblerHandler):
+            root.removeHandler(handler)
+
+    handler = _WarblerHandler(sys.stderr)
+    if app.config.get("LOG_FORMAT") == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    root.addHandler(handler)
+    root.setLevel(app.config.get("LOG_LEVEL") or "INFO")
@@ -0,0 +1,599 @@
+"""Prometheus metrics for the web workers, served at ``GET /metrics``.
+
+Like ``/healthz``, ``/metrics`` is answered by WSGI middleware in front of
+the app, so scrapes run no ``before_request`` hooks and aren't counted as
+requests. With ``METRICS_TOKEN`` set it needs ``Authorization: Bearer
+<token>``; where ``METRICS_TOKEN_REQUIRED`` (production), scrapes are
+refused until one is set. ``METRICS_ENABLED`` (on by default) turns the
+whole thing off.
+
+What's measured:
+
+* requests per endpoint, method and status, and their latency per endpoint,
+  from the WSGI call to the last streamed byte;
+* database queries per operation (select, insert, ...) and their duration,
+  on every engine the app uses, and each engine's pool: connections checked
+  out, idle, and allowed;
+* the cache's hits, misses, early refreshes and coalesced loads per key
+  family (see cache.py), from which dashboards work out hit rates;
+* password hashes in progress (``bcrypt_in_progress``: the logins and
+  signups hashing or queued for a CPU) and how long each takes;
+* warbles posted, likes and follows, counted from committed events.
+
+The metric types are the three this needs -- `Counter`, `Gauge` and
+`Histogram` -- written out here rather than pulled in as a dependency.
+Recording a value takes a lock and a dict update, around a microsecond;
+benchmarks/bench_metrics.py measures that and what it adds up to per
+request and per query.
+
+Each gunicorn worker only counts its own requests. With ``METRICS_DIR`` set,
+every worker writes its values to ``<pid>.json`` in that directory every
+`FLUSH_INTERVAL` seconds, and whichever worker serves a scrape adds them all
+up: counters and histograms over every worker that ever ran, gauges over
+the live ones. When gunicorn reaps a worker (see gunicorn.conf.py), its
+counts are folded into ``dead.json``, so recycled workers' counts don't go
+backwards or pile up files. Other workers' values can be up to a flush
+interval old. Under gunicorn, ``METRICS_DIR`` defaults to a temporary
+directory the master makes at startup; elsewhere, without it, ``/metrics``
+shows just the process that answered.
+"""
+
+import bisect
+import fcntl
+import glob
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+
+from cache import cache
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5
+DEAD = "dead"
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+BCRYPT_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 1, 2, 5)
+
+# Statements are labelled by their first word if it's one of these.
+OPERATIONS = {"select", "insert", "update", "delete"}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """A named family of values, one per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        self.reset()
+        (registry or default_registry).register(self)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            if not self.labels and self.kind != "histogram":
+                # Shown as 0 before anything happens, rather than missing.
+                self._values[()] = 0
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, value, *labels):
+        """Report a count kept somewhere else, such as `cache.stats`."""
+
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(Metric):
+    """A value that goes up and down; added up over live workers."""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @contextmanager
+    def track(self, *labels):
+        """Count the block as in progress while it runs."""
+
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.inc(*labels, amount=-1)
+
+
+class Histogram(Metric):
+    """How many observations fell in each bucket, and their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS, **kwargs):
+        super().__init__(name, help, labels, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # One count per bucket (the last is +Inf), then the sum; they're
+        # made cumulative on export.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+
+class Registry:
+    """The metrics of this process, and the directory it shares them through."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.directory = None
+        self.pid = os.getpid()
+        self._flusher = None
+        self._start_lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def collector(self, fn):
+        """Call `fn()` to bring callback-fed metrics up to date before each
+        snapshot."""
+
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self):
+        """This process's metrics, as a JSON-able dict."""
+
+        for fn in self.collectors:
+            fn()
+
+        return {
+            name: {
+                "kind": metric.kind,
+                "help": metric.help,
+                "labels": metric.labels,
+                "buckets": getattr(metric, "buckets", None),
+                "values": metric.snapshot(),
+            }
+            for name, metric in self.metrics.items()
+        }
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    # ~~ Sharing between workers
+
+    def start(self):
+        """Start flushing to `directory` in this process (again, after a fork)."""
+
+        if self.directory is None or self._flusher is not None:
+            return
+
+        with self._start_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run, name="warbler-metrics", daemon=True
+                )
+                self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def _after_fork(self):
+        # The parent's counts are the parent's; threads don't survive fork().
+        self.pid = os.getpid()
+        self._flusher = None
+        self._start_lock = threading.Lock()
+        self.reset()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with open(os.path.join(self.directory, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def flush(self):
+        """Write this process's metrics to its file in `directory`."""
+
+        if self.directory is None:
+            return
+
+        path = self._path(self.pid)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(f"{path}.tmp", path)
+
+    def mark_process_dead(self, pid):
+        """Fold the exited worker `pid`'s counts into ``dead.json``."""
+
+        if self.directory is None:
+            return
+
+        with self._locked(exclusive=True):
+            snapshots = _read(self._path(DEAD)), _read(self._path(pid))
+            if snapshots[1] is None:
+                return
+
+            dead = _merge([s for s in snapshots if s], live=False)
+            with open(f"{self._path(DEAD)}.tmp", "w") as file:
+                json.dump(dead, file)
+            os.replace(f"{self._path(DEAD)}.tmp", self._path(DEAD))
+            os.remove(self._path(pid))
+
+    def clear_directory(self):
+        """Forget every worker's metrics, as a fresh gunicorn master should."""
+
+        if self.directory is None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            os.remove(path)
+
+    def merged(self):
+        """Every worker's metrics (just this one's, without a directory)."""
+
+        if self.directory is None:
+            return self.snapshot()
+
+        self.flush()
+        with self._locked(exclusive=False):
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                name = os.path.basename(path)[: -len(".json")]
+                snapshot = _read(path)
+                if snapshot is not None:
+                    live = name != DEAD and _alive(int(name))
+                    snapshots.append((snapshot, live))
+
+        return _merge([s for s, _ in snapshots], [live for _, live in snapshots])
+
+    def exposition(self):
+        """All the metrics, in Prometheus' text format."""
+
+        lines = []
+        for name, family in sorted(self.merged().items()):
+            lines.append(f"# HELP {name} {_escape_help(family['help'])}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for key, value in sorted(family["values"]):
+                labels = dict(zip(family["labels"], key))
+                if family["kind"] == "histogram":
+                    lines.extend(_histogram_lines(name, labels, family, value))
+                else:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(snapshots, live=True):
+    """Add up `snapshots`, leaving out gauges where `live` is False.
+
+    `live` is one flag for all of them or a list with one per snapshot.
+    """
+
+    if not isinstance(live, list):
+        live = [live] * len(snapshots)
+
+    merged = {}
+    for snapshot, is_live in zip(snapshots, live):
+        for name, family in snapshot.items():
+            into = merged.setdefault(name, dict(family, values={}))
+            if family["kind"] == "gauge" and not is_live:
+                continue
+            for key, value in family["values"]:
+                key = tuple(key)
+                if family["kind"] == "histogram":
+                    total = into["values"].get(key) or [0] * len(value)
+                    into["values"][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    into["values"][key] = into["values"].get(key, 0) + value
+
+    for family in merged.values():
+        family["values"] = [[list(k), v] for k, v in family["values"].items()]
+    return merged
+
+
+def _histogram_lines(name, labels, family, counts):
+    cumulative = 0
+    bounds = [*family["buckets"], "+Inf"]
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        le = bound if bound == "+Inf" else _number(bound)
+        yield f"{name}_bucket{_labels(dict(labels, le=le))} {cumulative}"
+    yield f"{name}_sum{_labels(labels)} {_number(counts[-1])}"
+    yield f"{name}_count{_labels(labels)} {cumulative}"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _escape_help(text):
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _number(value):
+    return repr(float(value))
+
+
+default_registry = Registry()
+os.register_at_fork(after_in_child=default_registry._after_fork)
+
+
+##############################################################################
+# ~~ Metrics
+
+http_requests = Counter(
+    "warbler_http_requests_total",
+    "Requests handled, by endpoint, method and status.",
+    ["endpoint", "method", "status"],
+)
+http_request_seconds = Histogram(
+    "warbler_http_request_duration_seconds",
+    "Time from receiving a request to sending its last byte, by endpoint.",
+    ["endpoint"],
+    buckets=REQUEST_BUCKETS,
+)
+db_query_seconds = Histogram(
+    "warbler_db_query_duration_seconds",
+    "Time spent running SQL statements, by engine and operation.",
+    ["engine", "operation"],
+    buckets=QUERY_BUCKETS,
+)
+db_pool_connections = Gauge(
+    "warbler_db_pool_connections",
+    "Pooled database connections, by engine and state.",
+    ["engine", "state"],
+)
+cache_lookups = Counter(
+    "warbler_cache_lookups_total",
+    "Cache lookups, by key family and how they were answered.",
+    ["family", "result"],
+)
+bcrypt_in_progress = Gauge(
+    "warbler_bcrypt_in_progress",
+    "Password hashes being computed or waiting for a CPU.",
+)
+bcrypt_seconds = Histogram(
+    "warbler_bcrypt_duration_seconds",
+    "Time to hash or check a password, by operation.",
+    ["operation"],
+    buckets=BCRYPT_BUCKETS,
+)
+warbles_posted = Counter("warbler_warbles_posted_total", "Warbles posted.")
+likes = Counter("warbler_likes_total", "Warbles liked.")
+follows = Counter("warbler_follows_total", "Users followed.")
+
+BUSINESS_COUNTERS = {
+    "message.created": warbles_posted,
+    "like.created": likes,
+    "follow.created": follows,
+}
+
+# cache.FamilyStats counter -> the result label it's exported with.
+CACHE_RESULTS = {
+    "l1_hits": "l1_hit",
+    "l2_hits": "l2_hit",
+    "misses": "miss",
+    "early_refreshes": "early_refresh",
+    "coalesced": "coalesced",
+}
+
+
+@contextmanager
+def hashing_password(operation):
+    """Count and time a bcrypt `operation` ("hash" or "check")."""
+
+    with bcrypt_in_progress.track(), bcrypt_seconds.time(operation):
+        yield
+
+
+@default_registry.collector
+def collect_cache_stats():
+    for family, stats in list(cache.stats.items()):
+        for attr, result in CACHE_RESULTS.items():
+            cache_lookups.set_total(getattr(stats, attr), family, result)
+
+
+def count_events(batch):
+    for kind, data in batch:
+        BUSINESS_COUNTERS[kind].inc()
+
+
+def watch_engine(engine, name):
+    """Time `engine`'s queries and report its pool, as engine `name`."""
+
+    if event.contains(engine, "before_cursor_execute", _query_started):
+        return
+
+    event.listen(engine, "before_cursor_execute", _query_started)
+    event.listen(
+        engine,
+        "after_cursor_execute",
+        lambda conn, cursor, statement, parameters, context, executemany: (
+            _query_finished(context, statement, name)
+        ),
+    )
+
+    @default_registry.collector
+    def collect_pool():
+        pool = engine.pool  # dispose() replaces it, as after a fork
+        if hasattr(pool, "checkedout"):
+            db_pool_connections.set(pool.checkedout(), name, "checked_out")
+        if hasattr(pool, "checkedin"):
+            db_pool_connections.set(pool.checkedin(), name, "idle")
+        if hasattr(pool, "size") and hasattr(pool, "_max_overflow"):
+            db_pool_connections.set(pool.size() + pool._max_overflow, name, "max")
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    # On the execution context, so a statement that raises leaves nothing
+    # behind.
+    context.metrics_started = time.perf_counter()
+
+
+def _query_finished(context, statement, name):
+    started = getattr(context, "metrics_started", None)
+    if started is None:
+        return
+    operation = statement.lstrip()[:6].lower()
+    if operation not in OPERATIONS:
+        operation = "other"
+    db_query_seconds.observe(time.perf_counter() - started, name, operation)
+
+
+class MetricsMiddleware:
+    """WSGI middleware that serves ``/metrics`` and times everything else."""
+
+    def __init__(self, wsgi_app, registry, token=None, token_required=False):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+        self.token = token
+        self.token_required = token_required
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            environ["warbler.started"] = time.perf_counter()
+            return self.wsgi_app(environ, start_response)
+
+        if self.token is None and self.token_required:
+            start_response("403 FORBIDDEN", [("Content-Type", "text/plain")])
+            return [b"forbidden: METRICS_TOKEN isn't set"]
+
+        if self.token is not None:
+            scheme, _, supplied = environ.get("HTTP_AUTHORIZATION", "").partition(" ")
+            if scheme != "Bearer" or not hmac.compare_digest(
+                supplied.encode(), self.token.encode()
+            ):
+                start_response("403 FORBIDDEN", [("Content-Type", "text/plain")])
+                return [b"forbidden"]
+
+        body = self.registry.exposition().encode()
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE)])
+        return [body]
+
+
+def init_app(app, db):
+    """Measure `app`'s requests and databases, and serve ``/metrics``.
+
+    Call after `db` (and any shards) are set up.
+    """
+
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+
+    registry = default_registry
+    registry.directory = app.config.get("METRICS_DIR")
+    if registry.directory:
+        os.makedirs(registry.directory, exist_ok=True)
+
+    engines = {"0": db.get_engine(app)}
+    if "shards" in app.extensions:
+        engines = app.extensions["shards"].engines
+    for name, engine in engines.items():
+        watch_engine(engine, name)
+
+    # events imports models, which imports this module.
+    import events
+
+    events.consumer(*BUSINESS_COUNTERS)(count_events)
+
+    @app.after_request
+    def remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def count_request(exc):
+        # Teardown runs after a streamed response's last chunk.
+        registry.start()
+        started = request.environ.get("warbler.started")
+        endpoint = request.endpoint or "none"
+        status = g.get("response_status", 500)
+        http_requests.inc(endpoint, request.method, str(status))
+        if started is not None:
+            http_request_seconds.observe(time.perf_counter() - started, endpoint)
+
+    token = app.config.get("METRICS_TOKEN")
+    token_required = bool(app.config.get("METRICS_TOKEN_REQUIRED"))
+    if token is None and token_required:
+        logger.warning("METRICS_TOKEN isn't set; refusing to serve /metrics")
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, registry, token, token_required)
@@ -1,21 +1,37 @@
 """SQLAlchemy models for Warbler."""
 
+import heapq
+import random
+import sqlite3
+import time
 from datetime import datetime
+from itertools import islice
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, insert as sa_insert, lambda_stmt, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+import metrics
+import shards
 
 DEFAULT_IMAGE = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE = "/static/images/warbler-hero.jpg"
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = shards.ShardingSQLAlchemy()
 
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = "follows"
+    __table_args__ = (
+        db.Index("ix_follows_followed_created", "user_being_followed_id", "created_at"),
+        db.Index("ix_follows_following_created", "user_following_id", "created_at"),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -29,11 +45,38 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`, unless they already do.
+
+        Returns the follow's created_at, or None if it already existed. See
+        `insert_if_absent`; callers emit the event. Doesn't commit.
+        """
+
+        created_at = datetime.utcnow()
+        if insert_if_absent(
+            cls,
+            user_following_id=follower_id,
+            user_being_followed_id=followed_id,
+            created_at=created_at,
+        ):
+            return created_at
+        return None
+
 
 class Likes(db.Model):
     """Connect message likes to the user"""
 
     __tablename__ = "likes"
+    __table_args__ = (
+        db.Index("ix_likes_message_created", "message_being_liked_id", "created_at"),
+    )
 
     user_id = db.Column(
         db.Integer,
@@ -47,6 +90,31 @@ class Likes(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Make `user_id` like `message_id`, unless they already do.
+
+        Returns the like's created_at, or None if it already existed. See
+        `insert_if_absent`; callers bump the like count and emit the event.
+        Doesn't commit.
+        """
+
+        created_at = datetime.utcnow()
+        if insert_if_absent(
+            cls,
+            user_id=user_id,
+            message_being_liked_id=message_id,
+            created_at=created_at,
+        ):
+            return created_at
+        return None
+
 
 class User(db.Model):
     """User in the system."""
@@ -90,13 +158,32 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship("Message", order_by="Message.timestamp.desc()")
+    # Every UPDATE checks and bumps this, so an edit made from a stale copy
+    # of the row raises StaleDataError instead of overwriting a newer one.
+    version_id = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="1",
+    )
+
+    __mapper_args__ = {"version_id_col": version_id}
+
+    # The follows, likes and messages foreign keys all cascade on delete, so
+    # passive_deletes lets the database clean up after a deleted user instead
+    # of the ORM loading every related row first.
+
+    messages = db.relationship(
+        "Message",
+        order_by="Message.timestamp.desc()",
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
@@ -104,11 +191,13 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
         secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     liked_messages = db.relationship(
         "Message",
         secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -117,22 +206,98 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((other_user.id, self.id)) is not None
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set.
+
+        Lets a page of user cards get all its follow/unfollow buttons from
+        one query instead of one `is_following` call per card.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == self.id,
+            Follows.user_being_followed_id.in_(user_ids),
+        )
+        return {user_id for (user_id,) in rows}
+
+    def following_query(self):
+        """Users this user follows, most recently followed first."""
+
+        return (
+            User.query.join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == self.id)
+            .order_by(Follows.created_at.desc(), User.id.desc())
+        )
+
+    def followers_query(self):
+        """Users following this user, most recent followers first."""
+
+        return (
+            User.query.join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == self.id)
+            .order_by(Follows.created_at.desc(), User.id.desc())
+        )
+
+    def count_following(self):
+        """How many users this user follows, counted without loading them."""
+
+        return Follows.query.filter_by(user_following_id=self.id).count()
+
+    def count_followers(self):
+        """How many users follow this user, counted without loading them."""
+
+        return Follows.query.filter_by(user_being_followed_id=self.id).count()
+
+    def count_messages(self):
+        """How many messages this user has posted (archived ones included)."""
+
+        return (
+            Message.query.filter_by(user_id=self.id).count()
+            + MessageArchive.query.filter_by(user_id=self.id).count()
+        )
+
+    def count_likes(self):
+        """How many messages this user likes, counted in SQL.
+
+        Like the likes page, this leaves out likes of archived messages.
+        """
+
+        return Likes.query.filter_by(user_id=self.id).count()
+
+    def liked_messages_query(self):
+        """Messages this user likes, newest first."""
+
+        return (
+            Message.query.join(Likes, Likes.message_being_liked_id == Message.id)
+            .filter(Likes.user_id == self.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+        )
 
     def is_liking(self, message):
         """Does this user like `message`?"""
 
-        found_messages_list = [
-            msg for msg in self.liked_messages if msg.id == message.id
-        ]
-        return len(found_messages_list) == 1
+        return Likes.query.get((self.id, message.id)) is not None
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` does this user like? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        rows = db.session.query(Likes.message_being_liked_id).filter(
+            Likes.user_id == self.id,
+            Likes.message_being_liked_id.in_(message_ids),
+        )
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -141,7 +306,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
+        with metrics.hashing_password("hash"):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
 
         user = User(
             username=username,
@@ -164,10 +330,11 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = db.session.execute(_user_by_username(username)).scalars().first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with metrics.hashing_password("check"):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -178,6 +345,10 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = "messages"
+    __table_args__ = (db.Index("ix_messages_user_timestamp", "user_id", "timestamp"),)
+
+    # Old messages move to MessageArchive (see archival.py).
+    archived = False
 
     id = db.Column(
         db.Integer,
@@ -201,18 +372,480 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step with `likes` by add_likes(), so showing a count never
+    # means counting rows.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     user = db.relationship("User")
 
     liked_by = db.relationship(
         "User",
         secondary="likes",
+        passive_deletes=True,
     )
 
     def is_liked_by(self, user):
         """Is this message liked by `user`?"""
 
-        found_users_list = [liker for liker in self.liked_by if liker.id == user.id]
-        return len(found_users_list) == 1
+        return Likes.query.get((user.id, self.id)) is not None
+
+    def likers_query(self):
+        """Users who like this message, most recent first."""
+
+        return (
+            User.query.join(Likes, Likes.user_id == User.id)
+            .filter(Likes.message_being_liked_id == self.id)
+            .order_by(Likes.created_at.desc(), User.id.desc())
+        )
+
+    @classmethod
+    def timeline(cls, user_ids, limit):
+        """The `limit` newest messages by any of `user_ids`, newest first.
+
+        On a sharded database each shard's newest are read separately and
+        merged (see shards.py); otherwise it's one query.
+        """
+
+        streams = []
+        for shard_id, ids in shards.by_shard(user_ids):
+            options = {} if shard_id is None else {"_sa_shard_id": shard_id}
+            result = db.session.execute(
+                _newest_messages(ids, limit), execution_options=options
+            )
+            streams.append(result.scalars().all())
+
+        if len(streams) == 1:
+            return streams[0]
+
+        merged = heapq.merge(
+            *streams, key=lambda msg: (msg.timestamp, msg.id), reverse=True
+        )
+        return list(islice(merged, limit))
+
+    @classmethod
+    def add_likes(cls, message_ids, delta=1):
+        """Add `delta` to the like counts of `message_ids`, in SQL.
+
+        `message_ids` may be a list or a select of ids. The update is a
+        single ``like_count = like_count + delta`` statement, so concurrent
+        likes can't lose each other's increments. Doesn't commit.
+        """
+
+        cls.query.filter(cls.id.in_(message_ids)).update(
+            {cls.like_count: cls.like_count + delta},
+            synchronize_session=False,
+        )
+
+
+class MessageArchive(db.Model):
+    """A message moved out of `messages` by archival.py.
+
+    On PostgreSQL the table is range-partitioned by month of `timestamp`
+    (the partitions are created by archival.py as it needs them), which is
+    why the primary key includes `timestamp`. Elsewhere it is a plain table.
+    """
+
+    __tablename__ = "messages_archive"
+    __table_args__ = (
+        db.Index("ix_messages_archive_user_timestamp", "user_id", "timestamp"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+    archived = True
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+    )
+
+    # Likes rows reference live messages only; archiving moves them to
+    # `LikeArchive` and keeps the count here.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    user = db.relationship("User")
+
+
+class LikeArchive(db.Model):
+    """A like of a message archived by archival.py.
+
+    It refers to the archived message by its whole primary key, so deleting
+    that (with its author) cascades here.
+    """
+
+    __tablename__ = "likes_archive"
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ["message_id", "message_timestamp"],
+            ["messages_archive.id", "messages_archive.timestamp"],
+            ondelete="cascade",
+        ),
+        db.Index("ix_likes_archive_message", "message_id"),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A precomputed who-to-follow suggestion (see recommendations.py)."""
+
+    __tablename__ = "recommendations"
+    __table_args__ = (db.Index("ix_recommendations_user_score", "user_id", "score"),)
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    candidate = db.relationship("User", foreign_keys=[candidate_id])
+
+
+class MessageTrend(db.Model):
+    """Time-decayed like score for a message (see trending.py)."""
+
+    __tablename__ = "message_trends"
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey("messages.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+    message = db.relationship("Message")
+
+
+class HashtagCount(db.Model):
+    """How often a hashtag was used in one hourly bucket."""
+
+    __tablename__ = "hashtag_counts"
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+        index=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Notification(db.Model):
+    """An inbox entry: one or more people liked a warble or followed a user.
+
+    See notifications.py for how bursts of likes and follows coalesce.
+    """
+
+    __tablename__ = "notifications"
+    __table_args__ = (
+        db.Index("ix_notifications_user_updated", "user_id", "updated_at"),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+    )
+
+    # "like" or "follow".
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey("messages.id", ondelete="cascade"),
+    )
+
+    # The most recent of the `actor_count` people.
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="set null"),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    unread = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    actor = db.relationship("User", foreign_keys=[actor_id])
+
+    message = db.relationship("Message")
+
+
+# At most one unread row per recipient, kind and warble (follows have none,
+# hence the coalesce: NULLs never conflict), which is what bursts coalesce
+# into; see notifications.py.
+db.Index(
+    "uq_notifications_unread_group",
+    Notification.user_id,
+    Notification.kind,
+    func.coalesce(Notification.message_id, 0),
+    unique=True,
+    postgresql_where=Notification.unread,
+    sqlite_where=Notification.unread,
+)
+
+
+class NotificationCount(db.Model):
+    """How many unread notifications a user has, kept by notifications.py."""
+
+    __tablename__ = "notification_counts"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, claimed and run by worker.py."""
+
+    __tablename__ = "jobs"
+    __table_args__ = (db.Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="queued",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind}, {self.status}>"
+
+
+# Rows are inserted with ON CONFLICT DO NOTHING where the database has it.
+INSERT_IF_ABSENT = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
+
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF = 0.02
+
+# PostgreSQL's serialization_failure and deadlock_detected: the transaction
+# was rolled back and running it again is expected to work.
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+
+def insert_if_absent(model, **values):
+    """Insert a `model` row with `values`, unless a unique key is taken.
+
+    One ``INSERT ... ON CONFLICT DO NOTHING``: no read first for a
+    concurrent request to race, and no unique-violation error (or aborted
+    transaction) when two insert the same row. Returns whether the row was
+    inserted. It bypasses the session, so no object is added and no
+    flush-time event is made.
+    """
+
+    bind_arguments = shards.bind_arguments(model.__tablename__, values)
+    bind = db.session().get_bind(model.__mapper__, **bind_arguments)
+
+    insert = INSERT_IF_ABSENT.get(bind.dialect.name)
+    if insert is None:
+        # No ON CONFLICT: fall back to a savepoint around a plain insert.
+        try:
+            with db.session.begin_nested():
+                db.session.execute(
+                    sa_insert(model), values, bind_arguments=bind_arguments
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    result = db.session.execute(
+        insert(model).on_conflict_do_nothing(), values, bind_arguments=bind_arguments
+    )
+    return bool(result.rowcount)
+
+
+def is_retryable(error):
+    """Did `error` abort a transaction that can simply be run again?"""
+
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "pgcode", None) in RETRYABLE_PGCODES:
+        return True
+    return isinstance(orig, sqlite3.OperationalError) and "locked" in str(orig)
+
+
+def retry_on_conflict(fn, attempts=RETRY_ATTEMPTS):
+    """Call `fn()` and commit, running both again if the database says to.
+
+    Retries serialization failures and deadlocks, after a rollback and a
+    short, jittered, doubling sleep. The rollback expires everything in
+    the session, so `fn` must start from scratch each time. Returns what
+    `fn` returned.
+    """
+
+    for attempt in range(1, attempts + 1):
+        try:
+            result = fn()
+            db.session.commit()
+            return result
+        except DBAPIError as error:
+            db.session.rollback()
+            if attempt == attempts or not is_retryable(error):
+                raise
+            time.sleep(random.uniform(0, RETRY_BACKOFF * 2**attempt))
+
+
+# The queries run on nearly every request are lambda statements: SQLAlchemy
+# caches the statement built by the lambda (keyed on the lambda's code), so
+# after the first call each one costs a cache lookup and new bound values,
+# not building a Query and working out its cache key again.
+
+
+def _user_by_username(username):
+    return lambda_stmt(lambda: select(User).where(User.username == username))
+
+
+def _newest_messages(user_ids, limit):
+    return lambda_stmt(
+        lambda: select(Message)
+        .where(Message.user_id.in_(user_ids))
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit)
+    )
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores ON DELETE CASCADE unless foreign keys are switched on."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 
 def connect_db(app):
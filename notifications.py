@@ -0,0 +1,165 @@
+"""Notifications: someone followed you, or liked one of your warbles.
+
+They're written in the worker by a durable consumer of ``like.created`` and
+``follow.created`` events (see events.py), so liking or following adds
+nothing to the request but the transaction's outbox job. The worker hands a
+claimed batch of those jobs over at once, so a burst of likes is one pass
+here, with a couple of statements per warble or followed user rather than
+per like. Rows and counts are written with atomic updates and inserts that
+skip rows already there, so workers running batches for the same user at
+once neither fail nor double up.
+
+While a notification is unread, more likes of the same warble (or follows
+of the same user) coalesce into it: the row keeps the newest actor and how
+many there have been, for "alice and 4 others liked your warble". Once it
+has been read, the next like starts a new row. Unliking doesn't take a like
+back out, so liking again counts twice.
+
+Each user's number of unread rows is kept in ``notification_counts``, added
+to as rows are created and zeroed when the inbox is read, so the badge on
+every page is one primary-key lookup. A cascade that deletes an unread row
+(its warble was deleted) leaves the count high until the next read.
+"""
+
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+import events
+from models import (
+    db,
+    insert_if_absent,
+    Message,
+    Notification,
+    NotificationCount,
+    User,
+)
+
+INBOX_SIZE = 50
+
+
+def unread_count(user_id):
+    """How many of `user_id`'s notifications are unread."""
+
+    counts = db.session.get(NotificationCount, user_id)
+    return counts.unread if counts is not None else 0
+
+
+def inbox(user_id, limit=INBOX_SIZE):
+    """`user_id`'s `limit` most recently updated notifications."""
+
+    return (
+        Notification.query.options(
+            joinedload(Notification.actor), joinedload(Notification.message)
+        )
+        .filter_by(user_id=user_id)
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def mark_read(user_id):
+    """Mark all of `user_id`'s notifications read. Doesn't commit."""
+
+    Notification.query.filter_by(user_id=user_id, unread=True).update(
+        {"unread": False}, synchronize_session=False
+    )
+    NotificationCount.query.filter_by(user_id=user_id).update(
+        {"unread": 0}, synchronize_session=False
+    )
+
+
+def record(notices):
+    """Add `notices`, (user id, kind, message id, actor id) tuples, oldest
+    first, to their users' inboxes. Doesn't commit.
+    """
+
+    groups = {}
+    for user_id, kind, message_id, actor_id in notices:
+        if user_id != actor_id:
+            count = groups.get((user_id, kind, message_id), (0, None))[0]
+            groups[(user_id, kind, message_id)] = (count + 1, actor_id)
+    if not groups:
+        return
+
+    # Users deleted since the event have nothing to notify or be named.
+    user_ids = {key[0] for key in groups} | {actor for _, actor in groups.values()}
+    live = {row.id for row in db.session.query(User.id).filter(User.id.in_(user_ids))}
+
+    now = datetime.utcnow()
+    created = Counter()
+    for (user_id, kind, message_id), (count, actor_id) in groups.items():
+        if user_id in live:
+            actor_id = actor_id if actor_id in live else None
+            key = (user_id, kind, message_id)
+            if _add_to_unread(key, count, actor_id, now):
+                created[user_id] += 1
+
+    for user_id, count in created.items():
+        insert_if_absent(NotificationCount, user_id=user_id, unread=0)
+        NotificationCount.query.filter_by(user_id=user_id).update(
+            {"unread": NotificationCount.unread + count}, synchronize_session=False
+        )
+
+
+def _add_to_unread(key, count, actor_id, now):
+    """Fold `count` more actors into `key`'s unread row, or create it.
+
+    Returns whether it was created. Updates are atomic and the insert skips
+    a row another worker got in first (see ``uq_notifications_unread_group``),
+    so concurrent batches for one user neither fail nor make two rows.
+    """
+
+    user_id, kind, message_id = key
+    while True:
+        updated = Notification.query.filter(
+            Notification.user_id == user_id,
+            Notification.kind == kind,
+            func.coalesce(Notification.message_id, 0) == (message_id or 0),
+            Notification.unread,
+        ).update(
+            {
+                "actor_count": Notification.actor_count + count,
+                "actor_id": actor_id,
+                "updated_at": now,
+            },
+            synchronize_session=False,
+        )
+        if updated:
+            return False
+
+        if insert_if_absent(
+            Notification,
+            user_id=user_id,
+            kind=kind,
+            message_id=message_id,
+            actor_id=actor_id,
+            actor_count=count,
+            unread=True,
+            updated_at=now,
+        ):
+            return True
+        # Another worker inserted it since our update; update that one.
+
+
+@events.consumer("like.created", "follow.created", durable=True)
+def on_events(batch):
+    liked = {data["message_id"] for kind, data in batch if kind == "like.created"}
+    authors = dict(
+        db.session.query(Message.id, Message.user_id).filter(Message.id.in_(liked))
+        if liked
+        else ()
+    )
+
+    notices = []
+    for kind, data in batch:
+        if kind == "follow.created":
+            notices.append((data["followed_id"], "follow", None, data["follower_id"]))
+        elif data["message_id"] in authors:
+            author_id = authors[data["message_id"]]
+            notices.append((author_id, "like", data["message_id"], data["user_id"]))
+
+    record(notices)
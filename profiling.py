@@ -0,0 +1,216 @@
+"""Opt-in profiling for production workers.
+
+Two tools, both off unless configured:
+
+* With ``PROFILE_SAMPLING`` set, ``sampler`` runs a background thread in each
+  worker that, every ``SAMPLE_INTERVAL`` seconds, grabs the stack of every
+  thread that is handling a request (``sys._current_frames()``) and counts it
+  under the request's endpoint. Nothing is traced between samples, so the
+  cost is a few microseconds per sample, not per function call.
+  ``GET /internal/profile`` returns the counts in the "folded stacks" format
+  that flamegraph.pl, speedscope and friends read (``?reset=1`` clears them).
+  Each worker samples and reports only itself.
+
+* A request carrying an ``X-Profile-Request`` header (with the profile token)
+  is run under ``cProfile`` from start to last streamed byte. The stats are
+  written to ``PROFILE_DIR`` and named in the ``X-Profile-File`` response
+  header; open them with ``pstats`` or snakeviz.
+
+Both need ``PROFILE_TOKEN``; without it the endpoint doesn't exist and the
+header is ignored. Send the token as ``Authorization: Bearer <token>`` to
+the endpoint, and as the header's value to profile a request.
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from flask import abort, g, request
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.01
+MAX_DEPTH = 64
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(), "warbler-profiles")
+PROFILE_HEADER = "X-Profile-Request"
+
+
+class SamplingProfiler:
+    """Statistical profiler for the threads currently serving requests."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, max_depth=MAX_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._active = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start sampling in this process (again, after a fork)."""
+
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="warbler-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def enter(self, endpoint):
+        """Mark the current thread as serving `endpoint`."""
+
+        self._active[threading.get_ident()] = endpoint
+
+    def exit(self):
+        self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = os.path.basename(code.co_filename)
+            label = self._labels[code] = f"{filename}:{code.co_name}"
+        return label
+
+    def _fold(self, endpoint, frame):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(endpoint or "<unknown>")
+        return ";".join(reversed(labels))
+
+    def sample(self):
+        """Record one stack for each thread that is serving a request."""
+
+        active = dict(self._active)
+        if not active:
+            return
+
+        frames = sys._current_frames()
+        folded = [
+            self._fold(endpoint, frames[ident])
+            for ident, endpoint in active.items()
+            if ident in frames
+        ]
+
+        with self._lock:
+            self.stacks.update(folded)
+            self.samples += 1
+
+    def folded(self):
+        """The samples as "frame;frame;frame count" lines."""
+
+        with self._lock:
+            return "".join(
+                f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())
+            )
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+
+sampler = SamplingProfiler()
+
+
+def _token_matches(app, supplied):
+    token = app.config.get("PROFILE_TOKEN")
+    if not (token and supplied):
+        return False
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+
+def bearer_authorized(app):
+    """Does this request carry ``Authorization: Bearer <PROFILE_TOKEN>``?
+
+    Guards the ``/internal`` endpoints: sampled stacks here, cache stats in
+    cache.py.
+    """
+
+    scheme, _, supplied = request.headers.get("Authorization", "").partition(" ")
+    return scheme == "Bearer" and _token_matches(app, supplied)
+
+
+def init_app(app):
+    """Install the sampler hooks, profile endpoint and per-request profiling."""
+
+    if not app.config.get("PROFILE_TOKEN"):
+        return
+
+    sampling = bool(app.config.get("PROFILE_SAMPLING"))
+    profile_dir = app.config.get("PROFILE_DIR") or DEFAULT_PROFILE_DIR
+
+    @app.before_request
+    def start_profiling():
+        if sampling:
+            # Threads don't survive fork(), so each worker starts its own.
+            sampler.start()
+            sampler.enter(request.endpoint)
+
+        if _token_matches(app, request.headers.get(PROFILE_HEADER)):
+            g.request_profile = cProfile.Profile()
+            g.request_profile.enable()
+
+    @app.after_request
+    def name_profile(response):
+        if g.get("request_profile") is not None:
+            started = time.strftime("%Y%m%d-%H%M%S")
+            name = f"{started}-{os.getpid()}-{request.endpoint}.prof"
+            g.request_profile_file = name
+            response.headers["X-Profile-File"] = g.request_profile_file
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        # Teardown runs after a streamed response's last chunk, so the
+        # profile covers the whole render.
+        if sampling:
+            sampler.exit()
+
+        profile = g.pop("request_profile", None)
+        if profile is None:
+            return
+
+        profile.disable()
+        name = g.pop("request_profile_file", None)
+        if name:
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(profile_dir, name))
+            logger.info("Wrote request profile", extra={"profile_file": name})
+
+    @app.get("/internal/profile")
+    def sampled_profile():
+        """This worker's sampled stacks, as folded text."""
+
+        if not bearer_authorized(app):
+            abort(403)
+
+        body = sampler.folded()
+        if request.args.get("reset"):
+            sampler.reset()
+
+        return body, 200, {"Content-Type": "text/plain; charset=utf-8"}
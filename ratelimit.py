@@ -0,0 +1,309 @@
+"""Rate limiting and admission control for expensive endpoints.
+
+Views opt in with ``@limit(...)`` (under the route decorator)::
+
+    @bp.post("/login")
+    @ratelimit.limit(per_ip=Rate(10, 60), concurrency=4)
+    def login(): ...
+
+Before such a view runs, the request must take a token from each of its
+token buckets -- one per client IP and/or one per logged-in user, refilling
+at ``Rate.count`` tokens every ``Rate.per`` seconds -- or it gets a 429 with
+``Retry-After``. Then it must get one of the endpoint's ``concurrency``
+slots, or it gets a 503: a burst of bcrypt logins is turned away at the door
+instead of queueing up behind every worker. The checks run before anything
+else in the request (including loading the user), so a rejected request
+costs no database work.
+
+State lives in a backend. ``MemoryBackend`` is per process: fine for tests
+and a single worker, but each gunicorn worker would enforce the limits on
+its own, so N workers would allow N times each rate and N times each
+concurrency cap. ``RedisBackend`` shares buckets and slots between workers;
+both operations are single Lua scripts, so they are atomic. Where
+``SHARED_STORES_REQUIRED`` (production), the app won't start with the
+limiter on and no Redis to put it in. If Redis is unreachable later, the
+limiter fails open and logs a warning.
+
+``RATELIMIT_ENABLED`` turns the whole thing off (as the tests do).
+Behind a proxy, set ``RATELIMIT_TRUSTED_PROXIES`` to the number of proxies
+in front of the app so the client IP comes from ``X-Forwarded-For``.
+"""
+
+import logging
+import secrets
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, g, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+logger = logging.getLogger(__name__)
+
+Rate = namedtuple("Rate", ["count", "per"])
+Rate.__doc__ = "`count` requests per `per` seconds (also the burst size)."
+
+# Safety expiry, in seconds, for a Redis concurrency slot whose worker died
+# holding it.
+SLOT_TTL = 60
+PRUNE_EVERY = 10_000
+
+
+class Limit:
+    """The limits attached to a view by `limit()`."""
+
+    def __init__(self, per_ip, per_user, concurrency, methods, when):
+        self.per_ip = per_ip
+        self.per_user = per_user
+        self.concurrency = concurrency
+        self.methods = methods
+        self.when = when
+
+    def applies(self):
+        if self.methods and request.method not in self.methods:
+            return False
+        return self.when is None or self.when()
+
+
+def limit(per_ip=None, per_user=None, concurrency=None, methods=None, when=None):
+    """Attach rate and concurrency limits to a view function.
+
+    `methods` restricts the limits to those HTTP methods; `when` is an
+    optional callable deciding, per request, whether they apply at all.
+    """
+
+    def decorator(view):
+        view.rate_limit = Limit(
+            per_ip, per_user, concurrency, methods and set(methods), when
+        )
+        return view
+
+    return decorator
+
+
+class MemoryBackend:
+    """Token buckets and concurrency slots in this process's memory."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, rate):
+        """Take a token from `key`'s bucket.
+
+        Returns 0 if one was available, or the seconds until one will be.
+        """
+
+        per_second = rate.count / rate.per
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, stamp, _ = self._buckets.get(key, (rate.count, now, now))
+            tokens = min(rate.count, tokens + (now - stamp) * per_second)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / per_second
+
+            full_at = now + (rate.count - tokens) / per_second
+            self._buckets[key] = (tokens, now, full_at)
+
+            self._takes += 1
+            if self._takes % PRUNE_EVERY == 0:
+                self._prune(now)
+
+        return wait
+
+    def _prune(self, now):
+        # A bucket that has refilled since its last use is the same as none.
+        full = [key for key, bucket in self._buckets.items() if bucket[2] <= now]
+        for key in full:
+            del self._buckets[key]
+
+    def acquire(self, key, limit):
+        """Take one of `limit` slots for `key`.
+
+        Returns a token to hand back to `release()`, or None if all the
+        slots are taken.
+        """
+
+        with self._lock:
+            holders = self._slots.setdefault(key, set())
+            if len(holders) >= limit:
+                return None
+            token = secrets.token_hex(8)
+            holders.add(token)
+            return token
+
+    def release(self, key, token):
+        with self._lock:
+            holders = self._slots.get(key, set())
+            holders.discard(token)
+            if not holders:
+                self._slots.pop(key, None)
+
+
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1]) / tonumber(ARGV[2])
+local burst = tonumber(ARGV[1])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+# Each holder is a token in a sorted set, scored by the time (in ms) its
+# slot expires, so a slot leaked by a dead worker lapses on its own.
+ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local ttl = tonumber(ARGV[2]) * 1000
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+  return 0
+end
+
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ttl)
+return 1
+"""
+
+
+class RedisBackend:
+    """Token buckets and concurrency slots shared through Redis."""
+
+    key_prefix = "ratelimit:"
+
+    def __init__(self, client):
+        self.client = client
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._acquire = client.register_script(ACQUIRE_SCRIPT)
+
+    def take(self, key, rate):
+        wait = self._take(keys=[self.key_prefix + key], args=[rate.count, rate.per])
+        return float(wait)
+
+    def acquire(self, key, limit):
+        token = secrets.token_hex(8)
+        got = self._acquire(keys=[self.key_prefix + key], args=[limit, SLOT_TTL, token])
+        return token if got else None
+
+    def release(self, key, token):
+        self.client.zrem(self.key_prefix + key, token)
+
+
+def _too_many(wait):
+    retry_after = max(1, int(wait + 0.999))
+    return (
+        "Too many requests; try again shortly.",
+        429,
+        {"Retry-After": str(retry_after)},
+    )
+
+
+def _check(backend, rules, endpoint, user_id):
+    """The response refusing this request, or None to let it through."""
+
+    buckets = []
+    if rules.per_ip:
+        buckets.append((f"{endpoint}:ip:{request.remote_addr}", rules.per_ip))
+    if rules.per_user and user_id is not None:
+        buckets.append((f"{endpoint}:user:{user_id}", rules.per_user))
+
+    for key, rate in buckets:
+        wait = backend.take(key, rate)
+        if wait:
+            return _too_many(wait)
+
+    if rules.concurrency:
+        key = f"{endpoint}:slots"
+        token = backend.acquire(key, rules.concurrency)
+        if token is None:
+            return "Server busy; try again shortly.", 503, {"Retry-After": "1"}
+        g.ratelimit_slot = (key, token)
+
+    return None
+
+
+def init_app(app, user_id):
+    """Enforce `limit()` rules on `app`'s views.
+
+    `user_id()` returns the logged-in user's id (or None) without touching
+    the database. ``RATELIMIT_BACKEND`` is "redis" (needs the optional
+    ``redis`` package and ``RATELIMIT_REDIS_URL``) or "memory"; it defaults
+    to "redis" when a URL is configured. "memory" is refused, with a
+    RuntimeError, where ``SHARED_STORES_REQUIRED``.
+    """
+
+    if not app.config.get("RATELIMIT_ENABLED", True):
+        return
+
+    proxies = app.config.get("RATELIMIT_TRUSTED_PROXIES") or 0
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+
+    redis_url = app.config.get("RATELIMIT_REDIS_URL")
+    backend_name = app.config.get("RATELIMIT_BACKEND") or (
+        "redis" if redis_url else "memory"
+    )
+
+    if backend_name != "redis" and app.config.get("SHARED_STORES_REQUIRED"):
+        raise RuntimeError(
+            "Rate limits need a shared store here: set RATELIMIT_REDIS_URL "
+            "(or SESSION_REDIS_URL), or RATELIMIT_ENABLED=0"
+        )
+
+    if backend_name == "redis":
+        import redis
+
+        backend = RedisBackend(redis.Redis.from_url(redis_url))
+    else:
+        backend = MemoryBackend()
+
+    app.extensions["ratelimit"] = backend
+
+    @app.before_request
+    def enforce_limits():
+        view = current_app.view_functions.get(request.endpoint)
+        rules = getattr(view, "rate_limit", None)
+        if rules is None or not rules.applies():
+            return None
+
+        try:
+            return _check(backend, rules, request.endpoint, user_id())
+        except Exception:
+            logger.warning(
+                "Rate limiter unavailable; letting request through", exc_info=True
+            )
+            return None
+
+    @app.teardown_request
+    def release_slot(exc):
+        slot = g.pop("ratelimit_slot", None)
+        if slot is not None:
+            key, token = slot
+            try:
+                backend.release(key, token)
+            except Exception:
+                logger.warning(
+                    "Couldn't release rate limit slot %s", key, exc_info=True
+                )
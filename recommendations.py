@@ -0,0 +1,144 @@
+"""Who-to-follow recommendations.
+
+Candidates are friends of friends: the users followed by the people you
+follow, scored by how many of the people you follow also follow them. The
+scoring is done in the background (on every follow and unfollow, reading
+the worker's in-memory follow graph from graph.py) and the top results are
+stored per user in the ``recommendations`` table, so the homepage only has
+to read a handful of rows off an index.
+
+When A follows or unfollows B, A's candidates change, and so do those of
+everyone following A, whose friends-of-friends walk goes through A's
+follows. Both are rescored; for accounts with many followers, only
+``MAX_RESCORED_FOLLOWERS`` of them (sampled, seeded by A's id), and the rest
+catch up at their own next follow.
+
+Popular accounts make the naive walk explode -- following one celebrity
+would pull in everyone the celebrity follows, and following a thousand
+people multiplies that again. Both ends of the walk are sampled:
+``MAX_SEEDS`` of the user's follows, and ``MAX_FANOUT`` follows of each.
+Sampling is seeded by user id so a user's suggestions don't reshuffle on
+every recompute.
+"""
+
+import random
+from collections import Counter
+
+import events
+from graph import follow_graph
+from models import db, Follows, Recommendation, User
+
+MAX_SEEDS = 200
+MAX_FANOUT = 100
+KEEP_TOP = 20
+MAX_RESCORED_FOLLOWERS = 1000
+
+
+def following_ids(user_id):
+    """Ids of the users `user_id` follows."""
+
+    rows = db.session.query(Follows.user_being_followed_id).filter(
+        Follows.user_following_id == user_id
+    )
+    return [followed_id for (followed_id,) in rows]
+
+
+def _sample(ids, limit, rng):
+    ids = list(ids)
+    if len(ids) <= limit:
+        return ids
+    return rng.sample(ids, limit)
+
+
+def friends_of_friends(
+    user_id,
+    get_following,
+    max_seeds=MAX_SEEDS,
+    max_fanout=MAX_FANOUT,
+    keep_top=KEEP_TOP,
+):
+    """Score friend-of-friend candidates for `user_id`.
+
+    `get_following(user_id)` returns the ids a user follows; it is the only
+    access to the graph, so this works the same against the database, the
+    in-memory graph or a generated benchmark graph.
+
+    Returns up to `keep_top` ``(candidate_id, score)`` pairs, best first.
+    """
+
+    rng = random.Random(user_id)
+    following = set(get_following(user_id))
+
+    scores = Counter()
+    for friend_id in _sample(sorted(following), max_seeds, rng):
+        friend_follows = _sample(get_following(friend_id), max_fanout, rng)
+        scores.update(set(friend_follows) - following)
+
+    scores.pop(user_id, None)
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return ranked[:keep_top]
+
+
+def refresh_for_user(user_id, get_following=following_ids):
+    """Recompute and store `user_id`'s recommendations. Doesn't commit."""
+
+    ranked = friends_of_friends(user_id, get_following)
+
+    Recommendation.query.filter_by(user_id=user_id).delete()
+    db.session.bulk_insert_mappings(
+        Recommendation,
+        [
+            dict(user_id=user_id, candidate_id=candidate_id, score=score)
+            for candidate_id, score in ranked
+        ],
+    )
+
+
+def recommended_users(user_id, limit=5):
+    """The top `limit` stored suggestions for `user_id`, as User objects."""
+
+    return (
+        User.query.join(Recommendation, Recommendation.candidate_id == User.id)
+        .filter(Recommendation.user_id == user_id)
+        .order_by(Recommendation.score.desc(), User.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def update_follow_graph(batch):
+    """Apply a batch of follow events to the worker's follow graph."""
+
+    for kind, data in batch:
+        if kind == "follow.created":
+            follow_graph.add(data["follower_id"], data["followed_id"])
+        else:
+            follow_graph.remove(data["follower_id"], data["followed_id"])
+
+
+def affected_users(follower_ids, get_followers, limit=MAX_RESCORED_FOLLOWERS):
+    """Whose candidates change when `follower_ids` follow or unfollow
+    someone: theirs, and up to `limit` of each one's own followers'."""
+
+    affected = set(follower_ids)
+    for follower_id in follower_ids:
+        rng = random.Random(follower_id)
+        affected.update(_sample(get_followers(follower_id), limit, rng))
+    return affected
+
+
+@events.consumer("follow.created", "follow.deleted", durable=True)
+def on_follows(batch):
+    """Follows and unfollows change friends-of-friends; rescore those affected.
+
+    Scoring walks a few hundred adjacency lists, so it reads them from the
+    worker's in-memory follow graph rather than the database.
+    """
+
+    follow_graph.ensure_fresh()
+    update_follow_graph(batch)
+
+    followers = {data["follower_id"] for kind, data in batch}
+    for user_id in sorted(affected_users(followers, follow_graph.followers)):
+        refresh_for_user(user_id, follow_graph.following)
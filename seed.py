@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import create_app
+from models import db, User, Message, Follows
+
+app = create_app()
 
 db.drop_all()
 db.create_all()
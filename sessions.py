@@ -0,0 +1,250 @@
+"""Server-side sessions.
+
+Flask's default session is a signed cookie carrying the whole session, so
+the user id, pending ``flash()`` messages and the CSRF secret ride along on
+every request and response. With this interface the cookie carries only a
+signed, random session id; the data lives in a key/value store and is
+written back only when a request changed it.
+
+Any client with Redis' ``get`` / ``setex`` / ``delete`` commands works as the
+store. ``MemoryStore`` implements that subset in-process: it backs the tests
+and single-process development. It is per-process, so each web worker would
+see only its own sessions; production (``SHARED_STORES_REQUIRED``) uses
+Redis when ``SESSION_REDIS_URL`` is set and signed cookies otherwise.
+
+Logging in or out moves the session to a fresh id (`regenerate`), so an id
+planted in a victim's browser beforehand never becomes a logged-in one.
+"""
+
+import logging
+import secrets
+import threading
+import time
+from datetime import timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """A tiny in-process stand-in for the Redis commands Warbler uses.
+
+    Sessions use get/setex/delete; the cache (cache.py) also uses set with
+    NX/EX, mget, and `delete_if` in place of its compare-and-delete script. Expired keys are dropped when read, and by a sweep of
+    the whole store at most every `sweep_interval` seconds of writes, so
+    keys that are never read again don't pile up. With `max_keys`, a write
+    that would go past it first evicts the oldest keys.
+    """
+
+    def __init__(self, sweep_interval=60, max_keys=None):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.max_keys = max_keys
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _sweep(self, key):
+        """Make room for writing `key`; call holding the lock."""
+
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            expired = [
+                name for name, (expires, _) in self._data.items() if expires <= now
+            ]
+            for name in expired:
+                del self._data[name]
+
+        if self.max_keys is not None and key not in self._data:
+            while len(self._data) >= self.max_keys:
+                del self._data[next(iter(self._data))]
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def mget(self, keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def setex(self, key, seconds, value):
+        if isinstance(seconds, timedelta):
+            seconds = seconds.total_seconds()
+        with self._lock:
+            self._sweep(key)
+            self._data[key] = (time.monotonic() + seconds, value)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            self._sweep(key)
+            if nx and self._get(key) is not None:
+                return None
+            expires = time.monotonic() + ex if ex else float("inf")
+            self._data[key] = (expires, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_if(self, key, value):
+        """Delete `key` if it holds `value`. Returns whether it did."""
+
+        with self._lock:
+            if self._get(key) != value:
+                return False
+            del self._data[key]
+            return True
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data stored under `sid`; tracks whether it was modified."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Keep the data under a new id from the next save on."""
+
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(24)
+        self.new = True
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keep session data in `store`, and only a signed id in the cookie."""
+
+    serializer = TaggedJSONSerializer()
+    key_prefix = "session:"
+    salt = "warbler-session"
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+
+        signed_sid = request.cookies.get(self.get_cookie_name(app))
+        if signed_sid:
+            try:
+                sid = self._signer(app).unsign(signed_sid).decode()
+            except BadSignature:
+                sid = None
+
+            if sid:
+                data = self.store.get(self.key_prefix + sid)
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data), sid=sid)
+
+        return ServerSideSession(sid=secrets.token_urlsafe(24), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        key = self.key_prefix + session.sid
+
+        if session.previous_sid is not None:
+            self.store.delete(self.key_prefix + session.previous_sid)
+
+        if not session:
+            if session.modified:
+                self.store.delete(key)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Untouched sessions cost nothing: no store write, no Set-Cookie.
+        if not session.modified and not self.should_set_cookie(app, session):
+            return
+
+        if session.modified:
+            self.store.setex(
+                key,
+                app.permanent_session_lifetime,
+                self.serializer.dumps(dict(session)),
+            )
+
+        if session.new or session.permanent:
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid.encode()).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def regenerate(session):
+    """Move `session` to a new id, on logging in or out.
+
+    Flask's cookie sessions have no id to fix; they're left as they are.
+    """
+
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+
+def init_app(app):
+    """Install server-side sessions on `app`, per its config.
+
+    ``SESSION_BACKEND`` is "redis" (needs the optional ``redis`` package and
+    ``SESSION_REDIS_URL``), "memory", or "cookie" to keep Flask's signed
+    cookie sessions. It defaults to "redis" when a URL is configured, and
+    otherwise to "memory", or "cookie" where ``SHARED_STORES_REQUIRED``;
+    there "memory" is refused in favour of "cookie".
+    """
+
+    shared_only = app.config.get("SHARED_STORES_REQUIRED")
+    redis_url = app.config.get("SESSION_REDIS_URL")
+    backend = app.config.get("SESSION_BACKEND") or (
+        "redis" if redis_url else "cookie" if shared_only else "memory"
+    )
+
+    if backend == "memory" and shared_only:
+        logger.warning("In-process sessions aren't shared by workers; using cookies")
+        backend = "cookie"
+
+    if backend == "cookie":
+        return
+
+    if backend == "redis":
+        import redis
+
+        store = redis.Redis.from_url(redis_url)
+    else:
+        store = MemoryStore()
+
+    app.session_interface = ServerSideSessionInterface(store)
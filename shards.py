@@ -0,0 +1,345 @@
+"""Optional horizontal sharding of users and their rows by user id.
+
+Off unless ``SHARD_DATABASE_URLS`` is set, in which case ``DATABASE_URL`` is
+shard "0" and each URL in that (comma-separated) list is another shard, "1"
+and up. Everything below only applies to apps configured that way; without
+it `db.session` is Flask-SQLAlchemy's usual session.
+
+What goes where:
+
+* A user, and the ``messages``, ``likes`` and ``follows`` rows they make
+  (as author, liker and follower), live on shard ``user_id % N``.
+* New users are placed by a hash of their username, so the unique index on
+  ``username`` still means what it says. User and message ids are then
+  allocated so that ``id % N`` is their shard (see `next_id`), which lets a
+  message be found from its id alone.
+* Every other table -- jobs, trends, recommendations, the message archive --
+  is unsharded and lives on shard "0". All tables exist on all shards, so a
+  query that fans out never fails for want of one.
+
+Routing is SQLAlchemy's horizontal sharding extension, set up so handlers
+don't have to know about it: inserts go to their owner's shard (Core
+inserts pass `bind_arguments`); ``get()``
+goes straight to the shard the key names; other queries go to the shards
+their ``WHERE`` clause pins down with ``=`` or ``IN`` on a shard key, and
+to every shard otherwise, with the results concatenated. Ordered, limited
+reads across shards, such as the home timeline, are gathered per shard and
+merged (`by_shard`, `Message.timeline`).
+
+Known limitations, which is why this is opt-in:
+
+* Foreign keys between shards (a like of, or a follow of, another shard's
+  row) aren't created, so they're not enforced and don't cascade: deleting
+  a message or user leaves other shards' likes and follows of it behind.
+* Joins only see rows on the same shard, so lists built by joining across
+  the relationship -- followers and following pages, likers, liked
+  messages, recommended users, trending -- only show same-shard rows.
+  ``Query.count()`` adds up the shards' counts; other aggregates over a
+  fanned-out query come back one row per shard.
+* Changes made through the many-to-many ``User.following`` collection are
+  written to shard "0"; app code adds and removes `Follows` rows instead.
+* Email addresses are unique per shard only.
+"""
+
+import zlib
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy import BaseQuery, SQLAlchemy
+from sqlalchemy import MetaData, create_engine, event, func, inspect, text
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+
+# Sharded table -> the columns whose value says which shard a row is on.
+# User and message ids are allocated to agree with their owner's shard.
+SHARD_KEYS = {
+    "users": ("id",),
+    "messages": ("user_id", "id"),
+    "likes": ("user_id",),
+    "follows": ("user_following_id",),
+}
+
+# Tables whose ids are allocated per shard by `next_id`.
+ALLOCATED_IDS = ("users", "messages")
+
+PRIMARY = "0"
+
+
+class ShardRouter:
+    """Decides which shard each row, lookup and query goes to."""
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.count = len(engines)
+
+    @classmethod
+    def from_app(cls, app, primary):
+        urls = [url.strip() for url in app.config["SHARD_DATABASE_URLS"].split(",")]
+        engines = {PRIMARY: primary}
+        options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        for number, url in enumerate(filter(None, urls), 1):
+            engines[str(number)] = create_engine(url, **options)
+        return cls(engines)
+
+    def shard_for(self, user_id):
+        return str(int(user_id) % self.count)
+
+    def shard_for_username(self, username):
+        return str(zlib.crc32(username.encode()) % self.count)
+
+    # ~~ Choosers for ShardedSession
+
+    def choose_for_instance(self, mapper, instance, clause=None):
+        table = mapper.local_table.name
+        if table not in SHARD_KEYS or instance is None:
+            return PRIMARY
+
+        key = SHARD_KEYS[table][0]
+        value = getattr(instance, mapper.get_property_by_column(mapper.c[key]).key)
+        if value is not None:
+            return self.shard_for(value)
+
+        if table == "users":
+            return self.shard_for_username(instance.username)
+
+        if table == "messages" and instance.user is not None:
+            return self.shard_for(instance.user.id)
+
+        raise ValueError(f"Can't tell which shard {instance!r} belongs on")
+
+    def choose_for_identity(self, query, ident):
+        mapper = inspect(query.column_descriptions[0]["entity"])
+        table = mapper.local_table.name
+        if table not in SHARD_KEYS:
+            return [PRIMARY]
+
+        for position, column in enumerate(mapper.primary_key):
+            if column.key in SHARD_KEYS[table]:
+                return [self.shard_for(ident[position])]
+
+        return list(self.engines)
+
+    def choose_for_statement(self, orm_context):
+        mapper = orm_context.bind_mapper
+        table = mapper.local_table.name if mapper is not None else None
+        if table not in SHARD_KEYS:
+            return [PRIMARY]
+
+        shards = self._shards_in_criteria(
+            orm_context.statement, table, orm_context.parameters or {}
+        )
+        return sorted(shards) if shards else list(self.engines)
+
+    def _shards_in_criteria(self, statement, table, params):
+        """Shards that ``key = value``/``key IN (...)`` criteria pin down.
+
+        Only looks at comparisons with values (given, or bound separately
+        in `params` as lazy loads do), anywhere in the statement.
+        """
+
+        keys = SHARD_KEYS[table]
+        shards = set()
+
+        # The whole statement, so criteria inside a count()'s subquery count.
+        for clause in visitors.iterate(statement):
+            if not isinstance(clause, BinaryExpression):
+                continue
+            column, value = clause.left, clause.right
+            if (
+                getattr(column, "table", None) is None
+                or column.table.name != table
+                or column.key not in keys
+                or not isinstance(value, BindParameter)
+            ):
+                continue
+
+            bound = params.get(value.key, value.effective_value)
+            if bound is None:
+                continue
+            if clause.operator is operators.eq:
+                shards.add(self.shard_for(bound))
+            elif clause.operator is operators.in_op:
+                shards.update(self.shard_for(v) for v in bound)
+
+        return shards
+
+    def session(self, **options):
+        return ShardedSession(
+            shard_chooser=self.choose_for_instance,
+            id_chooser=self.choose_for_identity,
+            execute_chooser=self.choose_for_statement,
+            shards=self.engines,
+            **options,
+        )
+
+    # ~~ Schema and ids
+
+    def create_all(self, metadata):
+        """Create every table on every shard, without cross-shard keys."""
+
+        shard_metadata = _without_cross_shard_keys(metadata)
+        for number, engine in self.engines.items():
+            shard_metadata.create_all(engine)
+            if engine.dialect.name == "postgresql":
+                with engine.begin() as conn:
+                    for table in ALLOCATED_IDS:
+                        self._step_sequence(conn, table, int(number))
+
+    def _step_sequence(self, conn, table, number):
+        # Make the serial hand out only ids that are `number` mod N.
+        seq = conn.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}
+        ).scalar()
+        last = conn.execute(text(f"SELECT max(id) FROM {table}")).scalar() or 0
+        start = self._next_after(last, number)
+        conn.execute(
+            text(f"ALTER SEQUENCE {seq} INCREMENT BY {self.count} RESTART WITH {start}")
+        )
+
+    def next_id(self, connection, table, shard):
+        """The next free id for `table` on `shard`, one that is `shard` mod N.
+
+        PostgreSQL sequences are stepped by `create_all`, so take one from
+        the sequence; elsewhere (SQLite, one writer) count up from the max.
+        """
+
+        if connection.dialect.name == "postgresql":
+            return connection.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id'))"),
+                {"table": table},
+            ).scalar()
+
+        last = connection.execute(text(f"SELECT max(id) FROM {table}")).scalar() or 0
+        # A flush allocates all its ids before inserting any of them.
+        allocated = connection.info.get(("last_id", table), 0)
+        next_id = self._next_after(max(last, allocated), int(shard))
+        connection.info[("last_id", table)] = next_id
+        return next_id
+
+    def _next_after(self, last, number):
+        # The smallest id above `last` that lands on shard `number`.
+        return last + 1 + (number - last - 1) % self.count
+
+
+def _without_cross_shard_keys(metadata):
+    """A copy of `metadata` keeping only the foreign keys within a shard.
+
+    Those are the ones from a sharded table's shard key to ``users.id``
+    (a message's author, a like's liker, a follow's follower).
+    """
+
+    copy = MetaData()
+    for table in metadata.sorted_tables:
+        table.to_metadata(copy)
+
+    for table in copy.tables.values():
+        keys = SHARD_KEYS.get(table.name, ())
+        for fk in list(table.foreign_keys):
+            local = fk.parent.key in keys and fk.column.table.name == "users"
+            if not local:
+                table.foreign_keys.discard(fk)
+                fk.parent.foreign_keys.discard(fk)
+                table.constraints.discard(fk.constraint)
+
+    return copy
+
+
+def router():
+    """The current app's `ShardRouter`, or None if it isn't sharded."""
+
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("shards")
+
+
+def bind_arguments(table, values):
+    """`Session.execute` bind arguments for a Core insert of `values`.
+
+    Core inserts don't go through the choosers, so this names the shard of
+    the row being inserted into `table` (nothing, unsharded).
+    """
+
+    shard_router = router()
+    if shard_router is None or table not in SHARD_KEYS:
+        return {}
+    return {"shard_id": shard_router.shard_for(values[SHARD_KEYS[table][0]])}
+
+
+def by_shard(user_ids):
+    """Group `user_ids` by shard: a list of (shard id, ids) pairs.
+
+    Unsharded, that's one group with shard id None.
+    """
+
+    shard_router = router()
+    if shard_router is None:
+        return [(None, list(user_ids))]
+
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_router.shard_for(user_id), []).append(user_id)
+    return sorted(groups.items())
+
+
+class ShardedQuery(BaseQuery):
+    """A query whose ``count()`` adds up one count per shard queried."""
+
+    def count(self):
+        col = func.count(text("*"))
+        rows = self._from_self(col).enable_eagerloads(False).all()
+        return sum(row[0] for row in rows)
+
+
+class ShardingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, whose sessions are sharded in sharded apps."""
+
+    def __init__(self, *args, query_class=ShardedQuery, **kwargs):
+        super().__init__(*args, query_class=query_class, **kwargs)
+
+    def create_session(self, options):
+        default = super().create_session(options)
+
+        def session_factory(**kwargs):
+            shard_router = router()
+            if shard_router is None:
+                return default(**kwargs)
+            return shard_router.session(**{**options, **kwargs})
+
+        return session_factory
+
+
+def _allocate_id(mapper, connection, target):
+    shard_router = router()
+    if shard_router is None or target.id is not None:
+        return
+    target.id = shard_router.next_id(
+        connection, mapper.local_table.name, inspect(target).identity_token
+    )
+
+
+def init_app(app, db):
+    """Shard `app`'s data if ``SHARD_DATABASE_URLS`` is set.
+
+    Call after `db` is connected to `app`. Adds the ``create-shards``
+    command, which creates the tables on every shard.
+    """
+
+    if not app.config.get("SHARD_DATABASE_URLS"):
+        return
+
+    with app.app_context():
+        primary = db.get_engine(app)
+    shard_router = ShardRouter.from_app(app, primary)
+    app.extensions["shards"] = shard_router
+
+    for mapper in db.Model.registry.mappers:
+        if mapper.local_table.name in ALLOCATED_IDS and not event.contains(
+            mapper, "before_insert", _allocate_id
+        ):
+            event.listen(mapper, "before_insert", _allocate_id)
+
+    @app.cli.command("create-shards")
+    def create_shards():
+        """Create the tables on every shard."""
+
+        shard_router.create_all(db.metadata)
@@ -0,0 +1,179 @@
+"""Cached, read-only views of the pages every viewer sees the same way.
+
+A snapshot is the viewer-independent part of a page, loaded through
+`cache.get_or_load` and stored as plain JSON. Snapshot objects have the
+attributes and ``count_*`` methods templates use on the models, so a page
+renders from either. Anything that depends on who's looking (follow and like
+buttons) is still worked out per request.
+
+Key families and what invalidates them:
+
+``profile:<user id>``
+    A user's profile header: their fields and the four counts. Tagged
+    ``user:<id>``, which writes to the user, their messages, likes and
+    follows (either side) bump.
+``message:<message id>``
+    A message, live or archived. Tagged ``message:<id>``; its author comes
+    from their ``profile`` snapshot.
+``directory:<after id>``
+    One `STREAM_BATCH`-sized chunk of the unfiltered user list, starting
+    after a user id. Tagged ``users``, which any user write bumps.
+
+Tags are bumped by the `invalidate` event consumer. Deleting a user makes
+no events for their likes, so the like counts it lowers on cached message
+pages can lag by up to a TTL.
+"""
+
+from datetime import datetime
+
+import events
+from cache import cache
+from models import Message, MessageArchive, User
+
+PROFILE_TTL = 60
+MESSAGE_TTL = 60
+DIRECTORY_TTL = 300
+
+USER_FIELDS = ("id", "username", "image_url", "header_image_url", "bio", "location")
+
+
+class UserSnapshot:
+    """A user, as a profile header or user card shows them."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    def count_messages(self):
+        return self.message_count
+
+    def count_following(self):
+        return self.following_count
+
+    def count_followers(self):
+        return self.follower_count
+
+    def count_likes(self):
+        return self.like_total
+
+
+class MessageSnapshot:
+    """A message, as the message page shows it; `user` is set by `message`."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self.timestamp = datetime.fromisoformat(fields["timestamp"])
+
+
+def _user_fields(user):
+    return {name: getattr(user, name) for name in USER_FIELDS}
+
+
+def profile(user_id):
+    """The profile header snapshot of user `user_id`, or None."""
+
+    def load():
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        return dict(
+            _user_fields(user),
+            message_count=user.count_messages(),
+            following_count=user.count_following(),
+            follower_count=user.count_followers(),
+            like_total=user.count_likes(),
+        )
+
+    fields = cache.get_or_load(
+        f"profile:{user_id}", load, PROFILE_TTL, tags=[f"user:{user_id}"]
+    )
+    return fields and UserSnapshot(fields)
+
+
+def message(message_id):
+    """The snapshot of live or archived message `message_id`, or None."""
+
+    def load():
+        msg = Message.query.get(message_id)
+        if msg is None:
+            msg = MessageArchive.query.filter_by(id=message_id).first()
+        if msg is None:
+            return None
+        return dict(
+            id=msg.id,
+            text=msg.text,
+            timestamp=msg.timestamp.isoformat(),
+            user_id=msg.user_id,
+            like_count=msg.like_count,
+            archived=msg.archived,
+        )
+
+    fields = cache.get_or_load(
+        f"message:{message_id}", load, MESSAGE_TTL, tags=[f"message:{message_id}"]
+    )
+    if fields is None:
+        return None
+
+    # The author comes from their own (tagged) snapshot, so renaming them
+    # needn't find every message they've posted.
+    author = profile(fields["user_id"])
+    if author is None:
+        return None
+
+    msg = MessageSnapshot(fields)
+    msg.user = author
+    return msg
+
+
+def directory(batch_size):
+    """Yield every user's snapshot, in id order, `batch_size` at a time."""
+
+    after = 0
+    while True:
+
+        def load():
+            users = (
+                User.query.filter(User.id > after)
+                .order_by(User.id)
+                .limit(batch_size)
+                .all()
+            )
+            return [_user_fields(user) for user in users]
+
+        batch = cache.get_or_load(
+            f"directory:{after}", load, DIRECTORY_TTL, tags=["users"]
+        )
+        for fields in batch:
+            yield UserSnapshot(fields)
+
+        if len(batch) < batch_size:
+            return
+        after = batch[-1]["id"]
+
+
+@events.consumer(
+    "user.created",
+    "user.updated",
+    "user.deleted",
+    "message.created",
+    "message.deleted",
+    "message.archived",
+    "like.created",
+    "like.deleted",
+    "follow.created",
+    "follow.deleted",
+)
+def invalidate(batch):
+    """Invalidate the snapshots a committed transaction's writes touched."""
+
+    tags = set()
+    for kind, data in batch:
+        if kind.startswith("user."):
+            tags.update([f"user:{data['id']}", "users"])
+        elif kind.startswith("message."):
+            tags.update([f"message:{data['id']}", f"user:{data['user_id']}"])
+        elif kind.startswith("like."):
+            tags.update([f"message:{data['message_id']}", f"user:{data['user_id']}"])
+        else:
+            tags.update([f"user:{data['follower_id']}", f"user:{data['followed_id']}"])
+
+    cache.invalidate(*tags)
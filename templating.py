@@ -0,0 +1,196 @@
+"""Template compilation caching and render profiling.
+
+Jinja compiles each template to Python the first time it is rendered, per
+process. Two things take that off the request path:
+
+* a ``FileSystemBytecodeCache`` in ``TEMPLATE_CACHE_DIR``, so a process that
+  has to load a template reads compiled bytecode instead of re-parsing the
+  source (the cache is keyed by a checksum of the source, so edits
+  invalidate it);
+* ``precompile()``, which loads every template up front. gunicorn.conf.py
+  calls it in the master process after the app is preloaded, so workers are
+  forked with every template already compiled.
+
+``stream_template()`` renders a template as a streamed response, for pages
+whose size grows with the data behind them.
+
+With ``PROFILE_TEMPLATES`` set, ``profiler`` records how long each template
+and each of its blocks take to render; ``profiler.report()`` summarises it.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from flask import (
+    Response,
+    before_render_template,
+    current_app,
+    stream_with_context,
+    template_rendered,
+)
+from jinja2 import FileSystemBytecodeCache
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "warbler-jinja-cache")
+
+# Jinja yields a chunk per template statement; send them in groups of this
+# many so a large page isn't written to the socket a few bytes at a time.
+STREAM_BUFFER = 50
+
+
+def precompile(app):
+    """Compile every template into `app`'s environment (and bytecode cache).
+
+    Returns the number of templates loaded.
+    """
+
+    env = app.jinja_env
+    names = env.list_templates(extensions=["html"])
+
+    for name in names:
+        env.get_template(name)
+
+    return len(names)
+
+
+def stream_template(template_name, **context):
+    """Render `template_name` as a streamed response.
+
+    The page is sent as it is generated, so the first bytes go out before
+    the last rows have been read. Pass iterators (e.g. a ``yield_per()``
+    query) rather than lists to keep memory flat; the template must loop
+    over them once, and so can't use ``length`` on them.
+
+    Runs inside the request context, so `g`, `session` and the database
+    session stay available until the last chunk is sent.
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        stream = template.stream(context)
+        stream.enable_buffering(STREAM_BUFFER)
+        yield from stream
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()))
+
+
+class _Timing:
+    __slots__ = ("count", "total")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+
+class RenderProfiler:
+    """Wall-clock time spent rendering each template and block."""
+
+    def __init__(self):
+        self.templates = defaultdict(_Timing)
+        self.blocks = defaultdict(_Timing)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connect(self, app):
+        before_render_template.connect(self._before_render, app, weak=False)
+        template_rendered.connect(self._rendered, app, weak=False)
+
+    def disconnect(self, app):
+        before_render_template.disconnect(self._before_render, app)
+        template_rendered.disconnect(self._rendered, app)
+
+    def _record(self, timings, key, elapsed):
+        with self._lock:
+            timing = timings[key]
+            timing.count += 1
+            timing.total += elapsed
+
+    def _time_block(self, key, render_block):
+        def timed_block(context):
+            started = time.perf_counter()
+            try:
+                yield from render_block(context)
+            finally:
+                self._record(self.blocks, key, time.perf_counter() - started)
+
+        timed_block.profiled = True
+        return timed_block
+
+    def _instrument(self, template):
+        for name, render_block in list(template.blocks.items()):
+            if not getattr(render_block, "profiled", False):
+                key = f"{template.name}:{name}"
+                template.blocks[name] = self._time_block(key, render_block)
+
+    def _before_render(self, app, template, context, **extra):
+        # Parent templates are loaded mid-render and never pass through this
+        # signal, so instrument everything already compiled as well.
+        for cached in list(app.jinja_env.cache.values()):
+            self._instrument(cached)
+        self._instrument(template)
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(time.perf_counter())
+
+    def _rendered(self, app, template, context, **extra):
+        started = self._local.stack.pop()
+        self._record(self.templates, template.name, time.perf_counter() - started)
+
+    def reset(self):
+        with self._lock:
+            self.templates.clear()
+            self.blocks.clear()
+
+    def report(self):
+        """A plain-text table of render timings, slowest total first."""
+
+        lines = [
+            f"{'template / block':<40} {'renders':>8} {'total ms':>10} {'mean ms':>8}"
+        ]
+
+        with self._lock:
+            for timings in (self.templates, self.blocks):
+                ranked = sorted(timings.items(), key=lambda item: -item[1].total)
+                for key, timing in ranked:
+                    lines.append(
+                        f"{key:<40} {timing.count:>8} "
+                        f"{timing.total * 1000:>10.2f} "
+                        f"{timing.total * 1000 / timing.count:>8.3f}"
+                    )
+
+        return "\n".join(lines)
+
+
+profiler = RenderProfiler()
+
+
+def init_app(app):
+    """Set up the bytecode cache and, if enabled, the render profiler.
+
+    Must run before anything touches `app.jinja_env`.
+    """
+
+    cache_dir = app.config.get("TEMPLATE_CACHE_DIR") or DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_options = {
+        **app.jinja_options,
+        "bytecode_cache": FileSystemBytecodeCache(cache_dir),
+    }
+
+    if app.config.get("PROFILE_TEMPLATES"):
+        profiler.connect(app)
+
+    @app.cli.command("compile-templates")
+    def compile_templates_command():
+        """Compile all templates into the bytecode cache."""
+
+        print(f"Compiled {precompile(app)} templates into {cache_dir}")
@@ -0,0 +1,141 @@
+"""Message archival tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archival.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import (
+    db,
+    LikeArchive,
+    Likes,
+    Message,
+    MessageArchive,
+    Notification,
+    User,
+)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import archival
+import archives
+
+db.create_all()
+
+
+class ArchivalTestCase(TestCase):
+    """Test moving old messages to the archive table."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.author = User(username="author", email="a@test.com", password="x")
+        self.reader = User(username="reader", email="r@test.com", password="x")
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        self.old = [
+            Message(
+                text=f"old {i}",
+                user_id=self.author.id,
+                timestamp=now - timedelta(days=400 + i),
+            )
+            for i in range(5)
+        ]
+        self.new = Message(text="new", user_id=self.author.id, timestamp=now)
+        db.session.add_all(self.old + [self.new])
+        db.session.commit()
+
+        db.session.add(
+            Likes(user_id=self.reader.id, message_being_liked_id=self.old[0].id)
+        )
+        Message.add_likes([self.old[0].id])
+        db.session.add(
+            Notification(
+                user_id=self.author.id,
+                kind="like",
+                message_id=self.old[0].id,
+                actor_id=self.reader.id,
+            )
+        )
+        db.session.commit()
+
+        self.cutoff = now - timedelta(days=365)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_archive_messages(self):
+        old_ids = [msg.id for msg in self.old]
+
+        self.assertEqual(archival.archive_messages(self.cutoff, batch_size=2), 5)
+
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(
+            sorted(row.id for row in MessageArchive.query), sorted(old_ids)
+        )
+        self.assertEqual(
+            MessageArchive.query.filter_by(id=old_ids[0]).one().like_count, 1
+        )
+        self.assertEqual(Likes.query.count(), 0)
+        archived_like = LikeArchive.query.one()
+        self.assertEqual(
+            (archived_like.user_id, archived_like.message_id),
+            (self.reader.id, old_ids[0]),
+        )
+        self.assertEqual(self.author.count_messages(), 6)
+        # Archived likes aren't counted, and their notifications are gone.
+        self.assertEqual(self.reader.count_likes(), 0)
+        self.assertEqual(Notification.query.count(), 0)
+
+        # Nothing left to do the second time round.
+        self.assertEqual(archival.archive_messages(self.cutoff), 0)
+
+    def test_archived_likes_are_exported(self):
+        timestamp = self.old[0].timestamp
+        archival.archive_messages(self.cutoff)
+
+        likes = [
+            row for row in archives.archive_rows(self.reader) if row["type"] == "like"
+        ]
+
+        self.assertEqual(len(likes), 1)
+        self.assertEqual(likes[0]["author"], "author")
+        self.assertEqual(likes[0]["timestamp"], timestamp.isoformat())
+
+    def test_show_archived_message(self):
+        old_id = self.old[0].id
+        new_id = self.new.id
+        reader_id = self.reader.id
+        archival.archive_messages(self.cutoff)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            resp = c.get(f"/messages/{old_id}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old 0", html)
+            self.assertIn("archived", html)
+            self.assertNotIn("/msg/like/", html)
+
+            resp = c.get(f"/messages/{new_id}")
+            self.assertIn("/msg/like/", resp.get_data(as_text=True))
+
+            resp = c.get("/messages/999999")
+            self.assertEqual(resp.status_code, 404)
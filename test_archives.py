@@ -0,0 +1,180 @@
+"""Archive export/import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archives.py
+
+
+import gzip
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Follows, Job, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import archives
+import jobs
+import notifications
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class ArchiveTestCase(TestCase):
+    """Test exporting an account and importing it elsewhere."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        app.config["ARCHIVE_DIR"] = self.archive_dir.name
+
+        self.alice = User(username="alice", email="a@test.com", password="x")
+        self.bob = User(username="bob", email="b@test.com", password="x")
+        self.carol = User(username="carol", email="c@test.com", password="x")
+        db.session.add_all([self.alice, self.bob, self.carol])
+        db.session.commit()
+
+        self.bob_msg = Message(text="bob says hi", user_id=self.bob.id)
+        db.session.add_all(
+            [Message(text=f"alice #{i}", user_id=self.alice.id) for i in range(5)]
+            + [self.bob_msg]
+        )
+        db.session.commit()
+
+        db.session.add_all(
+            [
+                Likes(user_id=self.alice.id, message_being_liked_id=self.bob_msg.id),
+                Follows(
+                    user_being_followed_id=self.bob.id,
+                    user_following_id=self.alice.id,
+                ),
+            ]
+        )
+        db.session.commit()
+
+        # Drop the event jobs the fixture's writes queued.
+        Job.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.pop("ARCHIVE_DIR")
+        self.archive_dir.cleanup()
+
+    def export(self, user):
+        buf = io.BytesIO()
+        archives.write_archive(user, buf)
+        buf.seek(0)
+        return buf
+
+    def test_export_rows(self):
+        buf = self.export(self.alice)
+
+        with gzip.open(buf, "rt") as f:
+            rows = [json.loads(line) for line in f]
+
+        self.assertEqual(rows[0]["type"], "user")
+        self.assertEqual(rows[0]["username"], "alice")
+        self.assertEqual(
+            [row["type"] for row in rows[1:]],
+            ["message"] * 5 + ["like", "follow"],
+        )
+        # Likes and follows name users and messages, not their ids.
+        self.assertEqual(rows[-2]["author"], "bob")
+        self.assertEqual(rows[-2]["timestamp"], self.bob_msg.timestamp.isoformat())
+        self.assertEqual(rows[-1]["username"], "bob")
+
+    def test_import_in_batches(self):
+        buf = self.export(self.alice)
+
+        counts = archives.import_archive(self.carol, buf, batch_size=2)
+        db.session.commit()
+
+        self.assertEqual(counts, {"message": 5, "like": 1, "follow": 1})
+        self.assertEqual(self.carol.count_messages(), 5)
+        self.assertTrue(self.carol.is_liking(self.bob_msg))
+        self.assertTrue(self.carol.is_following(self.bob))
+
+        # Each batch was committed with its own, bounded events jobs.
+        payloads = [job.payload for job in Job.query.filter_by(kind="events")]
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(p["events"]) <= 2 for p in payloads))
+
+        # Importing again doesn't duplicate likes or follows.
+        counts = archives.import_archive(self.carol, self.export(self.alice))
+        self.assertEqual(counts, {"message": 5, "like": 0, "follow": 0})
+
+    def test_import_emits_events(self):
+        bob_id = self.bob.id
+        archives.import_archive(self.carol, self.export(self.alice))
+        db.session.commit()
+        jobs.run_pending()
+
+        # bob hears that carol followed him and liked his warble.
+        self.assertEqual(notifications.unread_count(bob_id), 2)
+
+    def test_import_skips_own_and_missing_rows(self):
+        buf = self.export(self.alice)
+
+        # bob can't like his own message or follow himself.
+        counts = archives.import_archive(self.bob, buf)
+        self.assertEqual(counts["like"], 0)
+        self.assertEqual(counts["follow"], 0)
+
+    def test_import_rejects_other_files(self):
+        buf = io.BytesIO()
+        with gzip.open(buf, "wt") as f:
+            f.write('{"type": "message", "text": "hi"}\n')
+        buf.seek(0)
+
+        with self.assertRaises(ValueError):
+            archives.import_archive(self.carol, buf)
+
+    def test_exports_off_without_archive_dir(self):
+        app.config["ARCHIVE_DIR"] = None
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice.id
+
+            self.assertEqual(c.post("/users/archive").status_code, 404)
+            self.assertEqual(c.get("/users/archive").status_code, 404)
+
+    def test_export_job_and_download(self):
+        alice_id = self.alice.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = alice_id
+
+            resp = c.get("/users/archive")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/users/archive")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(jobs.run_pending(), 1)
+
+            resp = c.get("/users/archive")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                "warbler-alice.ndjson.gz", resp.headers["Content-Disposition"]
+            )
+
+            rows = list(archives.read_archive(io.BytesIO(resp.get_data())))
+            resp.close()
+            self.assertEqual(len(rows), 8)
@@ -0,0 +1,265 @@
+"""Cache tests: the cache itself, and the pages that read through it."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from cache import Cache, cache, init_app
+from sessions import MemoryStore
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class CacheTestCase(TestCase):
+    """Test the two tiers, invalidation, coalescing and early refresh."""
+
+    def setUp(self):
+        self.cache = Cache(MemoryStore())
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return {"n": self.loads}
+
+    def test_l1_then_l2(self):
+        self.assertEqual(self.cache.get_or_load("thing:1", self.load, 60), {"n": 1})
+        self.assertEqual(self.cache.get_or_load("thing:1", self.load, 60), {"n": 1})
+
+        # Another process: nothing local, but the shared store has it.
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get_or_load("thing:1", self.load, 60), {"n": 1})
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(
+            self.cache.report()["thing"],
+            dict(
+                l1_hits=1,
+                l2_hits=1,
+                misses=1,
+                early_refreshes=0,
+                coalesced=0,
+                hit_rate=0.667,
+            ),
+        )
+
+    def test_invalidate_by_tag(self):
+        self.cache.get_or_load("thing:1", self.load, 60, tags=["a", "b"])
+        self.cache.get_or_load("other:1", lambda: "untouched", 60, tags=["c"])
+
+        other = Cache(self.cache.store)
+        other.get_or_load("thing:1", self.load, 60, tags=["a", "b"])
+        self.cache.invalidate("b")
+
+        self.assertEqual(
+            self.cache.get_or_load("thing:1", self.load, 60, tags=["a", "b"]),
+            {"n": 2},
+        )
+        self.assertEqual(
+            self.cache.get_or_load("other:1", self.load, 60, tags=["c"]), "untouched"
+        )
+
+        # The other process's L1 copy lasts until its L1 TTL is up; after
+        # that it sees the reloaded value, without loading it again.
+        other.clear_local()
+        self.assertEqual(
+            other.get_or_load("thing:1", self.load, 60, tags=["a", "b"]), {"n": 2}
+        )
+        self.assertEqual(self.loads, 2)
+
+    def test_lost_tag_never_revives_stale_entries(self):
+        self.cache.get_or_load("thing:1", self.load, 60, tags=["a"])
+        self.cache.invalidate("a")
+        # The tag is evicted; its next version is a new one, not the first.
+        self.cache.store.delete(self.cache.tag_prefix + "a")
+        self.cache.clear_local()
+
+        self.assertEqual(
+            self.cache.get_or_load("thing:1", self.load, 60, tags=["a"]), {"n": 2}
+        )
+
+    def test_memory_store_is_bounded(self):
+        store = MemoryStore(max_keys=3)
+        for number in range(5):
+            store.set(f"key:{number}", number)
+
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.get("key:0"))
+        self.assertEqual(store.get("key:4"), 4)
+
+    def test_concurrent_misses_load_once(self):
+        def slow_load():
+            time.sleep(0.1)
+            return self.load()
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.get_or_load("slow:1", slow_load, 60)
+                )
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(results, [{"n": 1}] * 8)
+        self.assertEqual(self.cache.stats["slow"].coalesced, 7)
+
+    def test_keeps_another_process_lock(self):
+        # Another process holds the load lock and never finishes.
+        self.cache.store.set("cache-lock:slow:1", "theirs", ex=10, nx=True)
+
+        with patch("cache.LOCK_WAIT", 0.05):
+            self.assertEqual(self.cache.get_or_load("slow:1", self.load, 60), {"n": 1})
+
+        self.assertEqual(self.cache.store.get("cache-lock:slow:1"), "theirs")
+
+    def test_loads_when_lock_unavailable(self):
+        with patch.object(self.cache.store, "set", side_effect=ConnectionError):
+            self.assertEqual(self.cache.get_or_load("thing:1", self.load, 60), {"n": 1})
+
+    def test_refreshes_early_near_expiry(self):
+        self.cache.get_or_load("thing:1", self.load, 60)
+
+        # Pretend the value is nearly expired and took a long time to load.
+        key = self.cache.key_prefix + "thing:1"
+        self.cache.store.setex(
+            key,
+            60,
+            '{"value": {"n": 1}, "expires": %f, "delta": 30, "tags": {}}'
+            % (time.time() + 1),
+        )
+        self.cache.clear_local()
+
+        # A middling draw: well inside the 30s early-refresh window.
+        with patch("cache.random.random", return_value=0.5):
+            value = self.cache.get_or_load("thing:1", self.load, 60)
+        self.assertEqual(value, {"n": 2})
+        self.assertEqual(self.cache.stats["thing"].early_refreshes, 1)
+
+    def test_disabled_always_loads(self):
+        disabled = Cache()
+        disabled.get_or_load("thing:1", self.load, 60)
+        disabled.get_or_load("thing:1", self.load, 60)
+
+        self.assertEqual(self.loads, 2)
+
+
+class CacheBackendTestCase(TestCase):
+    """Test which store each configuration gets."""
+
+    def tearDown(self):
+        cache.enabled = False
+
+    def configure(self, **config):
+        app = Flask(__name__)
+        app.config.update(config)
+        init_app(app)
+        return cache.enabled
+
+    def test_off_without_a_shared_store(self):
+        self.assertFalse(self.configure())
+        self.assertFalse(
+            self.configure(CACHE_BACKEND="memory", SHARED_STORES_REQUIRED=True)
+        )
+
+    def test_memory_when_asked_for(self):
+        self.assertTrue(self.configure(CACHE_BACKEND="memory"))
+        self.assertFalse(cache.shared)
+
+
+class CachedPagesTestCase(TestCase):
+    """Test that model writes invalidate the cached pages."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.author = User.signup("author", "a@test.com", "password", None)
+        self.reader = User.signup("reader", "r@test.com", "password", None)
+        db.session.commit()
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+
+        msg = Message(text="cached warble", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        cache.configure(MemoryStore())
+        self.client = app.test_client()
+
+    def tearDown(self):
+        cache.enabled = False
+        db.session.rollback()
+
+    def test_profile_header(self):
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertIn("@author", resp.get_data(as_text=True))
+
+        author = User.query.get(self.author_id)
+        author.bio = "Now with a bio"
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertIn("Now with a bio", resp.get_data(as_text=True))
+        self.assertEqual(cache.stats["profile"].misses, 2)
+
+    def test_message_like_count(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+        self.client.get(f"/messages/{self.msg_id}")
+        self.client.post(f"/msg/like/{self.msg_id}")
+
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertIn("1 likes", resp.get_data(as_text=True))
+
+        # No Referer: the view falls back to the homepage.
+        resp = self.client.post(f"/msg/stop-liking/{self.msg_id}")
+        self.assertEqual(resp.status_code, 302)
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertNotIn("1 likes", resp.get_data(as_text=True))
+
+    def test_directory(self):
+        self.client.get("/users")
+        User.signup("newcomer", "n@test.com", "password", None)
+        db.session.commit()
+
+        resp = self.client.get("/users")
+        self.assertIn("@newcomer", resp.get_data(as_text=True))
+
+    def test_deleted_message_404s(self):
+        self.assertEqual(self.client.get(f"/messages/{self.msg_id}").status_code, 200)
+
+        db.session.delete(Message.query.get(self.msg_id))
+        db.session.commit()
+
+        self.assertEqual(self.client.get(f"/messages/{self.msg_id}").status_code, 404)
@@ -0,0 +1,152 @@
+"""Concurrent write tests: idempotent likes and follows, retries, versions."""
+
+# run these tests like:
+#
+#    python -m unittest test_concurrency.py
+
+
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+
+from models import db, Follows, Likes, Message, User
+import models
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class ConcurrentWritesTestCase(TestCase):
+    """Test that racing writes to the same rows neither fail nor double up."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.author = User.signup("author", "a@test.com", "password", None)
+        self.fan = User.signup("fan", "f@test.com", "password", None)
+        db.session.flush()
+        msg = Message(text="popular", user_id=self.author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.fan_id = self.fan.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def hammer(self, path, threads=8):
+        """POST `path` as the fan from `threads` clients at once."""
+
+        statuses = []
+        start = threading.Barrier(threads)
+
+        def post():
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+            start.wait()
+            statuses.append(client.post(path).status_code)
+
+        workers = [threading.Thread(target=post) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return statuses
+
+    def test_likes_are_idempotent(self):
+        statuses = self.hammer(f"/msg/like/{self.msg_id}")
+
+        self.assertEqual(statuses, [302] * 8)
+        db.session.expire_all()
+        self.assertEqual(Likes.query.filter_by(user_id=self.fan_id).count(), 1)
+        self.assertEqual(Message.query.get(self.msg_id).like_count, 1)
+
+    def test_follows_are_idempotent(self):
+        statuses = self.hammer(f"/users/follow/{self.author_id}")
+
+        self.assertEqual(statuses, [302] * 8)
+        self.assertEqual(
+            Follows.query.filter_by(user_following_id=self.fan_id).count(), 1
+        )
+
+    def test_insert_if_absent(self):
+        self.assertIsNotNone(Likes.add(self.fan_id, self.msg_id))
+        self.assertIsNone(Likes.add(self.fan_id, self.msg_id))
+        db.session.commit()
+
+    def test_retry_on_conflict(self):
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("UPDATE", {}, Exception("database is locked"))
+            return "done"
+
+        with patch.object(models, "is_retryable", return_value=True), patch.object(
+            models, "RETRY_BACKOFF", 0
+        ):
+            self.assertEqual(models.retry_on_conflict(flaky), "done")
+        self.assertEqual(len(calls), 3)
+
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            models.retry_on_conflict(flaky)
+        self.assertEqual(len(calls), 1)
+
+    def test_stale_profile_edit(self):
+        mine = User.query.get(self.fan_id)
+        mine.bio = "mine"
+
+        # Someone else's edit lands between our read and our write.
+        db.session.execute(
+            text("UPDATE users SET version_id = version_id + 1 WHERE id = :id"),
+            {"id": self.fan_id},
+        )
+
+        with self.assertRaises(StaleDataError):
+            db.session.commit()
+
+    def test_profile_form_from_before_an_edit(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+        User.query.get(self.fan_id).bio = "changed elsewhere"
+        db.session.commit()
+
+        resp = client.post(
+            "/users/profile",
+            data={
+                "username": "fan",
+                "email": "f@test.com",
+                "password": "password",
+                "bio": "mine",
+                "version_id": "1",
+            },
+        )
+
+        self.assertEqual(resp.location.rsplit("/", 2)[-2:], ["users", "profile"])
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.fan_id).bio, "changed elsewhere")
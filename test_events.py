@@ -0,0 +1,124 @@
+"""Domain event tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Job, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import events
+import jobs
+
+db.create_all()
+
+
+class EventsTestCase(TestCase):
+    """Test capture, in-process delivery and the outbox."""
+
+    def setUp(self):
+        User.query.delete()
+        Job.query.delete()
+        db.session.commit()
+
+        self.seen = []
+        self.durable_seen = []
+
+        @events.consumer("user.created", "message.created", "follow.created")
+        def record(batch):
+            self.seen.append(batch)
+
+        @events.consumer("like.created", "like.deleted", durable=True)
+        def record_durable(batch):
+            self.durable_seen.append(batch)
+
+        self.names = [
+            f"{__name__}.{fn.__qualname__}" for fn in (record, record_durable)
+        ]
+
+        self.alice = User(username="alice", email="a@test.com", password="x")
+        self.bob = User(username="bob", email="b@test.com", password="x")
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        for name in self.names:
+            events.CONSUMERS.pop(name)
+
+    def test_delivered_once_per_commit(self):
+        self.assertEqual(
+            [kind for kind, _ in self.seen[0]], ["user.created", "user.created"]
+        )
+
+        msg = Message(text="hello", user_id=self.alice.id)
+        db.session.add(msg)
+        db.session.flush()
+        self.alice.following.append(self.bob)
+        db.session.commit()
+
+        self.assertEqual(
+            self.seen[1],
+            [
+                events.Event(
+                    "message.created",
+                    {
+                        "id": msg.id,
+                        "user_id": self.alice.id,
+                        "timestamp": msg.timestamp.isoformat(),
+                    },
+                ),
+                events.Event(
+                    "follow.created",
+                    {"follower_id": self.alice.id, "followed_id": self.bob.id},
+                ),
+            ],
+        )
+
+    def test_rollback_discards(self):
+        db.session.add(Message(text="never mind", user_id=self.alice.id))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertEqual(len(self.seen), 1)
+
+    def test_durable_through_outbox(self):
+        msg = Message(text="likeable", user_id=self.alice.id)
+        db.session.add(msg)
+        db.session.commit()
+        Job.query.delete()
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.bob.id, message_being_liked_id=msg.id))
+        db.session.commit()
+
+        # Bulk deletes are invisible to flush; they emit their own.
+        Likes.query.delete()
+        events.emit(db.session, "like.deleted", user_id=self.bob.id, message_id=msg.id)
+        db.session.commit()
+
+        # One job per transaction per consumer (trending takes likes too).
+        queued = [job.payload["consumer"] for job in Job.query.order_by(Job.id)]
+        self.assertEqual(queued.count(self.names[1]), 2)
+        self.assertEqual(self.durable_seen, [])
+
+        # The worker delivers both transactions' events in one batch.
+        jobs.run_pending()
+        self.assertEqual(
+            [[kind for kind, _ in batch] for batch in self.durable_seen],
+            [["like.created", "like.deleted"]],
+        )
@@ -0,0 +1,112 @@
+"""In-memory follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from graph import FollowGraph, intersect_sorted
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test lookups and incremental updates on the CSR graph."""
+
+    def setUp(self):
+        self.graph = FollowGraph()
+        # 1 -> 2, 1 -> 3, 2 -> 3, 4 -> 1, 4 -> 3
+        self.graph.load([(1, 2), (1, 3), (2, 3), (4, 1), (4, 3)])
+
+    def test_lookups(self):
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(99, 1))
+
+        self.assertEqual(list(self.graph.following(4)), [1, 3])
+        self.assertEqual(list(self.graph.followers(3)), [1, 2, 4])
+        self.assertEqual(self.graph.count_following(1), 2)
+        self.assertEqual(self.graph.count_followers(3), 3)
+        self.assertEqual(self.graph.count_followers(99), 0)
+
+    def test_intersections(self):
+        self.assertEqual(self.graph.common_following(1, 4), [3])
+        self.assertEqual(self.graph.followed_by_followers_of(1, 3), [2])
+        self.assertEqual(intersect_sorted([1, 4, 6, 9], [2, 4, 9, 10]), [4, 9])
+
+    def test_incremental_updates(self):
+        self.graph.add(3, 1)
+        self.graph.remove(1, 2)
+
+        self.assertTrue(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(list(self.graph.following(1)), [3])
+        self.assertEqual(list(self.graph.followers(1)), [3, 4])
+        self.assertEqual(self.graph.count_following(3), 1)
+        self.assertEqual(self.graph.count_followers(2), 0)
+
+        self.graph.add(1, 2)
+        self.assertTrue(self.graph.is_following(1, 2))
+        self.assertEqual(self.graph.count_following(1), 2)
+
+    def test_changes_during_load_are_kept(self):
+        graph = FollowGraph()
+
+        def edges():
+            yield (1, 2)
+            # Committed after the table was read past these rows.
+            graph.add(1, 3)
+            graph.remove(1, 2)
+            yield (2, 3)
+
+        graph.load(edges())
+
+        self.assertEqual(list(graph.following(1)), [3])
+        self.assertEqual(list(graph.followers(3)), [1, 2])
+
+    def test_updates_before_load_are_ignored(self):
+        graph = FollowGraph()
+        graph.add(1, 2)
+        self.assertFalse(graph.loaded)
+        self.assertEqual(graph.nbytes(), 0)
+
+
+class FollowGraphResyncTestCase(TestCase):
+    """Test loading the graph from the follows table."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        u1 = User.signup("graph1", "graph1@test.com", "password", None)
+        u2 = User.signup("graph2", "graph2@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load_from_db(self):
+        graph = FollowGraph().ensure_fresh()
+
+        self.assertTrue(graph.is_following(self.u1_id, self.u2_id))
+        self.assertFalse(graph.is_following(self.u2_id, self.u1_id))
+        self.assertFalse(graph.needs_resync())
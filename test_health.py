@@ -0,0 +1,91 @@
+"""Liveness and readiness endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_health.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import health
+
+db.create_all()
+
+
+class HealthEndpointsTestCase(TestCase):
+    """Test that probes are answered in front of the app."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.extensions["readiness"]._checked = None
+
+    def test_healthz(self):
+        resp = self.client.get("/healthz")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"ok")
+        # No before_request hooks ran, so no session was started.
+        self.assertNotIn("Set-Cookie", resp.headers)
+
+    def test_readyz_pings_the_database(self):
+        resp = self.client.get("/readyz")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"ready")
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+    def test_other_methods(self):
+        self.assertEqual(self.client.post("/healthz").status_code, 405)
+        self.assertEqual(self.client.head("/readyz").status_code, 200)
+
+
+class ReadinessTestCase(TestCase):
+    """Test caching and timeboxing of the readiness ping."""
+
+    def test_result_is_cached(self):
+        pings = []
+        readiness = health.Readiness(lambda: pings.append(1), ttl=60)
+
+        self.assertEqual(readiness.check(), (True, "ready"))
+        self.assertEqual(readiness.check(), (True, "ready"))
+        self.assertEqual(len(pings), 1)
+
+    def test_slow_ping_is_not_ready(self):
+        release = threading.Event()
+        pings = []
+
+        def ping():
+            pings.append(1)
+            release.wait()
+
+        readiness = health.Readiness(ping, ttl=0, timeout=0.05)
+        try:
+            self.assertFalse(readiness.check()[0])
+            # The stuck ping is waited on again, not joined by another.
+            self.assertFalse(readiness.check()[0])
+            self.assertEqual(len(pings), 1)
+        finally:
+            release.set()
+
+    def test_failed_ping_is_not_ready(self):
+        def ping():
+            raise ConnectionError("no database")
+
+        ready, reason = health.Readiness(ping).check()
+
+        self.assertFalse(ready)
+        self.assertEqual(reason, "database unavailable: ConnectionError")
@@ -0,0 +1,216 @@
+"""Image proxy and cache tests, against a local stand-in image host."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import http.client
+import io
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from flask import Flask, render_template_string
+
+import images
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def make_png(width, height):
+    """A solid grey PNG, built without any imaging library."""
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    rows = b"".join(b"\x00" + b"\x80\x80\x80" * width for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+class ImageHost(BaseHTTPRequestHandler):
+    """Serves /avatar.png; anything else is a 404. Counts requests."""
+
+    body = make_png(400, 300)
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path != "/avatar.png":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test URL signing, fetching once, resizing and serving."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHost)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ImageHost.hits.clear()
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+        self.app = Flask(__name__)
+        self.app.config.update(
+            SECRET_KEY="test",
+            IMAGE_CACHE_DIR=self.cache_dir.name,
+            IMAGE_PROXY_ALLOW_PRIVATE=True,
+        )
+        images.init_app(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def proxied(self, url, variant="thumb"):
+        with self.app.test_request_context():
+            return render_template_string(
+                "{{ url | image(variant) }}", url=url, variant=variant
+            )
+
+    def test_filter_rewrites_external_urls_only(self):
+        self.assertTrue(self.proxied(f"{self.base_url}/avatar.png").startswith("/img/"))
+        self.assertEqual(
+            self.proxied("/static/images/default-pic.png"),
+            "/static/images/default-pic.png",
+        )
+
+    def test_fetches_once_and_caches(self):
+        url = self.proxied(f"{self.base_url}/avatar.png")
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        self.assertIsNotNone(images.sniff_type(resp.get_data()))
+
+        # Another variant of the same image reuses the cached original.
+        self.client.get(self.proxied(f"{self.base_url}/avatar.png", "avatar"))
+        self.client.get(url, headers={"Accept": "image/webp,*/*"})
+        self.client.get(url)
+        self.assertEqual(ImageHost.hits, ["/avatar.png"])
+
+    @skipUnless(Image, "needs Pillow")
+    def test_resizes_and_serves_webp(self):
+        url = self.proxied(f"{self.base_url}/avatar.png")
+
+        resp = self.client.get(url)
+        with Image.open(io.BytesIO(resp.get_data())) as img:
+            self.assertLessEqual(max(img.size), 96)
+
+        resp = self.client.get(url, headers={"Accept": "image/webp,*/*"})
+        self.assertEqual(resp.mimetype, "image/webp")
+        self.assertIn("Accept", resp.headers["Vary"])
+
+    def test_bad_token_and_broken_images(self):
+        self.assertEqual(self.client.get("/img/thumb/forged").status_code, 404)
+
+        missing = f"{self.base_url}/missing.png"
+        resp = self.client.get(self.proxied(missing))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.headers["Location"], missing)
+
+        # The failure is remembered, for every variant.
+        resp = self.client.get(self.proxied(missing, "avatar"))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(ImageHost.hits, ["/missing.png"])
+
+    def test_refuses_private_addresses(self):
+        with self.assertRaises(ValueError):
+            images.fetch(f"{self.base_url}/avatar.png")
+        with self.assertRaises(ValueError):
+            images.fetch("file:///etc/passwd", allow_private=True)
+
+    def test_connects_to_the_checked_address(self):
+        public = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("93.184.216.34", 443))]
+        with patch("images.socket.getaddrinfo", return_value=public) as lookup:
+            address = images._check_host("https://img.example/a.png", False)
+        self.assertEqual(address, "93.184.216.34")
+        self.assertEqual(lookup.call_args[0][:2], ("img.example", 443))
+
+        # A pinned connection ignores what the name resolves to now.
+        port = self.server.server_port
+        connection = images._pinned(http.client.HTTPConnection, "127.0.0.1")
+        conn = connection(f"img.example:{port}", timeout=5)
+        conn.request("GET", "/avatar.png")
+        self.assertEqual(conn.getresponse().status, 200)
+        conn.close()
+
+
+class ImageCacheTestCase(TestCase):
+    """Test content addressing and LRU eviction."""
+
+    # Room for four or five small files.
+    MAX_BYTES = 5 * images.FILE_OVERHEAD
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = images.ImageCache(self.cache_dir.name, max_bytes=self.MAX_BYTES)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_same_content_stored_once(self):
+        first = self.cache.put("a", "image/png", b"x" * 100)
+        second = self.cache.put("b", "image/png", b"x" * 100)
+
+        self.assertEqual(first, second)
+        # One image and two refs of "image/png <sha256>".
+        self.assertEqual(self.cache.size(), 100 + 2 * 74 + 3 * images.FILE_OVERHEAD)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", "image/png", b"a" * 100)
+        self.cache.put("b", "image/png", b"b" * 100)
+
+        # Make "a" the most recently used.
+        old = time.time() - 60
+        os.utime(self.cache.get("b")[1], (old, old))
+        os.utime(self.cache.get("a")[1], (old, old))
+        self.cache.get("a")
+
+        self.cache.put("c", "image/png", b"c" * 100)
+
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("c"))
+        self.assertLessEqual(self.cache.size(), self.MAX_BYTES)
+
+    def test_failure_markers_are_evicted(self):
+        for number in range(20):
+            self.cache.mark_failed(f"src:http://example.com/{number}.png")
+
+        self.assertLessEqual(self.cache.size(), self.MAX_BYTES)
+        self.assertTrue(self.cache.failed_recently("src:http://example.com/19.png", 60))
@@ -0,0 +1,131 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import jobs
+
+db.create_all()
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, running and retrying jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+
+        self.calls = []
+
+        @jobs.handler("test_ok")
+        def record(**payload):
+            self.calls.append(payload)
+
+        @jobs.handler("test_boom")
+        def boom(**payload):
+            raise ValueError("boom")
+
+        @jobs.handler("test_batched", batched=True)
+        def batched(payloads):
+            if any(p.get("boom") for p in payloads):
+                raise ValueError("boom")
+            self.calls.append(payloads)
+
+    def tearDown(self):
+        db.session.rollback()
+        jobs.HANDLERS.pop("test_ok", None)
+        jobs.HANDLERS.pop("test_boom", None)
+        jobs.HANDLERS.pop("test_batched", None)
+        jobs.BATCHED.discard("test_batched")
+
+    def test_enqueue_and_run(self):
+        jobs.enqueue("test_ok", message_id=7)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.calls, [{"message_id": 7}])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_enqueue_needs_a_handler(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue("test_unhandled")
+
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_uncommitted_job_is_not_run(self):
+        jobs.enqueue("test_ok", message_id=7)
+        db.session.rollback()
+
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(self.calls, [])
+
+    def test_failed_job_is_retried_later(self):
+        jobs.enqueue("test_boom")
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, jobs.JOB_QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+    def test_job_fails_after_max_attempts(self):
+        job = jobs.enqueue("test_boom")
+        job.attempts = jobs.MAX_ATTEMPTS - 1
+        db.session.commit()
+
+        jobs.run_pending()
+
+        job = Job.query.one()
+        self.assertEqual(job.status, jobs.JOB_FAILED)
+        self.assertEqual(job.attempts, jobs.MAX_ATTEMPTS)
+
+    def test_batches_respect_size(self):
+        for i in range(5):
+            jobs.enqueue("test_ok", n=i)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_batch(size=2), 2)
+        self.assertEqual(jobs.run_pending(size=2), 3)
+        self.assertEqual([c["n"] for c in self.calls], [0, 1, 2, 3, 4])
+
+    def test_batched_handler_gets_jobs_together(self):
+        for i in range(3):
+            jobs.enqueue("test_batched", n=i)
+        jobs.enqueue("test_ok", n=3)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 4)
+        self.assertEqual(self.calls, [[{"n": 0}, {"n": 1}, {"n": 2}], {"n": 3}])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_failed_batch_runs_one_at_a_time(self):
+        jobs.enqueue("test_batched", n=0)
+        jobs.enqueue("test_batched", boom=True)
+        jobs.enqueue("test_batched", n=2)
+        db.session.commit()
+
+        jobs.run_pending()
+
+        self.assertEqual(self.calls, [[{"n": 0}], [{"n": 2}]])
+        self.assertEqual(Job.query.one().payload, {"boom": True})
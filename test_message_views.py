@@ -189,3 +189,28 @@ class MessageViewTestCase(TestCase):
             # html_user_show_page = response_user_show_page.get_data(as_text=True)
 
             # self.assertNotIn("DeleteMePlease</p>", html_user_show_page)
+
+    def test_like_count_and_likers(self):
+        """Do likes keep the message's count, and list on its likes page?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/msg/like/{self.testmsg2_id}")
+            c.post(f"/msg/like/{self.testmsg2_id}")
+            self.assertEqual(Message.query.get(self.testmsg2_id).like_count, 1)
+
+            resp = c.get(f"/messages/{self.testmsg2_id}/likes")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Liked by 1", html)
+            self.assertIn("@testuser</p>", html)
+
+            for page in (0, -1):
+                resp = c.get(f"/messages/{self.testmsg2_id}/likes?page={page}")
+                self.assertEqual(resp.status_code, 404)
+
+            c.post(f"/msg/stop-liking/{self.testmsg2_id}", headers={"Referer": "/"})
+            c.post(f"/msg/stop-liking/{self.testmsg2_id}", headers={"Referer": "/"})
+            self.assertEqual(Message.query.get(self.testmsg2_id).like_count, 0)
@@ -0,0 +1,170 @@
+"""Metrics registry, multiprocess aggregation and /metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import metrics
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+def dead_pid():
+    """The pid of a process that has exited."""
+
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+class RegistryTestCase(TestCase):
+    """Test the metric types and the text format."""
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_exposition(self):
+        requests = metrics.Counter(
+            "requests_total", "Requests.", ["path"], registry=self.registry
+        )
+        latency = metrics.Histogram(
+            "latency_seconds", "Latency.", buckets=(0.1, 1), registry=self.registry
+        )
+        requests.inc('/a"b')
+        requests.inc('/a"b', amount=2)
+        for seconds in (0.05, 0.5, 5):
+            latency.observe(seconds)
+
+        self.assertEqual(
+            self.registry.exposition(),
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 1\n'
+            'latency_seconds_bucket{le="1.0"} 2\n'
+            'latency_seconds_bucket{le="+Inf"} 3\n'
+            "latency_seconds_sum 5.55\n"
+            "latency_seconds_count 3\n"
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{path="/a\\"b"} 3.0\n',
+        )
+
+    def test_unlabelled_metrics_start_at_zero(self):
+        metrics.Gauge("busy", "Busy.", registry=self.registry)
+
+        self.assertIn("busy 0.0\n", self.registry.exposition())
+
+    def test_workers_add_up(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        workers = []
+        for pid in (os.getpid(), dead_pid()):
+            registry = metrics.Registry()
+            registry.directory = directory.name
+            registry.pid = pid
+            metrics.Counter("hits_total", "Hits.", registry=registry).inc(amount=2)
+            metrics.Gauge("busy", "Busy.", registry=registry).inc()
+            registry.flush()
+            workers.append(registry)
+
+        live, dead = workers
+        # The exited worker's gauge no longer counts; its counts do.
+        self.assertIn("hits_total 4.0\n", live.exposition())
+        self.assertIn("busy 1.0\n", live.exposition())
+
+        live.mark_process_dead(dead.pid)
+        self.assertFalse(
+            os.path.exists(os.path.join(directory.name, f"{dead.pid}.json"))
+        )
+        self.assertIn("hits_total 4.0\n", live.exposition())
+
+
+class MetricsEndpointTestCase(TestCase):
+    """Test what the app reports at /metrics."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup("poster", "poster@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def scrape(self):
+        return self.client.get("/metrics").get_data(as_text=True)
+
+    def test_requests_and_queries_are_counted(self):
+        before = metrics.http_requests.snapshot()
+        self.client.get("/login")
+
+        self.assertNotEqual(metrics.http_requests.snapshot(), before)
+        body = self.scrape()
+        self.assertIn(
+            'warbler_http_requests_total{endpoint="warbler.login",method="GET"', body
+        )
+        self.assertIn('warbler_db_query_duration_seconds_count{engine="0"', body)
+        self.assertIn("warbler_bcrypt_duration_seconds_count", body)
+
+        # Scrapes aren't requests.
+        before = metrics.http_requests.snapshot()
+        self.scrape()
+        self.assertEqual(metrics.http_requests.snapshot(), before)
+
+    def test_business_counters(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        posted = metrics.warbles_posted.snapshot()[0][1]
+        self.client.post("/messages/new", data={"text": "counted"})
+
+        self.assertEqual(metrics.warbles_posted.snapshot()[0][1], posted + 1)
+
+    def test_token(self):
+        endpoint = metrics.MetricsMiddleware(None, metrics.Registry(), "s3cret")
+
+        def get(headers):
+            statuses = []
+            environ = {"PATH_INFO": "/metrics", **headers}
+            endpoint(environ, lambda status, headers: statuses.append(status))
+            return statuses[0]
+
+        self.assertEqual(get({}), "403 FORBIDDEN")
+        self.assertEqual(get({"HTTP_AUTHORIZATION": "Bearer s3cret"}), "200 OK")
+
+    def test_token_required(self):
+        endpoint = metrics.MetricsMiddleware(
+            None, metrics.Registry(), token_required=True
+        )
+        statuses = []
+        endpoint(
+            {"PATH_INFO": "/metrics"}, lambda status, headers: statuses.append(status)
+        )
+
+        self.assertEqual(statuses, ["403 FORBIDDEN"])
@@ -0,0 +1,139 @@
+"""Notification inbox tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, insert_if_absent, User, Message, Job, Notification
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import notifications
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class NotificationsTestCase(TestCase):
+    """Test coalescing, unread counts and the /notifications page."""
+
+    def setUp(self):
+        User.query.delete()
+        Job.query.delete()
+        db.session.commit()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        fans = [
+            User.signup(f"fan{i}", f"fan{i}@test.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.commit()
+        self.author_id = author.id
+        self.fan_ids = [fan.id for fan in fans]
+
+        msg = Message(text="notable", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_likes_and_follows_coalesce(self):
+        for fan_id in self.fan_ids:
+            client = self.client_for(fan_id)
+            client.post(f"/msg/like/{self.msg_id}")
+            client.post(f"/users/follow/{self.author_id}")
+
+        # Nothing is written until the worker runs.
+        self.assertEqual(notifications.unread_count(self.author_id), 0)
+        jobs.run_pending()
+
+        inbox = notifications.inbox(self.author_id)
+        self.assertEqual(
+            sorted((n.kind, n.actor_count, n.actor_id) for n in inbox),
+            [("follow", 3, self.fan_ids[-1]), ("like", 3, self.fan_ids[-1])],
+        )
+        self.assertEqual(notifications.unread_count(self.author_id), 2)
+
+    def test_read_notifications_start_a_new_row(self):
+        notifications.record([(self.author_id, "follow", None, self.fan_ids[0])])
+        db.session.commit()
+
+        notifications.mark_read(self.author_id)
+        notifications.record([(self.author_id, "follow", None, self.fan_ids[1])])
+        db.session.commit()
+
+        self.assertEqual(Notification.query.filter_by(unread=True).count(), 1)
+        self.assertEqual(notifications.unread_count(self.author_id), 1)
+
+    def test_one_unread_row_per_group(self):
+        notifications.record([(self.author_id, "follow", None, self.fan_ids[0])])
+        db.session.commit()
+
+        # What a second worker racing the first would try to insert.
+        inserted = insert_if_absent(
+            Notification,
+            user_id=self.author_id,
+            kind="follow",
+            actor_id=self.fan_ids[1],
+            actor_count=1,
+            unread=True,
+            updated_at=datetime.utcnow(),
+        )
+        self.assertFalse(inserted)
+
+        notifications.record([(self.author_id, "follow", None, self.fan_ids[1])])
+        db.session.commit()
+        self.assertEqual(
+            [(n.actor_count, n.actor_id) for n in notifications.inbox(self.author_id)],
+            [(2, self.fan_ids[1])],
+        )
+        self.assertEqual(notifications.unread_count(self.author_id), 1)
+
+    def test_own_actions_are_not_notified(self):
+        notifications.record([(self.author_id, "like", self.msg_id, self.author_id)])
+        db.session.commit()
+
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_page_shows_and_marks_read(self):
+        notifications.record(
+            [(self.author_id, "like", self.msg_id, fan_id) for fan_id in self.fan_ids]
+        )
+        db.session.commit()
+
+        client = self.client_for(self.author_id)
+        self.assertIn(b'<span class="badge bg-danger">1</span>', client.get("/").data)
+
+        html = client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan2", html)
+        self.assertIn("and 2 others", html)
+        self.assertIn("list-group-item-info", html)
+
+        db.session.expire_all()
+        self.assertEqual(notifications.unread_count(self.author_id), 0)
+        self.assertNotIn(
+            "list-group-item-info", client.get("/notifications").data.decode()
+        )
@@ -0,0 +1,155 @@
+"""Sampling profiler, per-request profiling and structured logging tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+import logs
+import profiling
+
+
+def make_app(profile_dir):
+    """A bare app with profiling installed, so no database is needed."""
+
+    app = Flask(__name__)
+    app.config.update(
+        PROFILE_TOKEN="s3cret",
+        PROFILE_SAMPLING=True,
+        PROFILE_DIR=profile_dir,
+    )
+    profiling.init_app(app)
+
+    @app.get("/busy")
+    def busy():
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return "done"
+
+    return app
+
+
+class SamplingProfilerTestCase(TestCase):
+    """Test stack sampling and folding."""
+
+    def test_samples_only_request_threads(self):
+        sampler = profiling.SamplingProfiler()
+        entered = threading.Event()
+        release = threading.Event()
+
+        def serve():
+            sampler.enter("warbler.busy")
+            entered.set()
+            release.wait()
+            sampler.exit()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        entered.wait()
+        sampler.sample()
+        release.set()
+        thread.join()
+        sampler.sample()
+
+        self.assertEqual(sampler.samples, 1)
+        [(stack, count)] = sampler.stacks.items()
+        self.assertEqual(count, 1)
+        self.assertTrue(stack.startswith("warbler.busy;"))
+        self.assertIn("test_profiling.py:serve", stack)
+        self.assertTrue(sampler.folded().endswith(" 1\n"))
+
+
+class ProfilingEndpointTestCase(TestCase):
+    """Test the internal endpoint and header-triggered request profiles."""
+
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.app = make_app(self.profile_dir.name)
+        self.client = self.app.test_client()
+        profiling.sampler.reset()
+
+    def tearDown(self):
+        profiling.sampler.stop()
+        profiling.sampler.reset()
+        self.profile_dir.cleanup()
+
+    def test_endpoint_needs_token(self):
+        self.assertEqual(self.client.get("/internal/profile").status_code, 403)
+
+        resp = self.client.get(
+            "/internal/profile", headers={"Authorization": "Bearer wrong"}
+        )
+        self.assertEqual(resp.status_code, 403)
+
+    def test_endpoint_returns_folded_stacks(self):
+        self.client.get("/busy")
+
+        resp = self.client.get(
+            "/internal/profile?reset=1", headers={"Authorization": "Bearer s3cret"}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("busy;", resp.get_data(as_text=True))
+        self.assertEqual(profiling.sampler.samples, 0)
+
+    def test_profile_request_by_header(self):
+        resp = self.client.get("/busy")
+        self.assertNotIn("X-Profile-File", resp.headers)
+
+        resp = self.client.get("/busy", headers={profiling.PROFILE_HEADER: "s3cret"})
+        name = resp.headers["X-Profile-File"]
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir.name, name)))
+
+    def test_disabled_without_token(self):
+        app = Flask(__name__)
+        profiling.init_app(app)
+
+        self.assertEqual(app.test_client().get("/internal/profile").status_code, 404)
+
+
+class JSONFormatterTestCase(TestCase):
+    """Test structured log records."""
+
+    def test_request_and_extra_fields(self):
+        app = Flask(__name__)
+        record = logging.makeLogRecord(
+            {
+                "name": "app",
+                "levelno": logging.INFO,
+                "levelname": "INFO",
+                "msg": "Liked %s",
+                "args": ("it",),
+                "message_id": 3,
+            }
+        )
+
+        with app.test_request_context("/msg/like/3", method="POST"):
+            entry = json.loads(logs.JSONFormatter().format(record))
+
+        self.assertEqual(entry["msg"], "Liked it")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["method"], "POST")
+        self.assertEqual(entry["path"], "/msg/like/3")
+        self.assertEqual(entry["message_id"], 3)
+
+    def test_init_app_replaces_its_handlers(self):
+        root = logging.getLogger()
+        before = list(root.handlers)
+        root.handlers.extend([logs._WarblerHandler(), logs._WarblerHandler()])
+
+        try:
+            logs.init_app(Flask(__name__))
+            ours = [h for h in root.handlers if isinstance(h, logs._WarblerHandler)]
+            self.assertEqual(len(ours), 1)
+        finally:
+            root.handlers[:] = before
@@ -0,0 +1,124 @@
+"""Rate limiting and admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from flask import Flask, request
+
+import ratelimit
+from ratelimit import Rate
+
+
+def make_app(current_user):
+    """A bare app with a few limited views, so no database is needed."""
+
+    app = Flask(__name__)
+    ratelimit.init_app(app, user_id=lambda: current_user[0])
+
+    @app.route("/login", methods=["GET", "POST"])
+    @ratelimit.limit(per_ip=Rate(2, 60), methods=["POST"])
+    def login():
+        return "ok"
+
+    @app.get("/search")
+    @ratelimit.limit(per_user=Rate(1, 60), when=lambda: "q" in request.args)
+    def search():
+        return "ok"
+
+    @app.get("/slow")
+    @ratelimit.limit(concurrency=1)
+    def slow():
+        return "ok"
+
+    return app
+
+
+class RateLimitTestCase(TestCase):
+    """Test token buckets, concurrency slots and the request hook."""
+
+    def setUp(self):
+        self.current_user = [None]
+        self.app = make_app(self.current_user)
+        self.client = self.app.test_client()
+        self.backend = self.app.extensions["ratelimit"]
+
+    def test_per_ip_bucket(self):
+        self.assertEqual(self.client.post("/login").status_code, 200)
+        self.assertEqual(self.client.post("/login").status_code, 200)
+
+        resp = self.client.post("/login")
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+
+        # GETs aren't limited, and other clients have their own bucket.
+        self.assertEqual(self.client.get("/login").status_code, 200)
+        resp = self.client.post("/login", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_per_user_bucket_and_condition(self):
+        self.current_user[0] = 1
+        self.assertEqual(self.client.get("/search?q=a").status_code, 200)
+        self.assertEqual(self.client.get("/search?q=a").status_code, 429)
+        self.assertEqual(self.client.get("/search").status_code, 200)
+
+        self.current_user[0] = 2
+        self.assertEqual(self.client.get("/search?q=a").status_code, 200)
+
+    def test_concurrency_cap(self):
+        token = self.backend.acquire("slow:slots", 1)
+        self.assertIsNotNone(token)
+
+        resp = self.client.get("/slow")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+        self.backend.release("slow:slots", token)
+        self.assertEqual(self.client.get("/slow").status_code, 200)
+        # The request gave its slot back.
+        self.assertEqual(self.client.get("/slow").status_code, 200)
+
+    def test_release_only_frees_own_slot(self):
+        backend = ratelimit.MemoryBackend()
+        first = backend.acquire("k", 2)
+        second = backend.acquire("k", 2)
+        self.assertIsNone(backend.acquire("k", 2))
+
+        # Releasing twice doesn't hand out the other holder's slot.
+        backend.release("k", first)
+        backend.release("k", first)
+        self.assertIsNotNone(backend.acquire("k", 2))
+        self.assertIsNone(backend.acquire("k", 2))
+
+        backend.release("k", second)
+        self.assertIsNotNone(backend.acquire("k", 2))
+
+    def test_bucket_refills(self):
+        backend = ratelimit.MemoryBackend()
+        rate = Rate(1, 0.05)
+
+        self.assertEqual(backend.take("k", rate), 0)
+        self.assertGreater(backend.take("k", rate), 0)
+
+        backend._buckets["k"] = (0, backend._buckets["k"][1] - 0.05, 0)
+        self.assertEqual(backend.take("k", rate), 0)
+
+    def test_disabled(self):
+        app = Flask(__name__)
+        app.config["RATELIMIT_ENABLED"] = False
+        ratelimit.init_app(app, user_id=lambda: None)
+
+        self.assertNotIn("ratelimit", app.extensions)
+
+    def test_shared_store_required(self):
+        app = Flask(__name__)
+        app.config["SHARED_STORES_REQUIRED"] = True
+
+        with self.assertRaises(RuntimeError):
+            ratelimit.init_app(app, user_id=lambda: None)
+
+        app.config["RATELIMIT_ENABLED"] = False
+        ratelimit.init_app(app, user_id=lambda: None)
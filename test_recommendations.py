@@ -0,0 +1,136 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Recommendation, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import recommendations
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class FriendsOfFriendsTestCase(TestCase):
+    """Test candidate scoring on plain in-memory graphs."""
+
+    def test_scores_by_mutual_follows(self):
+        graph = {1: [2, 3], 2: [3, 4, 5], 3: [4, 1], 4: [], 5: []}
+
+        ranked = recommendations.friends_of_friends(1, graph.get)
+
+        # 4 is followed by both 2 and 3; 3 is already followed; 1 is self.
+        self.assertEqual(ranked, [(4, 2), (5, 1)])
+
+    def test_sampling_bounds(self):
+        graph = {1: list(range(2, 1000))}
+        for friend in range(2, 1000):
+            graph[friend] = list(range(1000, 1500))
+
+        ranked = recommendations.friends_of_friends(
+            1, graph.get, max_seeds=10, max_fanout=5, keep_top=100
+        )
+
+        self.assertLessEqual(sum(score for _, score in ranked), 10 * 5)
+        self.assertEqual(
+            ranked,
+            recommendations.friends_of_friends(
+                1, graph.get, max_seeds=10, max_fanout=5, keep_top=100
+            ),
+        )
+
+
+class RecommendationRefreshTestCase(TestCase):
+    """Test that follows refresh the stored recommendations."""
+
+    def setUp(self):
+        User.query.delete()
+        Job.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        self.users = [
+            User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.commit()
+        self.ids = [u.id for u in self.users]
+
+        # user1 and user2 both follow user3
+        db.session.add_all(
+            [
+                Follows(
+                    user_being_followed_id=self.ids[3], user_following_id=self.ids[1]
+                ),
+                Follows(
+                    user_being_followed_id=self.ids[3], user_following_id=self.ids[2]
+                ),
+                Follows(
+                    user_being_followed_id=self.ids[2], user_following_id=self.ids[0]
+                ),
+            ]
+        )
+        db.session.commit()
+        # Drop any earlier test's users from the worker's graph.
+        recommendations.follow_graph.load_from_db()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_follow_refreshes_recommendations(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            c.post(f"/users/follow/{self.ids[1]}")
+
+        jobs.run_pending()
+
+        recs = Recommendation.query.filter_by(user_id=self.ids[0]).all()
+        self.assertEqual([(r.candidate_id, r.score) for r in recs], [(self.ids[3], 2)])
+
+        suggested = recommendations.recommended_users(self.ids[0])
+        self.assertEqual([u.username for u in suggested], ["user3"])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@user3", html)
+
+    def test_unfollow_rescores_followers(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+            c.post(f"/users/follow/{self.ids[1]}")
+        jobs.run_pending()
+
+        # user1's unfollow changes what user0 reaches through user1.
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[1]
+            c.post(f"/users/stop-following/{self.ids[3]}")
+        jobs.run_pending()
+
+        recs = Recommendation.query.filter_by(user_id=self.ids[0]).all()
+        self.assertEqual([(r.candidate_id, r.score) for r in recs], [(self.ids[3], 1)])
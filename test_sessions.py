@@ -0,0 +1,164 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Flask, g
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import sessions
+from sessions import MemoryStore, ServerSideSessionInterface
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class MemoryStoreTestCase(TestCase):
+    """Test the in-process Redis stand-in."""
+
+    def test_get_setex_delete(self):
+        store = MemoryStore()
+        store.setex("a", 60, b"1")
+        store.setex("b", -1, b"2")
+
+        self.assertEqual(store.get("a"), b"1")
+        self.assertIsNone(store.get("b"))
+        self.assertIsNone(store.get("missing"))
+
+        store.delete("a")
+        self.assertIsNone(store.get("a"))
+
+    def test_expired_keys_are_swept(self):
+        store = MemoryStore(sweep_interval=0)
+        store.setex("gone", -1, b"1")
+        store.set("kept", b"2")
+
+        # Neither key was read, but the second write swept the first.
+        self.assertEqual(len(store), 1)
+
+
+class ServerSideSessionTestCase(TestCase):
+    """Test that session data stays on the server."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup("sessionuser", "session@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.store = MemoryStore()
+        self.original_interface = app.session_interface
+        app.session_interface = ServerSideSessionInterface(self.store)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.session_interface = self.original_interface
+        db.session.rollback()
+
+    def test_cookie_holds_only_session_id(self):
+        resp = self.client.post(
+            "/login", data={"username": "sessionuser", "password": "password"}
+        )
+
+        self.assertEqual(resp.status_code, 302)
+        cookie = resp.headers["Set-Cookie"]
+        self.assertNotIn("curr_user", cookie)
+        self.assertLess(len(cookie), 200)
+        self.assertEqual(len(self.store), 1)
+
+        # The flash message is consumed on the next page...
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("Hello, sessionuser!", html)
+
+        # ...after which the session is unchanged and nothing is re-sent.
+        resp = self.client.get("/")
+        self.assertNotIn("Set-Cookie", resp.headers)
+
+    def test_anonymous_requests_get_no_session(self):
+        resp = self.client.get("/")
+
+        self.assertNotIn("Set-Cookie", resp.headers)
+        self.assertEqual(len(self.store), 0)
+
+    def test_tampered_cookie_is_ignored(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.set_cookie("localhost", app.session_cookie_name, "forged.sig")
+        html = self.client.get("/").get_data(as_text=True)
+
+        self.assertIn("Sign up", html)
+
+    def test_logout_clears_stored_session(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.post("/logout")
+        self.client.get("/")
+
+        self.assertEqual(len(self.store), 0)
+
+    def test_login_moves_session_to_new_id(self):
+        with self.client.session_transaction() as sess:
+            sess["planted"] = True
+            planted = sess.sid
+
+        self.client.post(
+            "/login", data={"username": "sessionuser", "password": "password"}
+        )
+
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess[CURR_USER_KEY], self.user_id)
+            self.assertNotEqual(sess.sid, planted)
+        self.assertIsNone(self.store.get(f"session:{planted}"))
+
+
+class SessionBackendTestCase(TestCase):
+    """Test which store each configuration gets."""
+
+    def interface(self, **config):
+        app = Flask(__name__)
+        app.config.update(config)
+        sessions.init_app(app)
+        return app.session_interface
+
+    def test_memory_outside_production(self):
+        self.assertIsInstance(self.interface(), ServerSideSessionInterface)
+
+    def test_production_falls_back_to_cookies(self):
+        for backend in (None, "memory"):
+            interface = self.interface(
+                SHARED_STORES_REQUIRED=True, SESSION_BACKEND=backend
+            )
+            self.assertNotIsInstance(interface, ServerSideSessionInterface)
+
+
+class LazyCSRFTestCase(TestCase):
+    """Test that the CSRF form is only built when a template needs it."""
+
+    def test_csrf_form_built_on_demand(self):
+        with app.test_client() as c:
+            c.get("/users")
+            self.assertNotIn("csrf_checking", g)
+
+            self.assertIsNotNone(g.csrf_checking)
+            self.assertIn("csrf_checking", g)
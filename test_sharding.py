@@ -0,0 +1,162 @@
+"""Sharding tests, against three SQLite files."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import text
+
+from models import db, Follows, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, create_app, CURR_USER_KEY
+from cache import cache
+from sessions import MemoryStore
+import timeline
+
+SHARDS = 3
+
+
+class ShardingTestCase(TestCase):
+    """Test routing, id allocation and the merged timeline."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        urls = [f"sqlite:///{cls.tmp.name}/shard{n}.db" for n in range(SHARDS)]
+
+        env = {
+            "DATABASE_URL": urls[0],
+            "SHARD_DATABASE_URLS": ",".join(urls[1:]),
+            "SECRET_KEY": os.environ.get("SECRET_KEY", "test"),
+        }
+        with patch.dict(os.environ, env):
+            cls.app = create_app("testing")
+        cls.app.config["WTF_CSRF_ENABLED"] = False
+
+        # connect_db() made the sharded app db's default; put it back.
+        db.app = app
+        cls.router = cls.app.extensions["shards"]
+
+    @classmethod
+    def tearDownClass(cls):
+        for engine in cls.router.engines.values():
+            engine.dispose()
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        db.session.remove()
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        self.addCleanup(db.session.remove)
+
+        for engine in self.router.engines.values():
+            db.metadata.drop_all(engine)
+        self.router.create_all(db.metadata)
+
+        self.users = [
+            User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+            for i in range(9)
+        ]
+        db.session.commit()
+        self.ids = [u.id for u in self.users]
+
+    def rows_on(self, shard, sql):
+        with self.router.engines[shard].connect() as conn:
+            return conn.execute(text(sql)).all()
+
+    def test_users_spread_and_routed_by_id(self):
+        placed = {
+            shard: {row.id for row in self.rows_on(shard, "SELECT id FROM users")}
+            for shard in self.router.engines
+        }
+
+        self.assertGreater(sum(1 for ids in placed.values() if ids), 1)
+        for shard, ids in placed.items():
+            self.assertTrue(all(str(i % SHARDS) == shard for i in ids))
+        self.assertEqual(set().union(*placed.values()), set(self.ids))
+
+        db.session.remove()
+        for user_id in self.ids:
+            self.assertEqual(User.query.get(user_id).id, user_id)
+        self.assertEqual(User.authenticate("user4", "password").id, self.ids[4])
+
+    def test_messages_live_with_their_author(self):
+        for user_id in self.ids:
+            db.session.add(Message(text=f"from {user_id}", user_id=user_id))
+        db.session.commit()
+        db.session.remove()
+
+        for shard in self.router.engines:
+            for row in self.rows_on(shard, "SELECT id, user_id FROM messages"):
+                self.assertEqual(str(row.user_id % SHARDS), shard)
+                self.assertEqual(str(row.id % SHARDS), shard)
+
+        user = User.query.get(self.ids[5])
+        self.assertEqual([m.text for m in user.messages], [f"from {self.ids[5]}"])
+        msg = Message.query.get(user.messages[0].id)
+        self.assertEqual(msg.user.username, "user5")
+
+    def test_timeline_merges_shards(self):
+        start = datetime(2020, 1, 1)
+        for n in range(30):
+            author = self.ids[n % len(self.ids)]
+            db.session.add(
+                Message(
+                    text=f"#{n}", user_id=author, timestamp=start + timedelta(hours=n)
+                )
+            )
+        db.session.commit()
+
+        authors = self.ids[:6]
+        everything = [m for m in Message.query.all() if m.user_id in authors]
+        expected = sorted(everything, key=lambda m: (m.timestamp, m.id), reverse=True)
+
+        self.assertEqual(
+            [m.id for m in Message.timeline(authors, 10)],
+            [m.id for m in expected[:10]],
+        )
+
+        cache.configure(MemoryStore(), shared=True)
+        self.app.config["TIMELINE_FANIN"] = True
+        self.addCleanup(setattr, cache, "enabled", False)
+        self.addCleanup(self.app.config.update, TIMELINE_FANIN=False)
+        self.assertEqual(
+            [m.id for m in timeline.home(authors, 10)],
+            [m.id for m in expected[:10]],
+        )
+
+    def test_handlers_unaware_of_shards(self):
+        follower, followed = self.ids[0], self.ids[1]
+        db.session.add(Message(text="hello from the other shard", user_id=followed))
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = follower
+
+        client.post(f"/users/follow/{followed}")
+        shard = self.router.shard_for(follower)
+        self.assertEqual(
+            self.rows_on(shard, "SELECT user_being_followed_id FROM follows"),
+            [(followed,)],
+        )
+
+        html = client.get("/").get_data(as_text=True)
+        self.assertIn("hello from the other shard", html)
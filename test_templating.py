@@ -0,0 +1,75 @@
+"""Template precompilation and render profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import templating
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class TemplatingTestCase(TestCase):
+    """Test the bytecode cache, precompile and the render profiler."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup("renderer", "render@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(text="rendered by a macro", user_id=user.id))
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+        self.profiler = templating.RenderProfiler()
+        self.profiler.connect(app)
+
+    def tearDown(self):
+        self.profiler.disconnect(app)
+        db.session.rollback()
+
+    def test_precompile_loads_every_template(self):
+        count = templating.precompile(app)
+
+        self.assertGreaterEqual(count, 10)
+        self.assertIsNotNone(app.jinja_env.bytecode_cache)
+        self.assertIn("macros/messages.html", app.jinja_env.list_templates())
+
+    def test_profiler_records_templates_and_blocks(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            # Render twice: parent templates get instrumented once cached.
+            c.get(f"/users/{self.user_id}")
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+
+        self.assertIn("rendered by a macro</p>", html)
+        self.assertEqual(self.profiler.templates["users/show.html"].count, 2)
+        self.assertGreaterEqual(
+            self.profiler.blocks["users/show.html:user_details"].count, 1
+        )
+        self.assertGreaterEqual(
+            self.profiler.blocks["users/detail.html:content"].count, 1
+        )
+        self.assertIn("users/show.html", self.profiler.report())
@@ -0,0 +1,114 @@
+"""Merged home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from cache import cache
+from sessions import MemoryStore
+import timeline
+
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test that the merged timeline matches the SQL one and stays fresh."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.ids = []
+        for n in range(12):
+            user = User(username=f"user{n}", email=f"{n}@test.com", password="x")
+            db.session.add(user)
+            db.session.flush()
+            self.ids.append(user.id)
+
+        # Clashing timestamps, so the id tie-break matters too.
+        start = datetime(2021, 1, 1)
+        for n in range(300):
+            db.session.add(
+                Message(
+                    text=f"#{n}",
+                    user_id=self.ids[n * 7 % len(self.ids)],
+                    timestamp=start + timedelta(minutes=n // 3),
+                )
+            )
+        db.session.commit()
+
+        # One process's MemoryStore stands in for Redis here.
+        cache.configure(MemoryStore(), shared=True)
+        app.config["TIMELINE_FANIN"] = True
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        app.config["TIMELINE_FANIN"] = False
+        cache.enabled = False
+        db.session.rollback()
+
+    def assertMatchesSQL(self, user_ids, limit):
+        self.assertEqual(
+            [msg.id for msg in timeline.home(user_ids, limit)],
+            [msg.id for msg in Message.timeline(user_ids, limit)],
+        )
+
+    def test_matches_sql_ordering(self):
+        self.assertMatchesSQL(self.ids, 100)
+        self.assertMatchesSQL(self.ids[:5], 20)
+        # Second time round it's all from the cache.
+        self.assertMatchesSQL(self.ids, 100)
+        self.assertEqual(cache.stats["recent"].misses, len(self.ids))
+
+    def test_parallel_slices(self):
+        with patch.object(timeline, "PARALLEL_FROM", 4), patch.object(
+            timeline, "CHUNK", 5
+        ):
+            self.assertMatchesSQL(self.ids, 100)
+            self.assertMatchesSQL(self.ids, 100)
+
+    def test_new_message_invalidates(self):
+        self.assertMatchesSQL(self.ids, 10)
+
+        msg = Message(text="breaking", user_id=self.ids[3])
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(timeline.home(self.ids, 10)[0].id, msg.id)
+        self.assertMatchesSQL(self.ids, 10)
+
+    def test_falls_back_without_cache(self):
+        cache.enabled = False
+        self.assertMatchesSQL(self.ids, 50)
+        self.assertEqual(timeline.home([], 10), [])
+
+    def test_off_by_default_and_with_unshared_store(self):
+        cache.configure(MemoryStore())
+        self.assertFalse(timeline.enabled())
+
+        cache.configure(MemoryStore(), shared=True)
+        app.config["TIMELINE_FANIN"] = False
+        self.assertFalse(timeline.enabled())
+
+        timeline.home(self.ids, 10)
+        self.assertNotIn("recent", cache.stats)
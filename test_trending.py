@@ -0,0 +1,144 @@
+"""Trending warbles and hashtags tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Job, MessageTrend, HashtagCount
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import trending
+
+db.create_all()
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class TrendingTestCase(TestCase):
+    """Test trending scores, hashtag windows and the /trending page."""
+
+    def setUp(self):
+        User.query.delete()
+        Job.query.delete()
+        HashtagCount.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.author_id, self.fan_id = author.id, fan.id
+
+        old = Message(text="old news", user_id=author.id)
+        new = Message(text="fresh news", user_id=author.id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        self.old_id, self.new_id = old.id, new.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_recent_likes_outrank_older_ones(self):
+        now = datetime.utcnow()
+
+        for _ in range(3):
+            trending.record_like(self.old_id, now - 4 * trending.HALF_LIFE)
+        trending.record_like(self.new_id, now)
+        db.session.commit()
+
+        self.assertEqual(
+            [m.id for m in trending.trending_messages()], [self.new_id, self.old_id]
+        )
+
+        old_score = MessageTrend.query.get(self.old_id).score
+        self.assertAlmostEqual(trending.decayed_likes(old_score, now), 3 / 16)
+
+    def test_like_updates_trending_through_job(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+
+            c.post(f"/msg/like/{self.new_id}")
+
+        jobs.run_pending()
+
+        self.assertIsNotNone(MessageTrend.query.get(self.new_id))
+        html = self.client.get("/trending").get_data(as_text=True)
+        self.assertIn("fresh news", html)
+        self.assertNotIn("old news", html)
+
+    def test_unlike_takes_back_its_score(self):
+        now = datetime.utcnow()
+
+        trending.record_like(self.new_id, now - trending.HALF_LIFE)
+        trending.record_like(self.new_id, now)
+        trending.unrecord_like(self.new_id, now)
+        db.session.commit()
+
+        score = MessageTrend.query.get(self.new_id).score
+        self.assertAlmostEqual(trending.decayed_likes(score, now), 1 / 2)
+
+        trending.unrecord_like(self.new_id, now - trending.HALF_LIFE)
+        db.session.commit()
+        self.assertIsNone(MessageTrend.query.get(self.new_id))
+
+    def test_like_toggling_doesnt_inflate_score(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+
+            for _ in range(3):
+                c.post(f"/msg/like/{self.new_id}")
+                c.post(f"/msg/stop-liking/{self.new_id}")
+            c.post(f"/msg/like/{self.new_id}")
+
+        jobs.run_pending()
+
+        score = MessageTrend.query.get(self.new_id).score
+        self.assertAlmostEqual(trending.decayed_likes(score), 1, places=3)
+
+    def test_hashtags_counted_in_window(self):
+        now = datetime.utcnow()
+
+        self.assertEqual(
+            trending.parse_hashtags("#Flask and #flask #db"), ["db", "flask"]
+        )
+
+        trending.record_hashtags("#flask #db", now)
+        trending.record_hashtags("#flask", now - timedelta(hours=2))
+        trending.record_hashtags("#stale", now - timedelta(hours=30))
+        db.session.commit()
+
+        self.assertEqual(trending.trending_hashtags(now=now), [("flask", 2), ("db", 1)])
+
+        trending.prune_hashtags(now)
+        db.session.commit()
+        self.assertIsNone(HashtagCount.query.filter_by(tag="stale").first())
+
+    def test_posting_counts_hashtags(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            c.post("/messages/new", data={"text": "Shipping #warbler"})
+
+        jobs.run_pending()
+
+        html = self.client.get("/trending").get_data(as_text=True)
+        self.assertIn("#warbler", html)
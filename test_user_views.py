@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows, DEFAULT_IMAGE
+from models import db, connect_db, Message, User, Follows, Likes, DEFAULT_IMAGE
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +19,7 @@ os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, FOLLOWS_PER_PAGE, STREAM_BATCH
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -127,3 +127,174 @@ class UserViewTestCase(TestCase):
     #         html_user_show_page = response_user_show_page.get_data(as_text=True)
 
     #         self.assertNotIn("DeleteMePlease</p>", html_user_show_page)
+
+    def test_delete_user_cascades(self):
+        """Does deleting a user remove their messages, likes and follows?"""
+
+        other = User.signup(
+            username="otheruser",
+            email="other@test.com",
+            password="otheruser",
+            image_url=None,
+        )
+        db.session.commit()
+
+        own_msg = Message(text="mine", user_id=self.testuser.id)
+        other_msg = Message(text="theirs", user_id=other.id)
+        db.session.add_all([own_msg, other_msg])
+        db.session.commit()
+
+        db.session.add_all(
+            [
+                Follows(
+                    user_being_followed_id=other.id,
+                    user_following_id=self.testuser.id,
+                ),
+                Follows(
+                    user_being_followed_id=self.testuser.id,
+                    user_following_id=other.id,
+                ),
+                Likes(user_id=self.testuser.id, message_being_liked_id=other_msg.id),
+                Likes(user_id=other.id, message_being_liked_id=own_msg.id),
+            ]
+        )
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNone(User.query.get(testuser_id))
+        self.assertEqual(Message.query.filter_by(user_id=testuser_id).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Message.query.filter_by(user_id=other_id).count(), 1)
+
+    def test_followers_paginated(self):
+        """Are followers paged newest first, with follow-back flags?"""
+
+        followers = [
+            User.signup(
+                username=f"follower{i}",
+                email=f"follower{i}@test.com",
+                password="password",
+                image_url=None,
+            )
+            for i in range(FOLLOWS_PER_PAGE + 2)
+        ]
+        db.session.commit()
+
+        for follower in followers:
+            db.session.add(
+                Follows(
+                    user_being_followed_id=self.testuser.id,
+                    user_following_id=follower.id,
+                )
+            )
+            db.session.commit()
+
+        db.session.add(
+            Follows(
+                user_being_followed_id=followers[-1].id,
+                user_following_id=self.testuser.id,
+            )
+        )
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{testuser_id}/followers")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"@follower{FOLLOWS_PER_PAGE + 1}</p>", html)
+            self.assertNotIn("@follower0</p>", html)
+            self.assertIn("Unfollow", html)
+            self.assertIn("?page=2", html)
+
+            resp = c.get(f"/users/{testuser_id}/followers?page=2")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@follower0</p>", html)
+            self.assertIn("@follower1</p>", html)
+            self.assertNotIn("@follower2</p>", html)
+            self.assertNotIn("Unfollow", html)
+
+    def test_list_users_streamed(self):
+        """Is the user list streamed, across batches, with follow flags?"""
+
+        users = [
+            User(username=f"user{i}", email=f"user{i}@test.com", password="x")
+            for i in range(STREAM_BATCH + 5)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        followed = [users[0], users[STREAM_BATCH + 1]]
+        for user in followed:
+            db.session.add(
+                Follows(
+                    user_being_followed_id=user.id,
+                    user_following_id=self.testuser.id,
+                )
+            )
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get("/users")
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"@user{STREAM_BATCH + 4}</p>", html)
+            self.assertEqual(html.count(">Unfollow<"), len(followed))
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_liked_messages_streamed(self):
+        """Does the likes page stream the user's liked messages?"""
+
+        other = User(username="otheruser", email="other@test.com", password="x")
+        db.session.add(other)
+        db.session.commit()
+
+        messages = [Message(text=f"warble {i}", user_id=other.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        for msg in messages[:2]:
+            db.session.add(
+                Likes(user_id=self.testuser.id, message_being_liked_id=msg.id)
+            )
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{testuser_id}/likes")
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("warble 0", html)
+            self.assertIn("warble 1", html)
+            self.assertNotIn("warble 2", html)
+            self.assertEqual(html.count('class="liked '), 2)
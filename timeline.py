@@ -0,0 +1,204 @@
+"""The home timeline, merged from cached per-author lists of recent messages.
+
+`Message.timeline` has the database find the newest `limit` messages among
+everyone a user follows, which means reading and sorting the recent messages
+of every one of them on every page view. `home` instead keeps each author's
+newest `RECENT_PER_AUTHOR` (timestamp, id) pairs in the cache, as
+``recent:<user id>`` (see cache.py), merges those already-sorted lists with a
+heap, and looks up only the messages that made the cut, by primary key.
+
+Each list is cached as one string of fixed-width hex entries, timestamp then
+id, newest first. Entries compare as strings the way the columns do, so the
+merge reads them straight out of the string and only as far as it needs to;
+a follow set of thousands costs thousands of short strings, not thousands of
+decoded lists.
+
+No author can have more than `limit` messages in the newest `limit`, so as
+long as `limit` is at most `RECENT_PER_AUTHOR` the result is exactly what the
+SQL ordering (timestamp, then id, newest first) gives.
+
+This is off unless ``TIMELINE_FANIN`` is set, and even then only runs with a
+shared cache store (Redis); everything else, and bigger timelines, use
+`Message.timeline`. That's the better default: benchmarks/bench_timeline.py
+has the SQL query ahead at most follow counts, and filling cold lists costs
+far more than one query. The merge pays off where the database is the
+bottleneck and a Redis round trip is cheap. With a per-process store the
+lists would also be invalidated only in the process that made the change.
+
+Follow sets of `PARALLEL_FROM` authors or more are cut into `CHUNK`-sized
+slices, each fetched and merged on a small thread pool, and the slices'
+results merged again. That pays off when the cache is Redis or cold authors
+have to be read from the database, both of which wait on I/O; for small
+follow sets it would be all overhead.
+
+An author's list is invalidated by the events that change it: their message
+being posted, deleted or archived, or the author being deleted. Lists are
+also only kept for `RECENT_TTL`, which bounds how stale one can be if an
+invalidation is missed (say, a process dying between commit and consumer).
+"""
+
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+import events
+import shards
+from cache import cache
+from models import db, Message
+
+logger = logging.getLogger(__name__)
+
+RECENT_PER_AUTHOR = 100
+RECENT_TTL = 300
+
+PARALLEL_FROM = 2000
+CHUNK = 1000
+WORKERS = 4
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+ENTRY = 32  # hex digits: 16 of timestamp (in microseconds), 16 of id
+
+# Threads are only started once something is submitted, so this is safe to
+# create before gunicorn forks.
+_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="timeline")
+
+
+def home(user_ids, limit):
+    """The `limit` newest messages by any of `user_ids`, newest first."""
+
+    if not enabled() or limit > RECENT_PER_AUTHOR:
+        return Message.timeline(user_ids, limit)
+
+    ids = [int(entry[ENTRY // 2 :], 16) for entry in newest(user_ids, limit)]
+    if not ids:
+        return []
+
+    by_id = {
+        msg.id: msg
+        for msg in Message.query.options(joinedload(Message.user)).filter(
+            Message.id.in_(ids)
+        )
+    }
+    return [by_id[message_id] for message_id in ids if message_id in by_id]
+
+
+def enabled():
+    """Is the merged timeline on: ``TIMELINE_FANIN`` and a shared cache?"""
+
+    return (
+        bool(current_app.config.get("TIMELINE_FANIN"))
+        and cache.enabled
+        and cache.shared
+    )
+
+
+def init_app(app):
+    """Warn if ``TIMELINE_FANIN`` is set but can't take effect."""
+
+    if app.config.get("TIMELINE_FANIN") and not (cache.enabled and cache.shared):
+        logger.warning(
+            "TIMELINE_FANIN needs a shared (Redis) cache; using the SQL timeline"
+        )
+
+
+def newest(user_ids, limit):
+    """The `limit` newest entries (see `_entry`) by any of `user_ids`."""
+
+    user_ids = list(user_ids)
+    if len(user_ids) < PARALLEL_FROM:
+        return _newest(user_ids, limit)
+
+    app = current_app._get_current_object()
+    slices = [user_ids[i : i + CHUNK] for i in range(0, len(user_ids), CHUNK)]
+    merged = _pool.map(lambda ids: _newest_in_context(app, ids, limit), slices)
+    return list(islice(heapq.merge(*merged, reverse=True), limit))
+
+
+def _newest_in_context(app, user_ids, limit):
+    with app.app_context():
+        try:
+            return _newest(user_ids, limit)
+        finally:
+            db.session.remove()
+
+
+def _newest(user_ids, limit):
+    recent = cache.get_many_or_load(
+        [f"recent:{user_id}" for user_id in user_ids],
+        _load_recent,
+        RECENT_TTL,
+        tags=lambda key: [key],
+    )
+    streams = [_entries(entries) for entries in recent.values() if entries]
+    return list(islice(heapq.merge(*streams, reverse=True), limit))
+
+
+def _entry(timestamp, message_id):
+    """A message's (timestamp, id) as a string that sorts the same way."""
+
+    return f"{(timestamp - EPOCH) // MICROSECOND:016x}{message_id:016x}"
+
+
+def _entries(entries):
+    return (entries[i : i + ENTRY] for i in range(0, len(entries), ENTRY))
+
+
+def _load_recent(keys):
+    """Each ``recent:<id>`` key's newest entries, from SQL."""
+
+    recent = {key: [] for key in keys}
+    user_ids = [int(key.split(":", 1)[1]) for key in keys]
+
+    for start in range(0, len(user_ids), CHUNK):
+        for shard_id, ids in shards.by_shard(user_ids[start : start + CHUNK]):
+            for user_id, timestamp, message_id in _recent_rows(shard_id, ids):
+                recent[f"recent:{user_id}"].append(_entry(timestamp, message_id))
+
+    return {key: "".join(entries) for key, entries in recent.items()}
+
+
+def _recent_rows(shard_id, user_ids):
+    # Rank each author's messages with a window function, so the database
+    # only hands back the newest RECENT_PER_AUTHOR of each.
+    rank = (
+        func.row_number()
+        .over(
+            partition_by=Message.user_id,
+            order_by=(Message.timestamp.desc(), Message.id.desc()),
+        )
+        .label("rank")
+    )
+    ranked = (
+        db.session.query(Message.user_id, Message.timestamp, Message.id, rank)
+        .filter(Message.user_id.in_(user_ids))
+        .subquery()
+    )
+    query = (
+        db.session.query(ranked.c.user_id, ranked.c.timestamp, ranked.c.id)
+        .filter(ranked.c.rank <= RECENT_PER_AUTHOR)
+        .order_by(ranked.c.user_id, ranked.c.timestamp.desc(), ranked.c.id.desc())
+    )
+    if shard_id is not None:
+        query = query.execution_options(_sa_shard_id=shard_id)
+    return query.all()
+
+
+@events.consumer(
+    "message.created", "message.deleted", "message.archived", "user.deleted"
+)
+def invalidate(batch):
+    """Drop the recent-message lists of authors whose messages changed."""
+
+    cache.invalidate(
+        *{
+            f"recent:{data['id'] if kind == 'user.deleted' else data['user_id']}"
+            for kind, data in batch
+        }
+    )
@@ -0,0 +1,184 @@
+"""Trending warbles and hashtags.
+
+Both are kept up to date in the worker by a durable consumer of
+``like.created``, ``like.deleted`` and ``message.created`` events (see events.py), so the
+/trending page reads a few precomputed rows and never has to scan ``likes``.
+
+Message scores decay exponentially with a half-life of ``HALF_LIFE``. Rather
+than rewriting every score as time passes, a like at time t adds
+``exp((t - EPOCH) / TAU)`` -- later likes are worth more -- and the score is
+stored as the log of that sum to keep it in floating-point range. All scores
+decay at the same rate, so ordering by the stored score is ordering by the
+current decayed like count, which ``decayed_likes()`` recovers on demand.
+An unlike subtracts the weight its like added, so toggling a like doesn't
+pile up score.
+
+Hashtags are counted per hourly bucket; the trending list sums the buckets
+inside the last ``HASHTAG_WINDOW``, and buckets that slide out of the window
+are pruned as new warbles come in.
+"""
+
+import math
+import re
+from datetime import datetime, timedelta
+
+import events
+from models import db, HashtagCount, Message, MessageTrend
+
+EPOCH = datetime(2020, 1, 1)
+HALF_LIFE = timedelta(hours=6)
+TAU = HALF_LIFE.total_seconds() / math.log(2)
+LEFTOVER = 1e-9
+
+BUCKET = timedelta(hours=1)
+HASHTAG_WINDOW = timedelta(hours=24)
+TOP_K = 20
+
+HASHTAG_RE = re.compile(r"#(\w{1,50})")
+
+
+def like_weight(at):
+    """Log of the weight of a like made at `at`."""
+
+    return (at - EPOCH).total_seconds() / TAU
+
+
+def log_add(a, b):
+    """log(exp(a) + exp(b)) without overflowing."""
+
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+def log_sub(a, b):
+    """log(exp(a) - exp(b)), for b < a."""
+
+    return a + math.log1p(-math.exp(b - a))
+
+
+def decayed_likes(score, now=None):
+    """Turn a stored score back into a like count decayed to `now`."""
+
+    return math.exp(score - like_weight(now or datetime.utcnow()))
+
+
+def record_like(message_id, at):
+    """Add a like made at `at` to `message_id`'s score. Doesn't commit."""
+
+    trend = (
+        MessageTrend.query.filter_by(message_id=message_id).with_for_update().first()
+    )
+
+    if trend is None:
+        trend = MessageTrend(message_id=message_id, score=like_weight(at))
+        db.session.add(trend)
+    else:
+        trend.score = log_add(trend.score, like_weight(at))
+
+    return trend
+
+
+def unrecord_like(message_id, at):
+    """Take a like made at `at` back out of `message_id`'s score.
+
+    Doesn't commit. Drops the score altogether once nothing is left of it.
+    """
+
+    trend = (
+        MessageTrend.query.filter_by(message_id=message_id).with_for_update().first()
+    )
+    if trend is None:
+        return None
+
+    weight = like_weight(at)
+    # Whatever's left within rounding error of this like is this like.
+    if trend.score - weight < LEFTOVER:
+        db.session.delete(trend)
+        return None
+
+    trend.score = log_sub(trend.score, weight)
+    return trend
+
+
+def parse_hashtags(text):
+    """The distinct, lowercased hashtags in `text`."""
+
+    return sorted({tag.lower() for tag in HASHTAG_RE.findall(text)})
+
+
+def bucket_for(at):
+    return at.replace(minute=0, second=0, microsecond=0)
+
+
+def record_hashtags(text, at):
+    """Count `text`'s hashtags in the bucket for `at`. Doesn't commit."""
+
+    bucket = bucket_for(at)
+
+    for tag in parse_hashtags(text):
+        row = (
+            HashtagCount.query.filter_by(tag=tag, bucket=bucket)
+            .with_for_update()
+            .first()
+        )
+        if row is None:
+            row = HashtagCount(tag=tag, bucket=bucket, count=0)
+            db.session.add(row)
+        row.count += 1
+
+
+def prune_hashtags(now=None):
+    """Drop buckets that have slid out of the trending window."""
+
+    cutoff = bucket_for(now or datetime.utcnow()) - HASHTAG_WINDOW
+    HashtagCount.query.filter(HashtagCount.bucket <= cutoff).delete()
+
+
+def trending_messages(limit=TOP_K):
+    """The `limit` messages with the highest decayed like counts."""
+
+    return (
+        Message.query.join(MessageTrend, MessageTrend.message_id == Message.id)
+        .order_by(MessageTrend.score.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def trending_hashtags(limit=TOP_K, now=None):
+    """The top `limit` hashtags in the window, as (tag, uses) pairs."""
+
+    since = bucket_for(now or datetime.utcnow()) - HASHTAG_WINDOW + BUCKET
+    uses = db.func.sum(HashtagCount.count)
+
+    return (
+        db.session.query(HashtagCount.tag, uses)
+        .filter(HashtagCount.bucket >= since)
+        .group_by(HashtagCount.tag)
+        .order_by(uses.desc(), HashtagCount.tag)
+        .limit(limit)
+        .all()
+    )
+
+
+@events.consumer("like.created", "like.deleted", "message.created", durable=True)
+def on_events(batch):
+    for kind, data in batch:
+        if kind == "like.created":
+            if Message.query.get(data["message_id"]) is not None:
+                record_like(
+                    data["message_id"], datetime.fromisoformat(data["created_at"])
+                )
+
+        elif kind == "like.deleted":
+            # Likes from before created_at was recorded never scored.
+            if data.get("created_at"):
+                unrecord_like(
+                    data["message_id"], datetime.fromisoformat(data["created_at"])
+                )
+
+        else:
+            msg = Message.query.get(data["id"])
+            if msg is not None:
+                record_hashtags(msg.text, msg.timestamp)
+
+    prune_hashtags()
@@ -0,0 +1,13 @@
+"""Background job worker for Warbler.
+
+Run it alongside the web process (see Procfile):
+
+    python worker.py
+"""
+
+from app import create_app
+from jobs import run_worker
+
+if __name__ == "__main__":
+    with create_app().app_context():
+        run_worker()